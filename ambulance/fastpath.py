@@ -0,0 +1,208 @@
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from login.permissions import get_write_permissions
+
+from .models import Ambulance, AmbulanceStatus, AmbulanceUpdate
+
+# Fast path for the most common ambulance updates.
+#
+# Devices report status, location, location_timestamp and orientation
+# every few seconds. For these payloads validation and saving are done
+# here without going through AmbulanceSerializer. Anything else, including
+# invalid payloads, returns None from parse so that the caller falls back
+# to AmbulanceSerializer, which produces the regular error messages.
+
+FAST_PATH_FIELDS = frozenset(('status', 'location',
+                              'location_timestamp', 'orientation'))
+
+AMBULANCE_STATUS = frozenset(m.name for m in AmbulanceStatus)
+
+def parse_number(value):
+
+    # bool is an int but not a number here
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+
+    value = float(value)
+    if not math.isfinite(value):
+        return None
+
+    return value
+
+def parse(data):
+    """
+    Validate data using the same rules as AmbulanceSerializer.
+    Returns the validated data or None if the fast path does not apply.
+    """
+
+    if (not isinstance(data, dict) or not data or
+        not FAST_PATH_FIELDS.issuperset(data.keys())):
+        return None
+
+    validated_data = {}
+
+    # status
+    if 'status' in data:
+        if data['status'] not in AMBULANCE_STATUS:
+            return None
+        validated_data['status'] = data['status']
+
+    # orientation
+    if 'orientation' in data:
+        orientation = parse_number(data['orientation'])
+        if orientation is None:
+            return None
+        validated_data['orientation'] = orientation
+
+    # location and location_timestamp must be defined together
+    if 'location' in data or 'location_timestamp' in data:
+
+        location = data.get('location')
+        location_timestamp = data.get('location_timestamp')
+        if (not isinstance(location, dict) or
+            not isinstance(location_timestamp, str)):
+            return None
+
+        latitude = parse_number(location.get('latitude'))
+        longitude = parse_number(location.get('longitude'))
+        try:
+            location_timestamp = parse_datetime(location_timestamp)
+        except ValueError:
+            return None
+        if latitude is None or longitude is None or location_timestamp is None:
+            return None
+
+        # same as DateTimeField
+        if settings.USE_TZ and timezone.is_naive(location_timestamp):
+            location_timestamp = timezone.make_aware(location_timestamp)
+
+        validated_data['location'] = Point(longitude, latitude, srid=4326)
+        validated_data['location_timestamp'] = location_timestamp
+
+    return validated_data
+
+def update(ambulance, validated_data, user, guard = False):
+    """
+    Update ambulance with a single UPDATE query, publish it and save it
+    to AmbulanceUpdate, the same as Ambulance.save.
+
+    If guard is set, location updates older than the current
+    location_timestamp are not applied and None is returned.
+    """
+
+    # check credentials
+    if not get_write_permissions(user).check_can_write(ambulance=ambulance.id):
+        raise PermissionDenied()
+
+    validated_data['updated_by'] = user
+    validated_data['updated_on'] = timezone.now()
+
+    # targeted update
+    queryset = Ambulance.objects.filter(id=ambulance.id)
+    if guard and 'location_timestamp' in validated_data:
+        queryset = queryset.filter(Q(location_timestamp__isnull=True) |
+                                   Q(location_timestamp__lte=validated_data['location_timestamp']))
+    if not queryset.update(**validated_data):
+        # stale update
+        return None
+
+    # update instance
+    for key, value in validated_data.items():
+        setattr(ambulance, key, value)
+
+    # save to history and publish
+    update = ambulance.save_update()
+    ambulance.publish(update.id)
+    ambulance.reset_changed_fields()
+
+    return ambulance
+
+def bulk_update(items, user, guard = False):
+    """
+    Apply many fast path updates in one transaction with bulk queries.
+
+    items is a list of dicts with the ambulance id and the fast path
+    fields. Permissions are checked once for all items. Returns one
+    result per item, either {'id': id, 'result': 'updated' or 'stale'}
+    or {'id': id, 'error': message}.
+    """
+
+    permissions = get_write_permissions(user)
+
+    # validate items
+    results = [None] * len(items)
+    valid = []
+    for k, item in enumerate(items):
+
+        id = item.get('id') if isinstance(item, dict) else None
+        if isinstance(id, bool) or not isinstance(id, int):
+            results[k] = {'id': id, 'error': 'Invalid ambulance id'}
+            continue
+
+        validated_data = parse({key: value for key, value in item.items() if key != 'id'})
+        if validated_data is None:
+            results[k] = {'id': id, 'error': 'Invalid update, only {} can be updated in bulk'.format(', '.join(sorted(FAST_PATH_FIELDS)))}
+        elif not permissions.check_can_write(ambulance=id):
+            results[k] = {'id': id, 'error': 'Permission denied'}
+        else:
+            valid.append((k, id, validated_data))
+
+    if not valid:
+        return results
+
+    now = timezone.now()
+    with transaction.atomic():
+
+        # lock ambulances being updated
+        ambulances = Ambulance.objects.select_for_update() \
+                                      .in_bulk({id for k, id, validated_data in valid})
+
+        # apply items in order, keeping one history entry per item
+        updated = {}
+        fields = {'updated_by', 'updated_on'}
+        history = []
+        for k, id, validated_data in valid:
+
+            ambulance = ambulances.get(id)
+            if ambulance is None:
+                results[k] = {'id': id, 'error': "Ambulance with id '{}' does not exist".format(id)}
+                continue
+
+            # discard stale location updates
+            location_timestamp = validated_data.get('location_timestamp')
+            if (guard and location_timestamp is not None and
+                ambulance.location_timestamp is not None and
+                location_timestamp < ambulance.location_timestamp):
+                results[k] = {'id': id, 'result': 'stale'}
+                continue
+
+            for key, value in validated_data.items():
+                setattr(ambulance, key, value)
+            ambulance.updated_by = user
+            ambulance.updated_on = now
+            fields.update(validated_data.keys())
+
+            history.append(ambulance.make_update())
+            updated[id] = ambulance
+            results[k] = {'id': id, 'result': 'updated'}
+
+        if updated:
+
+            Ambulance.objects.bulk_update(updated.values(), sorted(fields))
+            history = AmbulanceUpdate.objects.bulk_create(history)
+
+            # publish last state of each ambulance, deferred to commit
+            seq = {update.ambulance_id: update.id for update in history}
+            for ambulance in updated.values():
+                ambulance.publish(seq[ambulance.id])
+                ambulance.reset_changed_fields()
+
+    return results
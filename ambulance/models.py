@@ -48,6 +48,13 @@ class Ambulance(UpdatedByModel):
     location = models.PointField(srid=4326, default = defaults['location'])
     location_timestamp = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # filters of nearest ambulance queries, location has a
+            # spatial index by default
+            models.Index(fields=['status', 'capability'])
+        ]
+
     @classmethod
     def from_db(cls, db, field_names, values):
         # call super
@@ -59,22 +66,56 @@ class Ambulance(UpdatedByModel):
         # return instance
         return instance
     
+    def get_changed_fields(self):
+
+        # fields changed since loaded from the database
+        loaded_values = getattr(self, '_loaded_values', None)
+        if loaded_values is None:
+            return None
+
+        return {field.name for field in self._meta.concrete_fields
+                if (field.attname in loaded_values and
+                    getattr(self, field.attname) != loaded_values[field.attname])}
+
+    def reset_changed_fields(self):
+
+        # current field values are now the ones in the database
+        deferred = self.get_deferred_fields()
+        self._loaded_values = {field.attname: getattr(self, field.attname)
+                               for field in self._meta.concrete_fields
+                               if field.attname not in deferred}
+
     def save(self, *args, **kwargs):
         # save to Ambulance
         super().save(*args, **kwargs)
 
+        # save to AmbulanceUpdate
+        update = self.save_update()
+
         # publish to mqtt
+        self.publish(update.id)
+
+        # later saves only publish what they change
+        self.reset_changed_fields()
+
+    def publish(self, seq = None):
         from mqtt.publish import SingletonPublishClient
-        SingletonPublishClient().publish_ambulance(self)
+        SingletonPublishClient().publish_ambulance(self,
+                                                   changed=self.get_changed_fields(),
+                                                   seq=seq)
 
-        # save to AmbulanceUpdate
+    def make_update(self):
         data = {k: getattr(self, k)
                 for k in ('status', 'orientation',
                           'location', 'location_timestamp',
                           'comment', 'updated_by', 'updated_on')}
         data['ambulance'] = self;
-        obj = AmbulanceUpdate(**data)
+        return AmbulanceUpdate(**data)
+
+    def save_update(self):
+        obj = self.make_update()
         obj.save()
+        return obj
         
     def delete(self, *args, **kwargs):
         from mqtt.publish import SingletonPublishClient
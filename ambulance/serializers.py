@@ -5,6 +5,8 @@ from django.core.exceptions import PermissionDenied
 from rest_framework import serializers
 from drf_extra_fields.geo_fields import PointField
 
+from login.permissions import get_write_permissions
+
 from .models import Ambulance
 
 # Ambulance serializers
@@ -58,8 +60,7 @@ class AmbulanceSerializer(serializers.ModelSerializer):
         if not user.is_superuser:
 
             # serializer.instance will always exist!
-            if not user.profile.ambulances.filter(can_write=True,
-                                                  ambulance=instance.id):
+            if not get_write_permissions(user).check_can_write(ambulance=instance.id):
                 raise PermissionDenied()
 
         return super().update(instance, validated_data)
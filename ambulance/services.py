@@ -0,0 +1,143 @@
+import math
+
+from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.geos import Point, Polygon
+from django.contrib.gis.measure import D
+from django.db.models import FloatField, Func
+
+from .models import Ambulance
+
+# Ambulance services
+
+# Nearest ambulances
+#
+# Candidates are selected by the KNN operator <->, which walks the
+# spatial index on Ambulance.location. Since location is stored in
+# degrees, the KNN ordering is only approximate, so more candidates than
+# requested are retrieved and then sorted by their distance in meters.
+#
+# The planar ordering treats a degree of longitude as long as a degree of
+# latitude, while it is cos(latitude) times shorter, so at higher
+# latitudes an ambulance east or west of the point may be closer than
+# all candidates yet not be one of them. The distance to the limit-th
+# candidate bounds the distance of the true nearest ambulances, so a
+# second query retrieves any other ambulance within that distance, using
+# a bounding box that covers the circle to go through the index.
+
+# candidates retrieved per requested ambulance
+KNN_FACTOR = 4
+
+# less than the radius used by ST_DistanceSphere, so that bounding boxes
+# err on the large side
+EARTH_RADIUS = 6.3e6
+
+class KNNDistance(Func):
+
+    """
+    Index-assisted planar distance between a geometry column and a point.
+    """
+
+    template = '%(expressions)s <-> ST_SetSRID(ST_MakePoint(%(x).17g, %(y).17g), %(srid)d)'
+
+    def __init__(self, expression, point, **extra):
+
+        # interpolated into the SQL, only finite coordinates
+        if not (math.isfinite(point.x) and math.isfinite(point.y)):
+            raise ValueError('Point coordinates must be finite')
+
+        super().__init__(expression,
+                         x=float(point.x), y=float(point.y),
+                         srid=int(point.srid or 4326),
+                         output_field=FloatField(),
+                         **extra)
+
+def bounding_box(point, radius):
+    """
+    Return a box in degrees containing every point within radius meters
+    of point, or None if the circle reaches a pole or the antimeridian.
+    """
+
+    angle = radius / EARTH_RADIUS
+    dlat = math.degrees(angle)
+    if abs(point.y) + dlat >= 90:
+        return None
+
+    # widest longitude of the circle
+    dlon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(point.y))))
+    if point.x - dlon < -180 or point.x + dlon > 180:
+        return None
+
+    return Polygon.from_bbox((point.x - dlon, point.y - dlat,
+                              point.x + dlon, point.y + dlat))
+
+def nearest_ambulances(point, status = None, capability = None, limit = 10,
+                       queryset = None):
+    """
+    Return up to limit ambulances closest to point, ordered by distance,
+    annotated with their distance to point in meters. Only ambulances
+    with one of the given status and capability are returned; queryset
+    can be used to restrict ambulances further, e.g. by permission.
+    """
+
+    if queryset is None:
+        queryset = Ambulance.objects.all()
+
+    if status:
+        queryset = queryset.filter(status__in=status)
+
+    if capability:
+        queryset = queryset.filter(capability__in=capability)
+
+    candidates = list(queryset.annotate(knn=KNNDistance('location', point),
+                                        distance=Distance('location', point))
+                      .order_by('knn')[:limit * KNN_FACTOR])
+
+    # exact ordering in meters
+    candidates.sort(key=lambda ambulance: ambulance.distance.m)
+
+    # fewer candidates than retrieved are all the ambulances
+    if len(candidates) < limit * KNN_FACTOR:
+        return candidates[:limit]
+
+    # ambulances missed by the planar ordering are closer than the
+    # limit-th candidate
+    radius = candidates[limit - 1].distance.m
+    missed = queryset.exclude(id__in=[ambulance.id for ambulance in candidates]) \
+                     .filter(location__distance_lte=(point, D(m=radius)))
+    box = bounding_box(point, radius)
+    if box is not None:
+        missed = missed.filter(location__contained=box)
+    candidates.extend(missed.annotate(distance=Distance('location', point)))
+    candidates.sort(key=lambda ambulance: ambulance.distance.m)
+
+    return candidates[:limit]
+
+def parse_point(latitude, longitude):
+    """
+    Parse latitude and longitude in degrees. Raises ValueError.
+    """
+
+    latitude, longitude = float(latitude), float(longitude)
+
+    if not (math.isfinite(latitude) and -90 <= latitude <= 90):
+        raise ValueError('Latitude must be between -90 and 90.')
+
+    if not (math.isfinite(longitude) and -180 <= longitude <= 180):
+        raise ValueError('Longitude must be between -180 and 180.')
+
+    return Point(longitude, latitude, srid=4326)
+
+def parse_choices(value, enum):
+    """
+    Parse comma-separated names of enum. Raises ValueError.
+    """
+
+    if not value:
+        return None
+
+    names = value.split(',')
+    for name in names:
+        if name not in enum.__members__:
+            raise ValueError("'{}' is not a valid {}".format(name, enum.__name__))
+
+    return names
@@ -0,0 +1,69 @@
+import time
+
+from django.utils import timezone
+
+from ambulance import fastpath
+from ambulance.models import Ambulance, AmbulanceStatus
+from ambulance.serializers import AmbulanceSerializer
+
+from emstrack.tests.util import date2iso
+
+from login.tests.setup_data import TestSetup
+
+# Micro-benchmark of ambulance updates
+#
+# Not collected by the test runner, run with
+#
+#     ./manage.py test ambulance/tests/bench_fastpath.py
+
+class BenchAmbulanceFastPath(TestSetup):
+
+    N = 500
+
+    def payloads(self):
+        statuses = [m.name for m in AmbulanceStatus]
+        for k in range(self.N):
+            yield {'status': statuses[k % len(statuses)],
+                   'orientation': float(k % 360),
+                   'location': {'latitude': 32.5 + k * 1e-5,
+                                'longitude': -117.0 - k * 1e-5},
+                   'location_timestamp': date2iso(timezone.now())}
+
+    def run_serializer(self, ambulance, user):
+        for data in self.payloads():
+            serializer = AmbulanceSerializer(ambulance, data=data, partial=True)
+            serializer.is_valid(raise_exception=True)
+            serializer.save(updated_by=user)
+
+    def run_fastpath(self, ambulance, user):
+        for data in self.payloads():
+            fastpath.update(ambulance, fastpath.parse(data), user)
+
+    def run_validate_serializer(self, ambulance, user):
+        for data in self.payloads():
+            AmbulanceSerializer(ambulance, data=data, partial=True).is_valid()
+
+    def run_validate_fastpath(self, ambulance, user):
+        for data in self.payloads():
+            fastpath.parse(data)
+
+    def test_benchmark(self):
+
+        ambulance = Ambulance.objects.get(id=self.a3.id)
+
+        print('\n>> Ambulance update benchmark ({} updates)'.format(self.N))
+        timings = {}
+        for name in ('validate_serializer', 'validate_fastpath',
+                     'serializer', 'fastpath'):
+            start = time.perf_counter()
+            getattr(self, 'run_' + name)(ambulance, self.u3)
+            elapsed = time.perf_counter() - start
+            timings[name] = elapsed
+            print('   {:20s}: {:8.3f} ms/update, {:8.1f} updates/s'.format(name,
+                                                                          1e3 * elapsed / self.N,
+                                                                          self.N / elapsed))
+
+        print('   validation speedup: {:.1f}x'.format(timings['validate_serializer'] /
+                                                     timings['validate_fastpath']))
+        print('   update speedup: {:.1f}x'.format(timings['serializer'] /
+                                                 timings['fastpath']))
@@ -0,0 +1,71 @@
+import random, time
+
+from django.contrib.gis.geos import Point
+
+from ambulance.models import Ambulance, AmbulanceStatus, AmbulanceCapability
+from ambulance.services import nearest_ambulances
+
+from login.tests.setup_data import TestSetup
+
+# Benchmark of nearest ambulance queries
+#
+# Not collected by the test runner, run with
+#
+#     ./manage.py test ambulance/tests/bench_nearest.py
+
+class BenchAmbulanceNearest(TestSetup):
+
+    N = 10000
+    QUERIES = 200
+    LIMIT = 5
+
+    def setUp(self):
+
+        # ambulances scattered over about 100 km x 100 km,
+        # bulk_create does not publish
+        rng = random.Random(0)
+        statuses = [m.name for m in AmbulanceStatus]
+        capabilities = [m.name for m in AmbulanceCapability]
+        Ambulance.objects.bulk_create(
+            Ambulance(identifier='BENCH-{}'.format(k),
+                      capability=rng.choice(capabilities),
+                      status=rng.choice(statuses),
+                      location=Point(-117.5 + rng.random(),
+                                     32.0 + rng.random(),
+                                     srid=4326),
+                      updated_by=self.u1)
+            for k in range(self.N))
+
+        self.points = [Point(-117.5 + rng.random(), 32.0 + rng.random(), srid=4326)
+                       for k in range(self.QUERIES)]
+
+    def run_client_side(self, point):
+        # what clients do today: fetch everything then sort
+        ambulances = [a for a in Ambulance.objects.all()
+                      if a.status == AmbulanceStatus.AV.name]
+        ambulances.sort(key=lambda a: a.location.distance(point))
+        return ambulances[:self.LIMIT]
+
+    def run_knn(self, point):
+        return nearest_ambulances(point,
+                                  status=[AmbulanceStatus.AV.name],
+                                  limit=self.LIMIT)
+
+    def test_benchmark(self):
+
+        print('\n>> Nearest ambulance benchmark ({} ambulances, {} queries)'.format(self.N,
+                                                                                    self.QUERIES))
+        timings = {}
+        for name in ('client_side', 'knn'):
+            # client side is too slow to run every query
+            points = self.points if name == 'knn' else self.points[:10]
+            start = time.perf_counter()
+            for point in points:
+                getattr(self, 'run_' + name)(point)
+            elapsed = time.perf_counter() - start
+            timings[name] = elapsed / len(points)
+            print('   {:12s}: {:8.3f} ms/query, {:8.1f} queries/s'.format(name,
+                                                                      1e3 * timings[name],
+                                                                      1 / timings[name]))
+
+        print('   speedup: {:.1f}x'.format(timings['client_side'] / timings['knn']))
@@ -17,6 +17,7 @@ from login.models import AmbulancePermission, HospitalPermission
 from ambulance.models import Ambulance, \
     AmbulanceStatus, AmbulanceCapability
 from ambulance.serializers import AmbulanceSerializer
+from ambulance.services import nearest_ambulances, KNN_FACTOR
 
 from hospital.models import Hospital, \
     Equipment, HospitalEquipment, EquipmentType
@@ -177,6 +178,170 @@ class TestAmbulanceGetList(TestSetup):
         # logout
         client.logout()
 
+    def test_ambulance_list_options(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # cursor pagination ordered by updated_on
+        ids = []
+        url = '/api/ambulance/?page_size=2'
+        while url:
+            response = client.get(url, follow=True)
+            self.assertEqual(response.status_code, 200)
+            result = JSONParser().parse(BytesIO(response.content))
+            self.assertLessEqual(len(result['results']), 2)
+            ids += [a['id'] for a in result['results']]
+            url = result['next']
+        self.assertEqual(ids, [a.id for a in Ambulance.objects.order_by('updated_on', 'id')])
+
+        # sparse fieldsets
+        response = client.get('/api/ambulance/', {'fields': 'id,status'}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual(result, [{'id': a.id, 'status': a.status}
+                                       for a in (self.a1, self.a2, self.a3)])
+
+        response = client.get('/api/ambulance/{}/'.format(self.a1.id), {'fields': 'identifier'},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(result, {'identifier': self.a1.identifier})
+
+        response = client.get('/api/ambulance/', {'fields': 'id,secret'}, follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # updated since
+        since = Ambulance.objects.get(id=self.a2.id).updated_on
+        Ambulance.objects.get(id=self.a1.id).save()
+        response = client.get('/api/ambulance/', {'updated_since': since.isoformat()},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([a['id'] for a in result], [self.a1.id, self.a3.id])
+
+        response = client.get('/api/ambulance/', {'updated_since': 'yesterday'}, follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+    def test_ambulance_conditional_get(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser2
+        client.login(username='testuser2', password='very_secret')
+
+        # list
+        response = client.get('/api/ambulance/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        response = client.get('/api/ambulance/', HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 304)
+
+        # lists ignore If-Modified-Since
+        response = client.get('/api/ambulance/',
+                              HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT',
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # other fields, other representation
+        response = client.get('/api/ambulance/', {'fields': 'id'},
+                              HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # detail
+        response = client.get('/api/ambulance/{}/'.format(self.a3.id), follow=True)
+        self.assertEqual(response.status_code, 200)
+        detail_etag = response['ETag']
+
+        response = client.get('/api/ambulance/{}/'.format(self.a3.id),
+                              HTTP_IF_NONE_MATCH=detail_etag, follow=True)
+        self.assertEqual(response.status_code, 304)
+
+        # modified
+        Ambulance.objects.get(id=self.a3.id).save()
+        response = client.get('/api/ambulance/', HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+        response = client.get('/api/ambulance/{}/'.format(self.a3.id),
+                              HTTP_IF_NONE_MATCH=detail_etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # permissions changed
+        etag = client.get('/api/ambulance/', follow=True)['ETag']
+        perm = AmbulancePermission.objects.get(ambulance=self.a1,
+                                               profile__user=self.u3)
+        perm.can_read = True
+        perm.save()
+        response = client.get('/api/ambulance/', HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # other ambulances, same count, sum of ids and latest update
+        a4 = Ambulance.objects.create(id=self.a2.id + self.a3.id - self.a1.id,
+                                      identifier='BC-182',
+                                      capability=AmbulanceCapability.B.name,
+                                      updated_by=self.u1)
+        Ambulance.objects.update(updated_on=timezone.now())
+
+        profile = self.u3.profile
+        profile.ambulances.clear()
+        profile.ambulances.add(*(AmbulancePermission.objects.create(ambulance=ambulance)
+                                 for ambulance in (self.a1, a4)))
+        etag = client.get('/api/ambulance/', follow=True)['ETag']
+
+        profile.ambulances.clear()
+        profile.ambulances.add(*(AmbulancePermission.objects.create(ambulance=ambulance)
+                                 for ambulance in (self.a2, self.a3)))
+        response = client.get('/api/ambulance/', HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([a['id'] for a in result], [self.a2.id, self.a3.id])
+
+        # logout
+        client.logout()
+
+    def test_ambulance_viewset_queries(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser2
+        client.login(username='testuser2', password='very_secret')
+
+        # load permissions
+        response = client.get('/api/ambulance/', follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # session, user, etag aggregate and ambulances, permissions are cached
+        with self.assertNumQueries(4):
+            response = client.get('/api/ambulance/', follow=True)
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(3):
+            response = client.get('/api/ambulance/{}/'.format(str(self.a3.id)),
+                                  follow=True)
+            self.assertEqual(response.status_code, 200)
+
+        # changing permissions invalidates the cache
+        perm = AmbulancePermission.objects.get(ambulance=self.a1,
+                                               profile__user=self.u3)
+        perm.can_read = True
+        perm.save()
+        response = client.get('/api/ambulance/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([a['id'] for a in result], [self.a1.id, self.a3.id])
+
+        # logout
+        client.logout()
+
 class TestAmbulanceUpdate(TestSetup):
     
     def test_ambulance_update_serializer(self):
@@ -615,3 +780,199 @@ class TestAmbulanceCreate(TestSetup):
         
         # logout
         client.logout()
+
+class TestAmbulanceBulk(TestSetup):
+
+    def test_ambulance_bulk_viewset(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser2
+        client.login(username='testuser2', password='very_secret')
+
+        data = [{'id': self.a3.id, 'status': AmbulanceStatus.AV.name},
+                {'id': self.a1.id, 'status': AmbulanceStatus.AV.name}]
+        response = client.post('/api/ambulance/bulk/', json.dumps(data),
+                               content_type='application/json', follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(result, [{'id': self.a3.id, 'result': 'updated'},
+                                  {'id': self.a1.id, 'error': 'Permission denied'}])
+        self.assertEqual(Ambulance.objects.get(id=self.a3.id).status,
+                         AmbulanceStatus.AV.name)
+        self.assertEqual(Ambulance.objects.get(id=self.a1.id).status,
+                         AmbulanceStatus.UK.name)
+
+        # not a list
+        response = client.post('/api/ambulance/bulk/', json.dumps(data[0]),
+                               content_type='application/json', follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # anonymous
+        response = client.post('/api/ambulance/bulk/', json.dumps(data),
+                               content_type='application/json', follow=True)
+        self.assertEqual(response.status_code, 403)
+
+class TestAmbulanceNearest(TestSetup):
+
+    def setUp(self):
+
+        # place ambulances 1 km, 2 km and 3 km north of the call
+        self.point = Point(-117.0382, 32.5149, srid=4326)
+        for k, ambulance in enumerate((self.a1, self.a2, self.a3)):
+            Ambulance.objects.filter(id=ambulance.id) \
+                             .update(location=Point(-117.0382, 32.5149 + (k + 1) * 0.009, srid=4326),
+                                     status=AmbulanceStatus.AV.name)
+
+    def get(self, client, **params):
+        params.setdefault('latitude', self.point.y)
+        params.setdefault('longitude', self.point.x)
+        response = client.get('/api/ambulance/nearest/', params, follow=True)
+        return response, JSONParser().parse(BytesIO(response.content))
+
+    def test_nearest_service(self):
+
+        ambulances = nearest_ambulances(self.point, limit=2)
+        self.assertEqual([a.id for a in ambulances], [self.a1.id, self.a2.id])
+        self.assertAlmostEqual(ambulances[0].distance.m, 1000, delta=10)
+
+        ambulances = nearest_ambulances(self.point,
+                                        capability=[AmbulanceCapability.R.name])
+        self.assertEqual([a.id for a in ambulances], [self.a3.id])
+
+        Ambulance.objects.filter(id=self.a1.id).update(status=AmbulanceStatus.OS.name)
+        ambulances = nearest_ambulances(self.point,
+                                        status=[AmbulanceStatus.AV.name])
+        self.assertEqual([a.id for a in ambulances], [self.a2.id, self.a3.id])
+
+    def test_nearest_high_latitude(self):
+
+        # at 70 degrees a degree of longitude is about 38 km
+        point = Point(20., 70., srid=4326)
+
+        # 11 km east, 0.3 degrees away
+        east = Ambulance.objects.create(identifier='EAST',
+                                        capability=AmbulanceCapability.B.name,
+                                        location=Point(20.3, 70., srid=4326),
+                                        updated_by=self.u1)
+
+        # 12 km and more north, less than 0.3 degrees away, outrank it
+        north = [Ambulance.objects.create(identifier='NORTH-{}'.format(k),
+                                          capability=AmbulanceCapability.B.name,
+                                          location=Point(20., 70.11 + k * 0.01, srid=4326),
+                                          updated_by=self.u1)
+                 for k in range(KNN_FACTOR + 1)]
+
+        queryset = Ambulance.objects.filter(id__in=[east.id] + [a.id for a in north])
+        ambulances = nearest_ambulances(point, limit=1, queryset=queryset)
+        self.assertEqual([a.id for a in ambulances], [east.id])
+        self.assertAlmostEqual(ambulances[0].distance.m, 11400, delta=200)
+
+        ambulances = nearest_ambulances(point, limit=2, queryset=queryset)
+        self.assertEqual([a.id for a in ambulances], [east.id, north[0].id])
+
+    def test_nearest_viewset(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response, result = self.get(client, status='AV', limit=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([a['id'] for a in result], [self.a1.id, self.a2.id])
+        self.assertAlmostEqual(result[0]['distance'], 1000, delta=10)
+        self.assertAlmostEqual(result[1]['distance'], 2000, delta=20)
+
+        # invalid parameters
+        response, result = self.get(client, status='XX')
+        self.assertEqual(response.status_code, 400)
+        response, result = self.get(client, latitude='north')
+        self.assertEqual(response.status_code, 400)
+        for latitude, longitude in (('nan', 0), (0, 'inf'), (91, 0), (0, -181)):
+            response, result = self.get(client, latitude=latitude, longitude=longitude)
+            self.assertEqual(response.status_code, 400)
+        response = client.get('/api/ambulance/nearest/', follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, can only read a3
+        client.login(username='testuser2', password='very_secret')
+
+        response, result = self.get(client)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([a['id'] for a in result], [self.a3.id])
+
+        # logout
+        client.logout()
+
+class TestAmbulanceViewport(TestSetup):
+
+    def setUp(self):
+
+        # a1 and a2 in Tijuana, a3 in Ensenada
+        for ambulance, location in ((self.a1, Point(-117.03, 32.51, srid=4326)),
+                                    (self.a2, Point(-117.02, 32.52, srid=4326)),
+                                    (self.a3, Point(-116.60, 31.86, srid=4326))):
+            Ambulance.objects.filter(id=ambulance.id).update(location=location)
+
+    def test_ambulance_viewport(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # list filtered by bbox
+        response = client.get('/api/ambulance/', {'bbox': '-117.1,32.4,-116.9,32.6'},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([a['id'] for a in result], [self.a1.id, self.a2.id])
+
+        # compact rows
+        response = client.get('/api/ambulance/viewport/', {'bbox': '-117.1,32.4,-116.9,32.6',
+                                                           'zoom': 14},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(result['fields'], ['id', 'identifier', 'status', 'capability',
+                                            'orientation', 'longitude', 'latitude'])
+        self.assertCountEqual([row[0] for row in result['rows']], [self.a1.id, self.a2.id])
+
+        # clusters
+        response = client.get('/api/ambulance/viewport/', {'bbox': '-118,31,-116,33',
+                                                           'zoom': 6},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([cluster[2] for cluster in result['clusters']], [2, 1])
+
+        # invalid parameters
+        response = client.get('/api/ambulance/', {'bbox': '-116,32,-117,33'}, follow=True)
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/api/ambulance/viewport/', {'zoom': 'far'}, follow=True)
+        self.assertEqual(response.status_code, 400)
+
+        # logout
+        client.logout()
+
+        # login as testuser2, can only read a3
+        client.login(username='testuser2', password='very_secret')
+
+        response = client.get('/api/ambulance/viewport/', {'bbox': '-118,31,-116,33'},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual([row[0] for row in result['rows']], [self.a3.id])
+
+        # logout
+        client.logout()
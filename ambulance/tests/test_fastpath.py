@@ -0,0 +1,140 @@
+from datetime import timedelta
+
+from django.core.exceptions import PermissionDenied
+from django.utils import timezone
+
+from ambulance import fastpath
+from ambulance.models import Ambulance, AmbulanceUpdate, AmbulanceStatus
+from ambulance.serializers import AmbulanceSerializer
+
+from emstrack.tests.util import date2iso, point2str
+
+from login.tests.setup_data import TestSetup
+
+class TestAmbulanceFastPath(TestSetup):
+
+    def test_parse(self):
+
+        location = {'latitude': -2., 'longitude': 7.}
+        location_timestamp = date2iso(timezone.now())
+
+        # payloads that take the fast path
+        for data in ({'status': AmbulanceStatus.AH.name},
+                     {'orientation': 12},
+                     {'location': location,
+                      'location_timestamp': location_timestamp},
+                     {'status': AmbulanceStatus.AV.name,
+                      'orientation': 12.5,
+                      'location': location,
+                      'location_timestamp': location_timestamp}):
+            self.assertIsNotNone(fastpath.parse(data))
+            serializer = AmbulanceSerializer(self.a1, data=data, partial=True)
+            self.assertTrue(serializer.is_valid())
+
+        # payloads that fall back to the serializer
+        for data in ({},
+                     {'status': 'Invalid'},
+                     {'comment': 'other fields'},
+                     {'status': AmbulanceStatus.AH.name,
+                      'identifier': 'BC-000'},
+                     {'orientation': True},
+                     {'orientation': '12'},
+                     {'location': location},
+                     {'location_timestamp': location_timestamp},
+                     {'location': None,
+                      'location_timestamp': location_timestamp},
+                     {'location': location,
+                      'location_timestamp': 'yesterday'},
+                     {'location': {'latitude': 'a', 'longitude': 7.},
+                      'location_timestamp': location_timestamp}):
+            self.assertIsNone(fastpath.parse(data))
+
+    def test_update(self):
+
+        location = {'latitude': -2., 'longitude': 7.}
+        location_timestamp = timezone.now()
+        data = {'status': AmbulanceStatus.AH.name,
+                'orientation': 12.5,
+                'location': location,
+                'location_timestamp': date2iso(location_timestamp)}
+
+        # authorized user
+        count = AmbulanceUpdate.objects.filter(ambulance=self.a3).count()
+        a = Ambulance.objects.get(id=self.a3.id)
+        fastpath.update(a, fastpath.parse(data), self.u3)
+
+        a = Ambulance.objects.get(id=self.a3.id)
+        result = {
+            'id': a.id,
+            'identifier': a.identifier,
+            'comment': a.comment,
+            'capability': a.capability,
+            'status': AmbulanceStatus.AH.name,
+            'orientation': 12.5,
+            'location': point2str(location),
+            'location_timestamp': date2iso(location_timestamp),
+            'updated_by': self.u3.id,
+            'updated_on': date2iso(a.updated_on)
+        }
+        self.assertDictEqual(AmbulanceSerializer(a).data, result)
+        self.assertEqual(AmbulanceUpdate.objects.filter(ambulance=self.a3).count(),
+                         count + 1)
+
+        # unauthorized user
+        a = Ambulance.objects.get(id=self.a1.id)
+        with self.assertRaises(PermissionDenied):
+            fastpath.update(a, fastpath.parse(data), self.u3)
+        a = Ambulance.objects.get(id=self.a1.id)
+        self.assertEqual(a.status, AmbulanceStatus.UK.name)
+
+    def test_bulk_update(self):
+
+        location_timestamp = timezone.now()
+        items = [
+            # authorized
+            {'id': self.a3.id,
+             'status': AmbulanceStatus.AV.name},
+            {'id': self.a3.id,
+             'location': {'latitude': -2., 'longitude': 7.},
+             'location_timestamp': date2iso(location_timestamp)},
+            # unauthorized
+            {'id': self.a1.id,
+             'status': AmbulanceStatus.AV.name},
+            # not a fast path update
+            {'id': self.a3.id,
+             'identifier': 'BC-000'},
+            # no id
+            {'status': AmbulanceStatus.AV.name}
+        ]
+
+        count = AmbulanceUpdate.objects.filter(ambulance=self.a3).count()
+        results = fastpath.bulk_update(items, self.u3)
+        self.assertEqual(results[0], {'id': self.a3.id, 'result': 'updated'})
+        self.assertEqual(results[1], {'id': self.a3.id, 'result': 'updated'})
+        self.assertEqual(results[2], {'id': self.a1.id, 'error': 'Permission denied'})
+        self.assertIn('error', results[3])
+        self.assertIn('error', results[4])
+
+        # both updates applied, one history entry per update
+        a = Ambulance.objects.get(id=self.a3.id)
+        self.assertEqual(a.status, AmbulanceStatus.AV.name)
+        self.assertEqual(a.location_timestamp, location_timestamp)
+        self.assertEqual(a.updated_by, self.u3)
+        self.assertEqual(AmbulanceUpdate.objects.filter(ambulance=self.a3).count(),
+                         count + 2)
+
+        a = Ambulance.objects.get(id=self.a1.id)
+        self.assertEqual(a.status, AmbulanceStatus.UK.name)
+
+        # stale and missing ambulances
+        results = fastpath.bulk_update([
+            {'id': self.a3.id,
+             'location': {'latitude': -3., 'longitude': 7.},
+             'location_timestamp': date2iso(location_timestamp - timedelta(seconds=1))},
+            {'id': 100000,
+             'status': AmbulanceStatus.AV.name}
+        ], self.u1, guard=True)
+        self.assertEqual(results[0], {'id': self.a3.id, 'result': 'stale'})
+        self.assertIn('error', results[1])
+        a = Ambulance.objects.get(id=self.a3.id)
+        self.assertEqual(a.location.y, -2.)
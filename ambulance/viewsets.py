@@ -2,25 +2,36 @@ from django.core.exceptions import PermissionDenied
 from django.shortcuts import get_object_or_404
 
 from rest_framework import viewsets, mixins, generics, filters, permissions
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
-from emstrack.mixins import BasePermissionMixin, \
+from emstrack.mixins import BasePermissionMixin, ViewportMixin, \
+    SparseFieldsMixin, UpdatedSinceMixin, ConditionalGetMixin, \
     CreateModelUpdateByMixin, UpdateModelUpdateByMixin
+from emstrack.pagination import UpdatedOnCursorPagination
 
-from .models import Ambulance
+from .models import Ambulance, AmbulanceStatus, AmbulanceCapability
 
 from .serializers import AmbulanceSerializer
 
+from .services import nearest_ambulances, parse_choices, parse_point
+
+from . import fastpath
+
 # Django REST Framework Viewsets
 
 # Ambulance viewset
 
-class AmbulanceViewSet(mixins.ListModelMixin,
+class AmbulanceViewSet(ConditionalGetMixin,
+                       mixins.ListModelMixin,
                        mixins.RetrieveModelMixin,
                        CreateModelUpdateByMixin,
                        UpdateModelUpdateByMixin,
+                       SparseFieldsMixin,
+                       UpdatedSinceMixin,
+                       ViewportMixin,
                        BasePermissionMixin,
                        viewsets.GenericViewSet):
 
@@ -41,12 +52,78 @@ class AmbulanceViewSet(mixins.ListModelMixin,
 
     partial_update:
     Partially update existing ambulance instance.
+
+    viewport:
+    Retrieve ambulances in bounding box as compact rows or clusters.
+
+    bulk:
+    Update many ambulances at once.
     """
 
     filter_field = 'id'
     profile_field = 'ambulances'
     profile_values = 'ambulance_id'
+    viewport_fields = ('id', 'identifier', 'status', 'capability', 'orientation')
     queryset = Ambulance.objects.all()
     
     serializer_class = AmbulanceSerializer
+    pagination_class = UpdatedOnCursorPagination
+
+    # maximum number of updates per bulk request
+    bulk_max_size = 1000
+
+    @list_route()
+    def nearest(self, request, **kwargs):
+        """
+        Retrieve ambulances closest to a point.
+
+        Query parameters are latitude, longitude, status and capability,
+        as comma-separated names, and limit. Distances are in meters.
+        """
+
+        params = request.query_params
+        try:
+            point = parse_point(params['latitude'], params['longitude'])
+            status = parse_choices(params.get('status'), AmbulanceStatus)
+            capability = parse_choices(params.get('capability'), AmbulanceCapability)
+            limit = int(params.get('limit', 10))
+        except KeyError as e:
+            raise ValidationError({str(e.args[0]): 'This parameter is required.'})
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+        if not 0 < limit <= 100:
+            raise ValidationError({'limit': 'Must be between 1 and 100.'})
+
+        # only ambulances the user can read
+        ambulances = nearest_ambulances(point,
+                                        status=status,
+                                        capability=capability,
+                                        limit=limit,
+                                        queryset=self.get_queryset())
+
+        data = []
+        for ambulance in ambulances:
+            entry = AmbulanceSerializer(ambulance).data
+            entry['distance'] = ambulance.distance.m
+            data.append(entry)
+
+        return Response(data)
+
+    @list_route(methods=['post'], permission_classes=[IsAuthenticated])
+    def bulk(self, request, **kwargs):
+        """
+        Update status, location and orientation of many ambulances at once.
+
+        Expects a list of updates, each with the ambulance id. Returns
+        one result per update.
+        """
+
+        data = request.data
+        if not isinstance(data, list):
+            raise ValidationError('Expected a list of updates.')
+
+        if len(data) > self.bulk_max_size:
+            raise ValidationError('At most {} updates are allowed.'.format(self.bulk_max_size))
 
+        return Response(fastpath.bulk_update(data, request.user))
@@ -0,0 +1,95 @@
+import threading, time
+from collections import OrderedDict
+
+# TTLCache
+
+class TTLCache():
+
+    """
+    Thread-safe in-process cache with time-to-live and LRU eviction.
+    """
+
+    def __init__(self, maxsize = 1024, ttl = 60):
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+
+        # incremented on every invalidation
+        self.generation = 0
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default = None):
+
+        with self.lock:
+
+            try:
+                value, expires = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # expired?
+            if expires < time.monotonic():
+                del self.data[key]
+                self.misses += 1
+                return default
+
+            # mark as recently used
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation = None):
+
+        with self.lock:
+
+            # skip if invalidated while value was being computed
+            if generation is not None and generation != self.generation:
+                return
+
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+
+            # evict least recently used
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, func):
+
+        value = self.get(key, self)
+        if value is self:
+            generation = self.generation
+            value = func()
+            self.set(key, value, generation)
+        return value
+
+    def delete(self, key):
+        with self.lock:
+            self.generation += 1
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / total if total else 0.0
+        }
@@ -0,0 +1,77 @@
+import calendar, hashlib
+
+from django.db.models import Aggregate, CharField, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+# Conditional GET
+#
+# Validators are computed before serializing so that requests carrying
+# If-None-Match or If-Modified-Since can be answered with 304 Not Modified
+# without serializing. For querysets of models with updated_on, the ETag
+# is derived from a digest of the sorted ids of the objects, and of any
+# other fields given, and the latest updated_on, which takes a single
+# aggregate query. The digest changes whenever the set of objects does,
+# e.g. when permissions change, which counts and sums of ids would not
+# always show. Fields of related objects that are serialized but do not
+# change updated_on, such as names, must be given to be digested. Lists
+# get no Last-Modified: deleting an object, or losing permission to read
+# it, changes the list without moving the latest updated_on. Other
+# responses are hashed after rendering, which still saves the transfer.
+
+class Digest(Aggregate):
+
+    """
+    md5 of the values of expressions of all rows, independent of their order.
+    Expressions must be columns, which take no parameters.
+    """
+
+    template = "md5(string_agg(concat_ws(',', %(expressions)s), ';' ORDER BY concat_ws(',', %(expressions)s)))"
+    output_field = CharField()
+
+def make_etag(*values):
+    return '"{}"'.format(hashlib.sha1(repr(values).encode()).hexdigest())
+
+def get_timestamp(value):
+    return calendar.timegm(value.utctimetuple()) if value is not None else None
+
+def queryset_etag(queryset, *key, fields = ()):
+    """
+    Return ETag of queryset. fields are digested with the ids.
+    """
+
+    values = queryset.order_by().aggregate(digest=Digest('id', *fields),
+                                           last_modified=Max('updated_on'))
+
+    last_modified = values['last_modified']
+    return make_etag(key, values['digest'],
+                     last_modified.isoformat() if last_modified is not None else None)
+
+def not_modified(request, etag, last_modified = None):
+    """
+    Return 304 response if validators match, None otherwise.
+    """
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+def set_validators(response, etag, last_modified = None):
+    if response.status_code in (200, 304):
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+    return response
+
+def conditional_response(request, data):
+    """
+    Response with data and an ETag computed from its content.
+    """
+
+    etag = make_etag(hashlib.sha1(JSONRenderer().render(data)).hexdigest())
+
+    response = not_modified(request, etag)
+    if response is None:
+        response = Response(data)
+
+    return set_validators(response, etag)
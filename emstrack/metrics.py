@@ -0,0 +1,82 @@
+import threading, time, bisect
+from contextlib import contextmanager
+
+# Histogram
+
+# upper bounds in seconds, from 100us to 1s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0)
+
+class Histogram():
+
+    """
+    Thread-safe histogram of values in buckets with fixed upper bounds.
+    """
+
+    def __init__(self, buckets = LATENCY_BUCKETS):
+
+        self.buckets = tuple(sorted(buckets))
+
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # last bucket holds values above all bounds
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.max = 0.0
+
+    def observe(self, value):
+
+        k = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[k] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q-th percentile.
+        """
+
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+
+            rank = q / 100 * self.count
+            total = 0
+            for bound, count in zip(self.buckets, self.counts):
+                total += count
+                if total >= rank:
+                    return bound
+            return self.max
+
+    def stats(self):
+        stats = {
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99)
+        }
+        with self.lock:
+            stats.update({
+                'count': self.count,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'max': self.max,
+                # None bounds the last bucket, so that stats serialize to JSON
+                'buckets': list(zip(self.buckets + (None,), self.counts))
+            })
+        return stats
@@ -1,4 +1,19 @@
+from django.contrib.gis.db.models import Collect
+from django.contrib.gis.db.models.functions import Centroid, SnapToGrid
+from django.contrib.gis.geos import Polygon
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count
+from django.utils.dateparse import parse_datetime
+
 from rest_framework import mixins
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+from login.permissions import get_permissions
+
+from .conditional import make_etag, get_timestamp, queryset_etag, \
+    not_modified, set_validators
 
 # CreateModelUpdateByMixin
 
@@ -27,9 +42,6 @@ class BasePermissionMixin:
     
     def get_queryset(self):
 
-        #print('@get_queryset {}({})'.format(self.request.user,
-        #                                    self.request.method))
-        
         # return all objects if superuser
         user = self.request.user
         if user.is_superuser:
@@ -39,30 +51,276 @@ class BasePermissionMixin:
         if user.is_anonymous:
             raise PermissionDenied()
 
-        # print('> METHOD = {}'.format(self.request.method))
+        # cached ids of objects the user has permissions to,
+        # shared with serializers and MQTT ACLs
+        permissions = get_permissions(user)
+
         # otherwise only return objects that the user can read or write to
         if self.request.method == 'GET':
             # objects that the user can read
-            can_do = getattr(user.profile,
-                             self.profile_field).filter(can_read=True).values(self.profile_values)
+            can_do = permissions.can_read[self.profile_field]
 
         elif (self.request.method == 'PUT' or
               self.request.method == 'PATCH' or
               self.request.method == 'DELETE'):
             # objects that the user can write to
-            can_do = getattr(user.profile,
-                             self.profile_field).filter(can_write=True).values(self.profile_values)
+            can_do = permissions.can_write[self.profile_field]
             
         else:
             raise PermissionDenied()
 
-        #print('> user = {}, can_do = {}'.format(user, can_do))
-        #print('> objects = {}'.format(Object.objects.all()))
-        #print('> filtered objects = {}'.format(Object.objects.filter(id__in=can_do)))
-        # add filter
+        # add filter, a list of ids instead of a subquery
         filter = {}
-        filter[self.filter_field + '__in'] = can_do
+        filter[self.filter_field + '__in'] = sorted(can_do)
 
         # retrieve query
         return super().get_queryset().filter(**filter)
-        
+
+# ViewportMixin
+
+class ViewportMixin:
+
+    """
+    Restrict viewsets to a bounding box and add a viewport route
+    returning a compact payload for maps.
+
+    Lists accept ?bbox=min_longitude,min_latitude,max_longitude,max_latitude.
+    The viewport route accepts the same bbox and a zoom level; below
+    cluster_zoom objects are aggregated in cluster_cells x cluster_cells
+    cells per map tile.
+    """
+
+    location_field = 'location'
+    viewport_fields = ('id',)
+    cluster_zoom = 12
+    cluster_cells = 8
+
+    def get_bbox(self):
+
+        bbox = self.request.query_params.get('bbox')
+        if bbox is None:
+            return None
+
+        try:
+            bbox = tuple(float(value) for value in bbox.split(','))
+        except ValueError:
+            bbox = ()
+
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValidationError({'bbox': 'Must be min_longitude,min_latitude,max_longitude,max_latitude.'})
+
+        return Polygon.from_bbox(bbox)
+
+    def get_queryset(self):
+
+        queryset = super().get_queryset()
+
+        # bounding box operator, uses the spatial index
+        bbox = self.get_bbox()
+        if bbox is not None:
+            filter = {}
+            filter[self.location_field + '__contained'] = bbox
+            queryset = queryset.filter(**filter)
+
+        return queryset
+
+    def get_zoom(self):
+
+        zoom = self.request.query_params.get('zoom')
+        if zoom is None:
+            return None
+
+        try:
+            zoom = int(zoom)
+        except ValueError:
+            zoom = -1
+
+        if not 0 <= zoom <= 22:
+            raise ValidationError({'zoom': 'Must be an integer between 0 and 22.'})
+
+        return zoom
+
+    @list_route()
+    def viewport(self, request, **kwargs):
+        """
+        Retrieve objects in viewport as rows or clusters.
+        """
+
+        queryset = self.get_queryset()
+        zoom = self.get_zoom()
+
+        if zoom is not None and zoom < self.cluster_zoom:
+
+            # cell size in degrees
+            size = 360 / 2 ** zoom / self.cluster_cells
+
+            clusters = queryset.annotate(cell=SnapToGrid(self.location_field, size)) \
+                               .values('cell') \
+                               .annotate(center=Centroid(Collect(self.location_field)),
+                                         count=Count('id')) \
+                               .order_by()
+
+            return Response({
+                'zoom': zoom,
+                'fields': ['longitude', 'latitude', 'count'],
+                'clusters': [[cluster['center'].x, cluster['center'].y, cluster['count']]
+                             for cluster in clusters]
+            })
+
+        # one row per object
+        fields = self.viewport_fields
+        rows = []
+        for values in queryset.values_list(self.location_field, *fields):
+            location = values[0]
+            rows.append(list(values[1:]) + [location.x, location.y])
+
+        return Response({
+            'zoom': zoom,
+            'fields': list(fields) + ['longitude', 'latitude'],
+            'rows': rows
+        })
+
+# UpdatedSinceMixin
+
+class UpdatedSinceMixin:
+
+    """
+    Restrict lists to objects updated after ?updated_since=<iso datetime>.
+    """
+
+    def filter_queryset(self, queryset):
+
+        queryset = super().filter_queryset(queryset)
+
+        updated_since = self.request.query_params.get('updated_since')
+        if updated_since is not None and self.action == 'list':
+
+            try:
+                value = parse_datetime(updated_since)
+            except ValueError:
+                value = None
+
+            if value is None:
+                raise ValidationError({'updated_since': 'Must be an ISO 8601 datetime.'})
+
+            queryset = queryset.filter(updated_on__gt=value)
+
+        return queryset
+
+# SparseFieldsMixin
+
+class SparseFieldsMixin:
+
+    """
+    Restrict GET responses to ?fields=name,name and only load the
+    columns needed by those fields.
+    """
+
+    def get_sparse_fields(self):
+
+        if self.request.method != 'GET':
+            return None
+
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return None
+
+        fields = fields.split(',')
+
+        # validate against serializer
+        serializer = self.get_serializer_class()(context=self.get_serializer_context())
+        unknown = [name for name in fields if name not in serializer.fields]
+        if unknown:
+            raise ValidationError({'fields': 'Unknown fields: {}.'.format(', '.join(unknown))})
+
+        return {name: serializer.fields[name] for name in fields}
+
+    def get_serializer(self, *args, **kwargs):
+
+        serializer = super().get_serializer(*args, **kwargs)
+
+        fields = self.get_sparse_fields()
+        if fields is not None:
+
+            # list serializers wrap a child serializer
+            child = getattr(serializer, 'child', serializer)
+            for name in set(child.fields.keys()) - set(fields.keys()):
+                child.fields.pop(name)
+
+        return serializer
+
+    def filter_queryset(self, queryset):
+
+        queryset = super().filter_queryset(queryset)
+
+        fields = self.get_sparse_fields()
+        if fields is not None:
+
+            # model fields by name and attname, e.g. hospital and hospital_id
+            model_fields = {}
+            for field in queryset.model._meta.concrete_fields:
+                model_fields[field.name] = field.name
+                model_fields[field.attname] = field.name
+
+            # columns read by the serializer fields
+            columns = set()
+            for field in fields.values():
+                source = field.source.split('.')[0]
+                if source in model_fields:
+                    columns.add(model_fields[source])
+
+            # cursor pagination reads updated_on
+            if 'updated_on' in model_fields:
+                columns.add('updated_on')
+
+            queryset = queryset.only(*columns)
+
+        return queryset
+
+# ConditionalGetMixin
+
+class ConditionalGetMixin:
+
+    """
+    Answer list and retrieve with 304 Not Modified, without serializing,
+    if objects have not changed since the request's ETag, or, for
+    retrieve only, Last-Modified.
+    """
+
+    # serialized fields of related objects
+    etag_fields = ()
+
+    def list(self, request, *args, **kwargs):
+
+        queryset = self.filter_queryset(self.get_queryset())
+
+        # query string selects pages and fields
+        etag = queryset_etag(queryset, request.get_full_path(),
+                             fields=self.etag_fields)
+
+        response = not_modified(request, etag)
+        if response is None:
+
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                serializer = self.get_serializer(page, many=True)
+                response = self.get_paginated_response(serializer.data)
+            else:
+                serializer = self.get_serializer(queryset, many=True)
+                response = Response(serializer.data)
+
+        return set_validators(response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+
+        instance = self.get_object()
+
+        etag = make_etag(request.get_full_path(), instance.pk, instance.updated_on.isoformat())
+        last_modified = get_timestamp(instance.updated_on)
+
+        response = not_modified(request, etag, last_modified)
+        if response is None:
+            serializer = self.get_serializer(instance)
+            response = Response(serializer.data)
+
+        return set_validators(response, etag, last_modified)
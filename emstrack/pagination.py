@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+# UpdatedOnCursorPagination
+
+class UpdatedOnCursorPagination(CursorPagination):
+
+    """
+    Keyset pagination ordered by updated_on and id.
+
+    Opt-in: lists are only paginated if ?page_size= is given so that
+    existing clients keep receiving plain lists.
+    """
+
+    ordering = ('updated_on', 'id')
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
@@ -22,7 +22,7 @@ from rest_framework import routers
 from rest_framework_swagger.views import get_swagger_view
 
 from login.viewsets import ProfileViewSet
-from login.views import PasswordView, SettingsView
+from login.views import PasswordView, SettingsView, BootstrapView, StatsView
 
 from ambulance.viewsets import AmbulanceViewSet
 
@@ -63,10 +63,20 @@ urlpatterns = [
         PasswordView.as_view(),
         name='mqtt_password'),
 
+    # Add bootstrap snapshot to api
+    url(r'^api/user/(?P<user__username>[\w.@+-]+)/bootstrap/$',
+        BootstrapView.as_view(),
+        name='bootstrap'),
+
     # Add mqtt_settings to api
     url(r'^api/settings/$',
         SettingsView.as_view(),
         name='mqtt_settings'),
+
+    # Add cache and acl statistics to api
+    url(r'^api/stats/$',
+        StatsView.as_view(),
+        name='stats'),
     
     # ambulance
     url(r'^ambulance/', include('ambulance.urls')),
@@ -5,6 +5,8 @@ from django.core.exceptions import PermissionDenied
 from rest_framework import serializers
 from drf_extra_fields.geo_fields import PointField
 
+from login.permissions import get_write_permissions
+
 from .models import Hospital, Equipment, HospitalEquipment
 
 # Hospital serializers
@@ -43,8 +45,7 @@ class HospitalSerializer(serializers.ModelSerializer):
         if not user.is_superuser:
             
             # serializer.instance will always exist!
-            if not user.profile.hospitals.filter(can_write=True,
-                                                 hospital=instance.id):
+            if not get_write_permissions(user).check_can_write(hospital=instance.id):
                 raise PermissionDenied()
 
         return super().update(instance, validated_data)
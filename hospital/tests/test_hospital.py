@@ -189,6 +189,70 @@ class TestHospitalGetList(TestSetup):
         # logout
         client.logout()
 
+    def test_hospital_viewset_queries(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser1
+        client.login(username='testuser1', password='top_secret')
+
+        # load permissions
+        response = client.get('/api/hospital/', follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # session, user, etag aggregate and hospitals, permissions are cached
+        with self.assertNumQueries(4):
+            response = client.get('/api/hospital/', follow=True)
+            self.assertEqual(response.status_code, 200)
+
+        with self.assertNumQueries(3):
+            response = client.get('/api/hospital/{}/'.format(str(self.h1.id)),
+                                  follow=True)
+            self.assertEqual(response.status_code, 200)
+
+        # no permission to write
+        response = client.patch('/api/hospital/{}/'.format(str(self.h1.id)),
+                                content_type='application/json',
+                                data=json.dumps({'comment': 'no way'}))
+        self.assertEqual(response.status_code, 404)
+
+        # logout
+        client.logout()
+
+    def test_hospital_viewport(self):
+
+        # move h3 out of Tijuana
+        Hospital.objects.filter(id=self.h3.id).update(location=Point(-116.60, 31.86, srid=4326))
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser1, can read h1 and h2
+        client.login(username='testuser1', password='top_secret')
+
+        response = client.get('/api/hospital/viewport/', {'bbox': '-118,31,-116,33'},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(result['fields'], ['id', 'name', 'longitude', 'latitude'])
+        self.assertCountEqual([row[0] for row in result['rows']], [self.h1.id, self.h2.id])
+
+        # logout
+        client.logout()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        response = client.get('/api/hospital/viewport/', {'bbox': '-117.1,32.4,-116.9,32.6'},
+                              follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual([row[0] for row in result['rows']], [self.h1.id, self.h2.id])
+
+        # logout
+        client.logout()
+
 class TestHospitalUpdate(TestSetup):
     
     def test_hospital_update_serializer(self):
@@ -645,6 +709,33 @@ class TestHospitalEquipmentGetList(TestSetup):
         # logout
         client.logout()
 
+    def test_hospital_equipment_list_options(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        # sparse fieldsets
+        response = client.get('/api/hospital/{}/equipment/'.format(self.h1.id),
+                              {'fields': 'equipment_name,value'}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertCountEqual(result, [{'equipment_name': self.e1.name, 'value': 'True'},
+                                       {'equipment_name': self.e2.name, 'value': '45'}])
+
+        # cursor pagination
+        response = client.get('/api/hospital/{}/equipment/'.format(self.h1.id),
+                              {'page_size': 1}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(len(result['results']), 1)
+        self.assertIsNotNone(result['next'])
+
+        # logout
+        client.logout()
+
     def test_hospital_equipment_list_viewset(self):
 
         # instantiate client
@@ -749,6 +840,32 @@ class TestHospitalEquipmentGetList(TestSetup):
         # logout
         client.logout()
 
+    def test_hospital_equipment_conditional_get(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as admin
+        client.login(username=settings.MQTT['USERNAME'], password=settings.MQTT['PASSWORD'])
+
+        url = '/api/hospital/{}/equipment/'.format(self.h1.id)
+        etag = client.get(url, follow=True)['ETag']
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 304)
+
+        # names of equipment and hospital are serialized
+        Equipment.objects.filter(id=self.e1.id).update(name='renamed')
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        Hospital.objects.filter(id=self.h1.id).update(name='renamed')
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # logout
+        client.logout()
+
 
 class TestHospitalEquipmentUpdate(TestSetup):
 
@@ -1,3 +1,4 @@
+from django.db import transaction
 from django.http import HttpResponseRedirect
 
 from django.contrib import messages
@@ -29,8 +30,12 @@ class HospitalActionMixin:
     def success_message(self):
         return NotImplemented
 
+    @transaction.atomic
     def forms_valid(self, form, inlines):
 
+        # save hospital and equipment in one transaction so that
+        # mqtt updates are only published once, on commit
+
         # add message
         messages.info(self.request, self.success_message)
 
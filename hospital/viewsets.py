@@ -1,13 +1,18 @@
 from django.core.exceptions import PermissionDenied
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 
 from rest_framework import viewsets, mixins, generics, filters, permissions
 from rest_framework.decorators import detail_route
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.response import Response
 
-from emstrack.mixins import BasePermissionMixin, \
+from emstrack.mixins import BasePermissionMixin, ViewportMixin, \
+    SparseFieldsMixin, UpdatedSinceMixin, ConditionalGetMixin, \
     CreateModelUpdateByMixin, UpdateModelUpdateByMixin
+from emstrack.conditional import conditional_response
+from emstrack.pagination import UpdatedOnCursorPagination
+
+from login.permissions import get_permissions, get_write_permissions
 
 from .models import Hospital, HospitalEquipment, Equipment
 
@@ -18,10 +23,14 @@ from .serializers import HospitalSerializer, \
     
 # Hospital viewset
 
-class HospitalViewSet(mixins.ListModelMixin,
+class HospitalViewSet(ConditionalGetMixin,
+                      mixins.ListModelMixin,
                       mixins.RetrieveModelMixin,
                       CreateModelUpdateByMixin,
                       UpdateModelUpdateByMixin,
+                      SparseFieldsMixin,
+                      UpdatedSinceMixin,
+                      ViewportMixin,
                       BasePermissionMixin,
                       viewsets.GenericViewSet):
     
@@ -42,14 +51,19 @@ class HospitalViewSet(mixins.ListModelMixin,
 
     partial_update:
     Partially update existing hospital instance.
+
+    viewport:
+    Retrieve hospitals in bounding box as compact rows or clusters.
     """
     
     filter_field = 'id'
     profile_field = 'hospitals'
     profile_values = 'hospital_id'
+    viewport_fields = ('id', 'name')
     queryset = Hospital.objects.all()
     
     serializer_class = HospitalSerializer
+    pagination_class = UpdatedOnCursorPagination
 
     @detail_route()
     def metadata(self, request, pk=None, **kwargs):
@@ -61,13 +75,18 @@ class HospitalViewSet(mixins.ListModelMixin,
         hospital_equipment = hospital.hospitalequipment_set.values('equipment')
         equipment = Equipment.objects.filter(id__in=hospital_equipment)
         serializer = EquipmentSerializer(equipment, many=True)
-        return Response(serializer.data)
+
+        # Equipment has no updated_on, hash content
+        return conditional_response(request, serializer.data)
     
 # HospitalEquipment viewset
 
-class HospitalEquipmentViewSet(mixins.ListModelMixin,
+class HospitalEquipmentViewSet(ConditionalGetMixin,
+                               mixins.ListModelMixin,
                                mixins.RetrieveModelMixin,
                                UpdateModelUpdateByMixin,
+                               SparseFieldsMixin,
+                               UpdatedSinceMixin,
                                viewsets.GenericViewSet):
     
     """
@@ -89,7 +108,9 @@ class HospitalEquipmentViewSet(mixins.ListModelMixin,
     queryset = HospitalEquipment.objects.all()
     
     serializer_class = HospitalEquipmentSerializer
+    pagination_class = UpdatedOnCursorPagination
     lookup_field = 'equipment__name'
+    etag_fields = ('hospital__name', 'equipment__name', 'equipment__etype')
 
     # make sure both fields are looked up
     def get_queryset(self):
@@ -118,15 +139,15 @@ class HospitalEquipmentViewSet(mixins.ListModelMixin,
         # otherwise check permission
         if self.request.method == 'GET':
             # objects that the user can read
-            get_object_or_404(user.profile.hospitals,
-                              hospital_id=id, can_read=True)
+            if not get_permissions(user).check_can_read(hospital=id):
+                raise Http404()
 
         elif (self.request.method == 'PUT' or
               self.request.method == 'PATCH' or
               self.request.method == 'DELETE'):
             # objects that the user can write to
-            get_object_or_404(user.profile.hospitals,
-                              hospital_id=id, can_write=True)
+            if not get_write_permissions(user).check_can_write(hospital=id):
+                raise Http404()
 
         # and return qset
         return qset
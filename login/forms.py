@@ -11,6 +11,8 @@ from django.contrib.auth.hashers import get_hasher, check_password
 from django.contrib.auth.models import User, Group
 
 from .models import TemporaryPassword
+from .permissions import get_user
+from .tokens import token_generator
 
 class SignupForm(auth_forms.UserCreationForm):
     username = auth_forms.UsernameField(
@@ -110,6 +112,8 @@ class MQTTAuthenticationForm(AuthenticationForm):
     """
     This form will allow authentication against a temporary password.
     The password must be retrieved using a valid session only.
+    Temporary passwords are tokens signed by login.tokens; hashes of
+    passwords stored in TemporaryPassword are still accepted.
     """
     
     def clean(self):
@@ -117,7 +121,30 @@ class MQTTAuthenticationForm(AuthenticationForm):
         username = self.cleaned_data.get('username')
         password = self.cleaned_data.get('password')
 
-        # see if password is encoded as a hash
+        # see if password is a token
+        if password and token_generator.is_token(password):
+
+            if token_generator.check_token(username, password):
+
+                try:
+
+                    # confirm user login allowed
+                    self.confirm_login_allowed(get_user(username))
+
+                    # valid login
+                    return self.cleaned_data
+
+                except User.DoesNotExist:
+                    pass
+
+            # otherwise it is an invalid login
+            raise forms.ValidationError(
+                self.error_messages['invalid_login'],
+                code='invalid_login',
+                params={'username': self.username_field.verbose_name},
+            )
+
+        # see if password is encoded as a legacy hash
         if password: 
 
             # a hash is in the format: <algorithm>$<iterations>$<hash>
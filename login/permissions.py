@@ -0,0 +1,262 @@
+import re
+import hashlib, hmac, os, time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from emstrack.cache import TTLCache
+from emstrack.metrics import Histogram
+
+from .models import Profile
+
+# Caches
+#
+# Caches are per process and signals only invalidate them in the process
+# that saved the change. Other web workers and mqttclient may therefore
+# keep using revoked permissions for up to TTL seconds. Write decisions,
+# which change data, use permissions loaded at most WRITE_TTL seconds
+# ago instead. MQTT ACLs are cached for TTL, but updates published by a
+# user who lost write access are still rejected by mqttclient.
+
+cache_settings = {
+    'TTL': 60,
+    'WRITE_TTL': 5,
+    'MAXSIZE': 4096,
+    'AUTH_TTL': 10,
+}
+cache_settings.update(getattr(settings, 'PERMISSION_CACHE', {}))
+
+user_cache = TTLCache(cache_settings['MAXSIZE'], cache_settings['TTL'])
+permission_cache = TTLCache(cache_settings['MAXSIZE'], cache_settings['TTL'])
+acl_cache = TTLCache(cache_settings['MAXSIZE'], cache_settings['TTL'])
+
+# positive MQTT login and superuser decisions
+auth_cache = TTLCache(cache_settings['MAXSIZE'], cache_settings['AUTH_TTL'])
+
+# credentials are never kept in memory, only keyed digests
+_auth_key = os.urandom(32)
+
+# MQTT ACL decision latency
+acl_latency = Histogram()
+
+def load_permissions(user, fields):
+    """
+    Read and write permissions in user's profile as dicts of
+    frozensets of ids indexed by field.
+    """
+
+    try:
+        profile = user.profile
+    except Profile.DoesNotExist:
+        profile = None
+
+    can_read = {}
+    can_write = {}
+    for field, values in fields.items():
+
+        read = set()
+        write = set()
+
+        if profile is not None:
+            for (id, can_read_, can_write_) in getattr(profile, field).values_list(values,
+                                                                                  'can_read',
+                                                                                  'can_write'):
+                if can_read_:
+                    read.add(id)
+                if can_write_:
+                    write.add(id)
+
+        can_read[field] = frozenset(read)
+        can_write[field] = frozenset(write)
+
+    return can_read, can_write
+
+# Permissions
+
+class Permissions():
+
+    """
+    Materialized read and write permissions of a user.
+
+    Permissions are indexed by the name of the profile field, that is
+    'ambulances' or 'hospitals', and hold sets of object ids.
+    """
+
+    fields = {
+        'ambulances': 'ambulance_id',
+        'hospitals': 'hospital_id'
+    }
+
+    def __init__(self, user):
+
+        self.user_id = user.id
+        self.is_superuser = user.is_superuser
+        self.loaded_on = time.monotonic()
+
+        self.can_read = {}
+        self.can_write = {}
+
+        # superusers do not need permissions
+        if self.is_superuser:
+            return
+
+        self.can_read, self.can_write = load_permissions(user, self.fields)
+
+    def check_can_read(self, **kwargs):
+        return self.check(self.can_read, **kwargs)
+
+    def check_can_write(self, **kwargs):
+        return self.check(self.can_write, **kwargs)
+
+    def check(self, permissions, ambulance = None, hospital = None):
+
+        if self.is_superuser:
+            return True
+
+        if ambulance is not None:
+            return int(ambulance) in permissions['ambulances']
+
+        if hospital is not None:
+            return int(hospital) in permissions['hospitals']
+
+        return False
+
+# ACL
+
+# topics that do not depend on the user, the first group is an id
+SUBSCRIBE_TOPICS = (
+    (re.compile(r'settings'), None),
+    (re.compile(r'hospital/(\d+)/(data|metadata|equipment/[^/]+/data)'), 'hospitals'),
+    (re.compile(r'ambulance/(\d+)/data'), 'ambulances')
+)
+
+class ACL():
+
+    """
+    Compiled MQTT access control list of a user.
+
+    Topics are matched against precompiled patterns and ids are checked
+    against the sets of readable and writable ambulances and hospitals.
+    Unlike Permissions, superusers have no implicit permissions since
+    the broker checks superusers separately.
+    """
+
+    def __init__(self, user):
+
+        self.user_id = user.id
+        self.can_read, self.can_write = load_permissions(user, Permissions.fields)
+
+        # topics under user/{username}
+        prefix = 'user/{}/'.format(re.escape(user.username))
+        self.subscribe_topics = SUBSCRIBE_TOPICS + (
+            (re.compile(prefix + r'(profile|error)'), None),
+        )
+        self.publish_topics = (
+            (re.compile(prefix + r'error'), None),
+            (re.compile(prefix + r'ambulance/(\d+)/data'), 'ambulances'),
+            (re.compile(prefix + r'hospital/(\d+)/(data|equipment/[^/]+/data)'), 'hospitals')
+        )
+        self.client_topic = re.compile(prefix + r'client/([^/]+)/status')
+        self.bulk_topic = 'user/{}/ambulance/data'.format(user.username)
+
+    @staticmethod
+    def check(topics, permissions, topic):
+
+        for pattern, field in topics:
+            match = pattern.fullmatch(topic)
+            if match:
+                return field is None or int(match.group(1)) in permissions[field]
+
+        return False
+
+    def can_subscribe(self, topic):
+        return self.check(self.subscribe_topics, self.can_read, topic)
+
+    def can_publish(self, topic, client_id = None):
+
+        #  - user/{username}/client/{client-id}/status
+        match = self.client_topic.fullmatch(topic)
+        if match:
+            return match.group(1) == client_id
+
+        #  - user/{username}/ambulance/data
+        # each update is checked when processed
+        if topic == self.bulk_topic:
+            return bool(self.can_write['ambulances'])
+
+        return self.check(self.publish_topics, self.can_write, topic)
+
+def get_user(username):
+    """
+    Retrieve user by username. Raises User.DoesNotExist.
+    """
+    user = user_cache.get(username)
+    if user is None:
+        generation = user_cache.generation
+        user = User.objects.get(username=username)
+        user_cache.set(username, user, generation)
+    return user
+
+def get_permissions(user):
+    """
+    Retrieve cached permissions of user.
+    """
+    return permission_cache.get_or_set(user.id,
+                                       lambda: Permissions(user))
+
+def get_write_permissions(user):
+    """
+    Retrieve permissions of user loaded at most WRITE_TTL seconds ago.
+    """
+    permissions = permission_cache.get(user.id)
+    if (permissions is None or
+        time.monotonic() - permissions.loaded_on > cache_settings['WRITE_TTL']):
+        generation = permission_cache.generation
+        permissions = Permissions(user)
+        permission_cache.set(user.id, permissions, generation)
+    return permissions
+
+def get_acl(user):
+    """
+    Retrieve cached MQTT ACL of user.
+    """
+    return acl_cache.get_or_set(user.id,
+                                lambda: ACL(user))
+
+def auth_fingerprint(username, password):
+    """
+    Key of credentials in auth_cache.
+    """
+    return hmac.new(_auth_key,
+                    '{}\0{}'.format(username, password).encode(),
+                    hashlib.sha256).digest()
+
+def invalidate_auth(username = None):
+    if username is None:
+        auth_cache.clear()
+    else:
+        auth_cache.delete(('login', username))
+        auth_cache.delete(('superuser', username))
+
+def invalidate_user(user):
+    user_cache.delete(user.username)
+    permission_cache.delete(user.id)
+    acl_cache.delete(user.id)
+    invalidate_auth(user.username)
+
+def invalidate_permissions(user_id = None):
+    if user_id is None:
+        permission_cache.clear()
+        acl_cache.clear()
+    else:
+        permission_cache.delete(user_id)
+        acl_cache.delete(user_id)
+
+def stats():
+    return {
+        'users': user_cache.stats(),
+        'permissions': permission_cache.stats(),
+        'acl': acl_cache.stats(),
+        'auth': auth_cache.stats(),
+        'acl_latency': acl_latency.stats()
+    }
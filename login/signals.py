@@ -1,12 +1,71 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.dispatch import receiver
 
 from django.contrib.auth.models import User
 
-from .models import Profile
+from .models import Profile, AmbulancePermission, HospitalPermission, \
+    TemporaryPassword
+from .permissions import invalidate_user, invalidate_permissions, \
+    invalidate_auth
+
+def export():
+
+    # regenerate broker ACL and password files
+    from mqtt.export import get_exporter
+    exporter = get_exporter()
+    if exporter is not None:
+        exporter.schedule()
 
 # Add signal to automatically extend user profile
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
+
+# Invalidate permission caches
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+
+    # django updates last_login on every web login
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+
+    invalidate_user(instance)
+    export()
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_permissions(instance.user_id)
+    export()
+
+@receiver(m2m_changed, sender=Profile.ambulances.through)
+@receiver(m2m_changed, sender=Profile.hospitals.through)
+def profile_permissions_changed(sender, instance, action, **kwargs):
+    if action.startswith('post_'):
+        if isinstance(instance, Profile):
+            invalidate_permissions(instance.user_id)
+            export()
+        else:
+            # changed from the permission side
+            invalidate_permissions()
+            export()
+
+@receiver(post_save, sender=AmbulancePermission)
+@receiver(post_delete, sender=AmbulancePermission)
+@receiver(post_save, sender=HospitalPermission)
+@receiver(post_delete, sender=HospitalPermission)
+def permission_changed(sender, instance, **kwargs):
+    # permissions are shared through many-to-many tables,
+    # invalidate all users
+    invalidate_permissions()
+    export()
+
+@receiver(post_save, sender=TemporaryPassword)
+@receiver(post_delete, sender=TemporaryPassword)
+def temporary_password_changed(sender, instance, **kwargs):
+    # legacy temporary passwords are rare, drop all decisions
+    invalidate_auth()
@@ -0,0 +1,191 @@
+import random, threading, time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TransactionTestCase, Client
+from django.test.utils import CaptureQueriesContext
+
+from login.models import AmbulancePermission, HospitalPermission
+from login.permissions import user_cache, permission_cache, acl_cache, auth_cache
+
+from ambulance.models import Ambulance, AmbulanceCapability
+from hospital.models import Hospital
+
+# Load test of the broker authentication and ACL endpoints
+#
+# Not collected by the test runner, run with
+#
+#     ./manage.py test login/tests/bench_acl.py
+#
+# Creates USERS users with AMBULANCES and HOSPITALS permissions each
+# and drives a mix of requests to MQTTAclView, MQTTLoginView and
+# MQTTSuperuserView from CONCURRENCY threads. Data has to be committed
+# to be visible from the threads, hence the TransactionTestCase.
+
+def percentile(values, q):
+    # nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[k]
+
+class BenchMQTTAcl(TransactionTestCase):
+
+    USERS = 50
+    AMBULANCES = 20
+    HOSPITALS = 10
+    CONCURRENCY = 8
+    REQUESTS = 2000
+
+    # fraction of requests of each kind
+    MIX = (('subscribe', 0.5),
+           ('publish', 0.3),
+           ('login', 0.1),
+           ('superuser', 0.1))
+
+    def setUp(self):
+
+        password = make_password('very_secret')
+
+        # Add superuser
+        admin = User.objects.create(username='admin',
+                                    email='admin@user.com',
+                                    password=password,
+                                    is_superuser=True)
+
+        # Add ambulances and hospitals
+        self.ambulances = [Ambulance.objects.create(identifier='BC-{}'.format(k),
+                                                    capability=AmbulanceCapability.B.name,
+                                                    updated_by=admin)
+                           for k in range(2 * self.AMBULANCES)]
+        self.hospitals = [Hospital.objects.create(name='Hospital {}'.format(k),
+                                                  number=str(k),
+                                                  street='Street',
+                                                  updated_by=admin)
+                          for k in range(2 * self.HOSPITALS)]
+
+        # Add users with permissions to half of them
+        rng = random.Random(0)
+        self.users = []
+        for k in range(self.USERS):
+
+            user = User.objects.create(username='testuser{}'.format(k),
+                                       email='test{}@user.com'.format(k),
+                                       password=password)
+
+            user.profile.ambulances.add(*[
+                AmbulancePermission.objects.create(ambulance=ambulance,
+                                                   can_write=rng.random() < 0.5)
+                for ambulance in rng.sample(self.ambulances, self.AMBULANCES)
+            ])
+            user.profile.hospitals.add(*[
+                HospitalPermission.objects.create(hospital=hospital,
+                                                  can_write=rng.random() < 0.5)
+                for hospital in rng.sample(self.hospitals, self.HOSPITALS)
+            ])
+
+            self.users.append(user.username)
+
+    def request(self, rng, kind):
+
+        username = rng.choice(self.users)
+
+        if kind == 'subscribe':
+            if rng.random() < 0.5:
+                topic = 'ambulance/{}/data'.format(rng.choice(self.ambulances).id)
+            else:
+                topic = 'hospital/{}/{}'.format(rng.choice(self.hospitals).id,
+                                                rng.choice(('data', 'metadata')))
+            return '/auth/mqtt/acl/', {'username': username,
+                                       'clientid': 'client_' + username,
+                                       'acc': '1',
+                                       'topic': topic}
+
+        elif kind == 'publish':
+            if rng.random() < 0.8:
+                topic = 'user/{}/ambulance/{}/data'.format(username,
+                                                           rng.choice(self.ambulances).id)
+            else:
+                topic = 'user/{}/client/client_{}/status'.format(username, username)
+            return '/auth/mqtt/acl/', {'username': username,
+                                       'clientid': 'client_' + username,
+                                       'acc': '2',
+                                       'topic': topic}
+
+        elif kind == 'login':
+            return '/auth/mqtt/login/', {'username': username,
+                                         'password': 'very_secret'}
+
+        else:
+            return '/auth/mqtt/superuser/', {'username': rng.choice(self.users + ['admin'])}
+
+    def worker(self, seed, count, results):
+
+        rng = random.Random(seed)
+        kinds = [kind for kind, weight in self.MIX]
+        weights = [weight for kind, weight in self.MIX]
+        client = Client()
+
+        latencies = {kind: [] for kind in kinds}
+        queries = {kind: 0 for kind in kinds}
+        try:
+            for k in range(count):
+                kind = rng.choices(kinds, weights)[0]
+                url, data = self.request(rng, kind)
+                with CaptureQueriesContext(connection) as context:
+                    start = time.perf_counter()
+                    client.post(url, data)
+                    latencies[kind].append(time.perf_counter() - start)
+                queries[kind] += len(context.captured_queries)
+            results.append((latencies, queries))
+        finally:
+            connection.close()
+
+    def run_load(self, label):
+
+        count = self.REQUESTS // self.CONCURRENCY
+        results = []
+        threads = [threading.Thread(target=self.worker,
+                                    args=(k, count, results))
+                   for k in range(self.CONCURRENCY)]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        total = sum(len(values) for latencies, queries in results
+                    for values in latencies.values())
+        print('\n>> {}: {} requests from {} threads in {:.2f} s, {:.1f} requests/s'.format(label, total,
+                                                                                       self.CONCURRENCY,
+                                                                                       elapsed,
+                                                                                       total / elapsed))
+        print('   {:10s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s}'.format('endpoint', 'count',
+                                                                 'p50 ms', 'p95 ms', 'p99 ms',
+                                                                 'queries'))
+        for kind, weight in self.MIX:
+            values = sorted(value for latencies, queries in results
+                            for value in latencies[kind])
+            n = sum(queries[kind] for latencies, queries in results)
+            print('   {:10s} {:7d} {:9.3f} {:9.3f} {:9.3f} {:9.2f}'.format(kind, len(values),
+                                                                       1e3 * percentile(values, 50),
+                                                                       1e3 * percentile(values, 95),
+                                                                       1e3 * percentile(values, 99),
+                                                                       n / len(values) if values else 0.0))
+
+    def test_benchmark(self):
+
+        print('\n>> MQTT auth/ACL load test ({} users, {} ambulances and {} hospitals per user)'.format(self.USERS,
+                                                                                                       self.AMBULANCES,
+                                                                                                       self.HOSPITALS))
+
+        # cold caches
+        for cache in (user_cache, permission_cache, acl_cache, auth_cache):
+            cache.clear()
+        self.run_load('cold')
+
+        # warm caches
+        self.run_load('warm')
@@ -0,0 +1,65 @@
+import time
+
+from django.contrib.auth.hashers import make_password
+
+from login.forms import MQTTAuthenticationForm
+from login.models import TemporaryPassword
+from login.tokens import token_generator
+
+from login.tests.setup_data import TestSetup
+
+# Micro-benchmark of MQTT logins with temporary passwords
+#
+# Not collected by the test runner, run with
+#
+#     ./manage.py test login/tests/bench_login.py
+
+class BenchMQTTLogin(TestSetup):
+
+    N = 200
+
+    def login(self, username, password):
+        form = MQTTAuthenticationForm(data={'username': username,
+                                            'password': password})
+        assert form.is_valid()
+
+    def run_issue_hash(self, username):
+        for k in range(self.N):
+            make_password('temporary')
+
+    def run_issue_token(self, username):
+        for k in range(self.N):
+            token_generator.make_token(username)
+
+    def run_login_hash(self, username):
+        encoded = make_password('temporary')
+        for k in range(self.N):
+            self.login(username, encoded)
+
+    def run_login_token(self, username):
+        token = token_generator.make_token(username)
+        for k in range(self.N):
+            self.login(username, token)
+
+    def test_benchmark(self):
+
+        username = self.u2.username
+        TemporaryPassword.objects.create(user=self.u2,
+                                         password='temporary')
+
+        print('\n>> MQTT login benchmark ({} logins)'.format(self.N))
+        timings = {}
+        for name in ('issue_hash', 'issue_token',
+                     'login_hash', 'login_token'):
+            start = time.perf_counter()
+            getattr(self, 'run_' + name)(username)
+            elapsed = time.perf_counter() - start
+            timings[name] = elapsed
+            print('   {:12s}: {:8.3f} ms/login, {:10.1f} logins/s'.format(name,
+                                                                        1e3 * elapsed / self.N,
+                                                                        self.N / elapsed))
+
+        print('   issue speedup: {:.1f}x'.format(timings['issue_hash'] /
+                                                timings['issue_token']))
+        print('   login speedup: {:.1f}x'.format(timings['login_hash'] /
+                                                timings['login_token']))
@@ -5,7 +5,7 @@ from django.test import Client
 
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.contrib.auth.hashers import get_hasher, check_password
+from django.contrib.auth.hashers import get_hasher, make_password
 
 from rest_framework.parsers import JSONParser
 from io import BytesIO
@@ -19,10 +19,12 @@ from hospital.models import Hospital, \
 from ..models import Profile, AmbulancePermission, HospitalPermission, \
     TemporaryPassword
 
+from ..tokens import TokenGenerator, token_generator
+
 from ..serializers import ProfileSerializer, ExtendedProfileSerializer
 
 from ..views import LoginView, SignupView, LogoutView, \
-    MQTTLoginView, MQTTSuperuserView, MQTTAclView
+    MQTTLoginView, MQTTSuperuserView, MQTTAclView, SettingsView
 
 from mqtt.tests.client import MQTTTestCase, MQTTTestClient
 from mqtt.client import MQTTException
@@ -186,6 +188,96 @@ class TestProfileViewset(MyTestCase):
         # logout
         client.logout()
         
+class TestBootstrap(MyTestCase):
+
+    def test_bootstrap(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser2
+        client.login(username='testuser2', password='very_secret')
+
+        # cannot retrieve other users' bootstrap
+        response = client.get('/api/user/testuser1/bootstrap/', follow=True)
+        self.assertEqual(response.status_code, 403)
+
+        response = client.get('/api/user/testuser2/bootstrap/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        result = JSONParser().parse(BytesIO(response.content))
+        self.assertEqual(set(result.keys()),
+                         {'version', 'settings', 'profile', 'ambulances', 'hospitals'})
+        self.assertEqual(result['settings'], SettingsView.get_settings())
+        self.assertEqual(result['profile'],
+                         ExtendedProfileSerializer(Profile.objects.get(user=self.u3)).data)
+        self.assertEqual([a['id'] for a in result['ambulances']], [self.a3.id])
+        self.assertEqual(result['hospitals'], [])
+
+        # not modified
+        etag = response['ETag']
+        response = client.get('/api/user/testuser2/bootstrap/',
+                              HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 304)
+
+        # modified
+        Ambulance.objects.get(id=self.a3.id).save()
+        response = client.get('/api/user/testuser2/bootstrap/',
+                              HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(JSONParser().parse(BytesIO(response.content))['version'],
+                           result['version'])
+
+        # gzip
+        response = client.get('/api/user/testuser2/bootstrap/',
+                              HTTP_ACCEPT_ENCODING='gzip', follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        # logout
+        client.logout()
+
+class TestConditionalGet(MyTestCase):
+
+    def test_conditional_get(self):
+
+        # instantiate client
+        client = Client()
+
+        # login as testuser2
+        client.login(username='testuser2', password='very_secret')
+
+        for url in ('/api/settings/',
+                    '/api/user/testuser2/profile/',
+                    '/api/hospital/{}/metadata/'.format(self.h1.id)):
+
+            response = client.get(url, follow=True)
+            if url.startswith('/api/hospital/'):
+                # testuser2 cannot read hospitals
+                self.assertEqual(response.status_code, 404)
+                continue
+
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag, follow=True)
+            self.assertEqual(response.status_code, 304)
+
+        # profile changes with permissions
+        etag = client.get('/api/user/testuser2/profile/', follow=True)['ETag']
+        self.u3.profile.hospitals.add(HospitalPermission.objects.create(hospital=self.h1))
+        response = client.get('/api/user/testuser2/profile/',
+                              HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # metadata
+        etag = client.get('/api/hospital/{}/metadata/'.format(self.h1.id), follow=True)['ETag']
+        response = client.get('/api/hospital/{}/metadata/'.format(self.h1.id),
+                              HTTP_IF_NONE_MATCH=etag, follow=True)
+        self.assertEqual(response.status_code, 304)
+
+        # logout
+        client.logout()
+
 class TestLogin(MyTestCase):
             
     def test_login(self):
@@ -894,10 +986,8 @@ class TestMQTTLoginTempPassword(MyTestCase):
         self.assertEqual(response.status_code, 200)
         encoded = JSONParser().parse(BytesIO(response.content))
 
-        # retrieve temporary password
-        password = TemporaryPassword.objects.get(user__username = username).password
-        
-        self.assertEqual(check_password(password, encoded), True)
+        # password is a token
+        self.assertTrue(token_generator.check_token(username, encoded))
 
         # logout
         response = self.client.get('/auth/logout/', follow=True)
@@ -937,10 +1027,8 @@ class TestMQTTLoginTempPassword(MyTestCase):
         self.assertEqual(response.status_code, 200)
         encoded = JSONParser().parse(BytesIO(response.content))
 
-        # retrieve temporary password
-        password = TemporaryPassword.objects.get(user__username = username).password
-        
-        self.assertEqual(check_password(password, encoded), True)
+        # password is a token
+        self.assertTrue(token_generator.check_token(username, encoded))
 
         # logout
         response = self.client.get('/auth/logout/', follow=True)
@@ -980,10 +1068,8 @@ class TestMQTTLoginTempPassword(MyTestCase):
         self.assertEqual(response.status_code, 200)
         encoded = JSONParser().parse(BytesIO(response.content))
 
-        # retrieve temporary password
-        password = TemporaryPassword.objects.get(user__username = username).password
-        
-        self.assertEqual(check_password(password, encoded), True)
+        # password is a token
+        self.assertTrue(token_generator.check_token(username, encoded))
 
         # logout
         response = self.client.get('/auth/logout/', follow=True)
@@ -1011,4 +1097,71 @@ class TestMQTTLoginTempPassword(MyTestCase):
                                     follow=True)
         self.assertEqual(response.status_code, 403)
 
-        
+class TestMQTTLoginToken(MyTestCase):
+
+    def test_token(self):
+
+        tokens = TokenGenerator(secret='secret', ttl=120)
+        now = time.time()
+        token = tokens.make_token('testuser1', now=now)
+
+        self.assertTrue(tokens.check_token('testuser1', token, now=now))
+        self.assertFalse(tokens.check_token('testuser2', token, now=now))
+        self.assertFalse(tokens.check_token('testuser1', token + 'r', now=now))
+        self.assertFalse(tokens.check_token('testuser1', 'mqtt$1$2', now=now))
+
+        # signed with a different key
+        self.assertFalse(TokenGenerator(secret='other').check_token('testuser1', token, now=now))
+
+        # expired
+        self.assertTrue(tokens.check_token('testuser1', token, now=now + 120))
+        self.assertFalse(tokens.check_token('testuser1', token, now=now + 121))
+
+        # revoked
+        other = tokens.make_token('testuser1', now=now)
+        tokens.revoke(token, now=now)
+        self.assertFalse(tokens.check_token('testuser1', token, now=now))
+        self.assertTrue(tokens.check_token('testuser1', other, now=now))
+
+        # expired revocations are dropped
+        tokens.revoke(other, now=now + 121)
+        self.assertEqual(tokens.revoked, {})
+
+        # login with token
+        username = 'testuser1'
+        token = token_generator.make_token(username)
+        response = self.client.post('/auth/mqtt/login/',
+                                    { 'username': username,
+                                      'password': token },
+                                    follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # revoked tokens are rejected
+        token_generator.revoke(token)
+        response = self.client.post('/auth/mqtt/login/',
+                                    { 'username': username,
+                                      'password': token },
+                                    follow=True)
+        self.assertEqual(response.status_code, 403)
+
+class TestMQTTLoginLegacyPassword(MyTestCase):
+
+    def test_legacy(self):
+
+        # temporary password hashes issued before tokens are still accepted
+        username = 'testuser1'
+        TemporaryPassword.objects.create(user=User.objects.get(username=username),
+                                         password='temporary')
+        encoded = make_password('temporary')
+
+        response = self.client.post('/auth/mqtt/login/',
+                                    { 'username': username,
+                                      'password': encoded },
+                                    follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post('/auth/mqtt/login/',
+                                    { 'username': username,
+                                      'password': make_password('other') },
+                                    follow=True)
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,274 @@
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from ..models import AmbulancePermission, HospitalPermission
+from ..permissions import get_user, get_permissions, get_write_permissions, \
+    get_acl, cache_settings, user_cache, permission_cache, acl_cache, acl_latency, auth_cache
+
+from .setup_data import TestSetup
+
+class TestPermissions(TestSetup):
+
+    def setUp(self):
+
+        # start with empty caches
+        user_cache.clear()
+        permission_cache.clear()
+        acl_cache.clear()
+        auth_cache.clear()
+
+    def test_permissions(self):
+
+        # superuser
+        perms = get_permissions(self.u1)
+        self.assertTrue(perms.check_can_read(ambulance=self.a1.id))
+        self.assertTrue(perms.check_can_write(hospital=self.h2.id))
+
+        # testuser1
+        perms = get_permissions(self.u2)
+        self.assertEqual(perms.can_read['hospitals'], {self.h1.id, self.h2.id})
+        self.assertEqual(perms.can_write['hospitals'], {self.h2.id})
+        self.assertEqual(perms.can_read['ambulances'], set())
+        self.assertTrue(perms.check_can_write(hospital=self.h2.id))
+        self.assertFalse(perms.check_can_write(hospital=self.h1.id))
+        self.assertFalse(perms.check_can_read(ambulance=self.a1.id))
+
+        # testuser2
+        perms = get_permissions(self.u3)
+        self.assertEqual(perms.can_read['ambulances'], {self.a3.id})
+        self.assertEqual(perms.can_write['ambulances'], {self.a3.id})
+        self.assertTrue(perms.check_can_write(ambulance=str(self.a3.id)))
+        self.assertFalse(perms.check_can_read(ambulance=self.a1.id))
+
+    def test_cache(self):
+
+        # first access hits the database
+        user = get_user('testuser2')
+        get_permissions(user)
+
+        # then it is cached
+        with self.assertNumQueries(0):
+            user = get_user('testuser2')
+            perms = get_permissions(user)
+            self.assertFalse(perms.check_can_write(ambulance=self.a1.id))
+
+        self.assertGreater(permission_cache.hits, 0)
+        self.assertGreater(user_cache.hits, 0)
+
+        # unknown users
+        with self.assertRaises(User.DoesNotExist):
+            get_user('unknown')
+
+        # changing permissions invalidates the cache
+        perm = AmbulancePermission.objects.get(ambulance=self.a1,
+                                               profile__user=self.u3)
+        perm.can_write = True
+        perm.save()
+        perms = get_permissions(user)
+        self.assertTrue(perms.check_can_write(ambulance=self.a1.id))
+
+        # adding permissions invalidates the cache
+        user.profile.hospitals.add(
+            HospitalPermission.objects.create(hospital=self.h3)
+        )
+        perms = get_permissions(user)
+        self.assertTrue(perms.check_can_read(hospital=self.h3.id))
+
+        # changing user invalidates the cache
+        user.is_superuser = True
+        user.save()
+        user = get_user('testuser2')
+        self.assertTrue(user.is_superuser)
+        self.assertTrue(get_permissions(user).check_can_write(hospital=self.h1.id))
+
+    def test_write_permissions(self):
+
+        user = get_user('testuser2')
+        get_permissions(user)
+
+        # recently loaded permissions are reused
+        with self.assertNumQueries(0):
+            self.assertFalse(get_write_permissions(user).check_can_write(ambulance=self.a1.id))
+
+        # changed in another process, no invalidation here
+        AmbulancePermission.objects.filter(ambulance=self.a1,
+                                           profile__user=self.u3).update(can_write=True)
+        self.assertFalse(get_permissions(user).check_can_write(ambulance=self.a1.id))
+
+        # write checks reload after WRITE_TTL
+        with patch.dict(cache_settings, {'WRITE_TTL': -1}):
+            self.assertTrue(get_write_permissions(user).check_can_write(ambulance=self.a1.id))
+
+        # and refresh the cache
+        self.assertTrue(get_permissions(user).check_can_write(ambulance=self.a1.id))
+
+    def test_acl(self):
+
+        # testuser2
+        acl = get_acl(self.u3)
+        self.assertTrue(acl.can_subscribe('settings'))
+        self.assertTrue(acl.can_subscribe('user/testuser2/profile'))
+        self.assertFalse(acl.can_subscribe('user/testuser1/profile'))
+        self.assertTrue(acl.can_subscribe('hospital/{}/metadata'.format(self.h2.id)))
+        self.assertTrue(acl.can_subscribe('hospital/{}/equipment/+/data'.format(self.h1.id)))
+        self.assertFalse(acl.can_subscribe('hospital/{}/data'.format(self.h3.id)))
+        self.assertFalse(acl.can_subscribe('hospital/{}/data/extra'.format(self.h1.id)))
+        self.assertTrue(acl.can_subscribe('ambulance/{}/data'.format(self.a3.id)))
+        self.assertFalse(acl.can_subscribe('ambulance/{}/data'.format(self.a1.id)))
+        self.assertFalse(acl.can_subscribe('ambulance/x/data'))
+
+        self.assertTrue(acl.can_publish('user/testuser2/error'))
+        self.assertTrue(acl.can_publish('user/testuser2/ambulance/{}/data'.format(self.a3.id)))
+        self.assertFalse(acl.can_publish('user/testuser2/ambulance/{}/data'.format(self.a1.id)))
+        self.assertFalse(acl.can_publish('user/testuser1/ambulance/{}/data'.format(self.a3.id)))
+        self.assertTrue(acl.can_publish('user/testuser2/hospital/{}/equipment/beds/data'.format(self.h2.id)))
+        self.assertFalse(acl.can_publish('user/testuser2/hospital/{}/data'.format(self.h1.id)))
+        self.assertTrue(acl.can_publish('user/testuser2/client/client_1/status', 'client_1'))
+        self.assertFalse(acl.can_publish('user/testuser2/client/client_1/status', 'client_2'))
+
+        # superusers have no implicit permissions
+        acl = get_acl(self.u1)
+        self.assertTrue(acl.can_subscribe('ambulance/{}/data'.format(self.a2.id)))
+        self.assertFalse(acl.can_subscribe('ambulance/{}/data'.format(self.a1.id)))
+
+    def test_acl_view(self):
+
+        data = {
+            'username': 'testuser2',
+            'clientid': 'test_client',
+            'acc': '2',
+            'topic': '/user/testuser2/ambulance/{}/data'.format(self.a1.id)
+        }
+
+        response = self.client.post('/auth/mqtt/acl/', data, follow=True)
+        self.assertEqual(response.status_code, 403)
+
+        # decisions do not hit the database once cached
+        count = acl_latency.count
+        with self.assertNumQueries(0):
+            response = self.client.post('/auth/mqtt/acl/', data, follow=True)
+            self.assertEqual(response.status_code, 403)
+        self.assertEqual(acl_latency.count, count + 1)
+
+        # changing permissions invalidates the cache
+        perm = AmbulancePermission.objects.get(ambulance=self.a1,
+                                               profile__user=self.u3)
+        perm.can_write = True
+        perm.save()
+        response = self.client.post('/auth/mqtt/acl/', data, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # inactive users are denied
+        self.u3.is_active = False
+        self.u3.save()
+        response = self.client.post('/auth/mqtt/acl/', data, follow=True)
+        self.assertEqual(response.status_code, 403)
+
+    def test_stats_view(self):
+
+        # only superusers
+        response = self.client.get('/api/stats/', follow=True)
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(self.client.login(username='testuser1', password='top_secret'))
+        response = self.client.get('/api/stats/', follow=True)
+        self.assertEqual(response.status_code, 403)
+        self.client.logout()
+
+        # acl checks done by this process are reported
+        data = {
+            'username': 'testuser2',
+            'clientid': 'test_client',
+            'acc': '1',
+            'topic': '/user/testuser2/ambulance/{}/data'.format(self.a3.id)
+        }
+        count = acl_latency.count
+        for k in range(2):
+            response = self.client.post('/auth/mqtt/acl/', data, follow=True)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertTrue(self.client.login(username=self.u1.username,
+                                          password=settings.MQTT['PASSWORD']))
+        response = self.client.get('/api/stats/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual(stats['acl_latency']['count'], count + 2)
+        self.assertEqual(sum(n for bound, n in stats['acl_latency']['buckets']),
+                         count + 2)
+        self.assertIsNone(stats['acl_latency']['buckets'][-1][0])
+        self.assertEqual(stats['acl']['misses'], 1)
+        self.assertEqual(stats['acl']['hits'], 1)
+        self.client.logout()
+
+    def test_auth_cache(self):
+
+        data = {
+            'username': 'testuser2',
+            'password': 'very_secret'
+        }
+
+        response = self.client.post('/auth/mqtt/login/', data, follow=True)
+        self.assertEqual(response.status_code, 200)
+
+        # successful logins do not hit the database once cached
+        hits = auth_cache.hits
+        with self.assertNumQueries(0):
+            response = self.client.post('/auth/mqtt/login/', data, follow=True)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(auth_cache.hits, hits + 1)
+
+        # failed logins are not cached
+        response = self.client.post('/auth/mqtt/login/',
+                                    {'username': 'testuser2',
+                                     'password': 'wrong'},
+                                    follow=True)
+        self.assertEqual(response.status_code, 403)
+
+        # superuser decisions
+        response = self.client.post('/auth/mqtt/superuser/',
+                                    {'username': self.u1.username}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            response = self.client.post('/auth/mqtt/superuser/',
+                                        {'username': self.u1.username}, follow=True)
+            self.assertEqual(response.status_code, 200)
+
+        # web logins do not invalidate the cache
+        self.assertTrue(self.client.login(username='testuser2', password='very_secret'))
+        self.client.logout()
+        self.assertIsNotNone(auth_cache.get(('login', 'testuser2')))
+        self.assertIsNotNone(auth_cache.get(('superuser', self.u1.username)))
+
+        # changes to other users do not invalidate the cache
+        user = User.objects.get(id=self.u2.id)
+        user.first_name = 'Other'
+        user.save()
+        self.assertIsNotNone(auth_cache.get(('login', 'testuser2')))
+
+        # hits and misses are reported by the web process
+        self.assertTrue(self.client.login(username=self.u1.username,
+                                          password=settings.MQTT['PASSWORD']))
+        response = self.client.get('/api/stats/', follow=True)
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()['auth']
+        self.assertEqual((stats['hits'], stats['misses']),
+                         (auth_cache.hits, auth_cache.misses))
+        self.assertGreater(stats['hits'], 0)
+        self.assertGreater(stats['hit_ratio'], 0)
+        self.client.logout()
+
+        # changing password invalidates the cache
+        user = User.objects.get(id=self.u3.id)
+        user.set_password('other_secret')
+        user.save()
+        response = self.client.post('/auth/mqtt/login/', data, follow=True)
+        self.assertEqual(response.status_code, 403)
+
+        # deactivating user invalidates the cache
+        user = User.objects.get(id=self.u1.id)
+        user.is_active = False
+        user.save()
+        response = self.client.post('/auth/mqtt/superuser/',
+                                    {'username': self.u1.username}, follow=True)
+        self.assertEqual(response.status_code, 403)
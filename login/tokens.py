@@ -0,0 +1,112 @@
+import hashlib, hmac, os, threading, time
+
+from django.conf import settings
+
+# Temporary MQTT passwords
+#
+# A token is signed with a key derived from settings.SECRET_KEY and
+# has the format
+#
+#     mqtt$<expires>$<nonce>$<signature>
+#
+# where expires is a unix timestamp and signature is the HMAC-SHA256
+# of the username, expires and nonce. Verifying a token is a single
+# HMAC and does not touch the database, unlike the legacy temporary
+# password hashes, which require a full PBKDF2 per login.
+
+ALGORITHM = 'mqtt'
+
+def get_ttl():
+    return getattr(settings, 'MQTT', {}).get('TOKEN_TTL', 120)
+
+class TokenGenerator():
+
+    """
+    Generates and verifies temporary MQTT passwords.
+    """
+
+    def __init__(self, secret = None, ttl = None):
+
+        self.secret = secret
+        self.ttl = ttl
+        self._key = None
+
+        # nonce -> expires
+        self.revoked = {}
+        self.lock = threading.Lock()
+
+    @property
+    def key(self):
+        if self._key is None:
+            secret = self.secret if self.secret is not None else settings.SECRET_KEY
+            self._key = hashlib.sha256(('login.tokens.' + secret).encode()).digest()
+        return self._key
+
+    def sign(self, username, expires, nonce):
+        message = '{}${}${}'.format(username, expires, nonce).encode()
+        return hmac.new(self.key, message, hashlib.sha256).hexdigest()
+
+    def make_token(self, username, now = None):
+        """
+        Return a new token for username.
+        """
+
+        now = time.time() if now is None else now
+        ttl = self.ttl if self.ttl is not None else get_ttl()
+
+        expires = int(now + ttl)
+        nonce = os.urandom(8).hex()
+        return '{}${}${}${}'.format(ALGORITHM, expires, nonce,
+                                    self.sign(username, expires, nonce))
+
+    @staticmethod
+    def is_token(password):
+        return password.startswith(ALGORITHM + '$')
+
+    def check_token(self, username, token, now = None):
+        """
+        Return True if token is a valid, unexpired and unrevoked token
+        for username.
+        """
+
+        try:
+            algorithm, expires, nonce, signature = token.split('$')
+            expires = int(expires)
+        except ValueError:
+            return False
+
+        if algorithm != ALGORITHM:
+            return False
+
+        # constant-time comparison
+        if not hmac.compare_digest(signature, self.sign(username, expires, nonce)):
+            return False
+
+        now = time.time() if now is None else now
+        if now > expires:
+            return False
+
+        return nonce not in self.revoked
+
+    def revoke(self, token, now = None):
+        """
+        Revoke token until it expires. Revocation is kept in memory
+        and only applies to the current process.
+        """
+
+        try:
+            algorithm, expires, nonce, signature = token.split('$')
+            expires = int(expires)
+        except ValueError:
+            return
+
+        now = time.time() if now is None else now
+        with self.lock:
+
+            # drop revocations of tokens that have already expired
+            self.revoked = {n: e for n, e in self.revoked.items() if e >= now}
+
+            if expires >= now:
+                self.revoked[nonce] = expires
+
+token_generator = TokenGenerator()
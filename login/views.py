@@ -1,13 +1,14 @@
-import logging
-import string, random
-from datetime import timedelta
+import logging, os
+import hashlib, hmac
 
+from django.db import connection, transaction
+from django.db.models import Max
 from django.urls import reverse
-from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
+from django.core.exceptions import PermissionDenied
 from django.http.response import HttpResponse, HttpResponseForbidden
 from django.contrib.auth import views as auth_views
-from django.contrib.auth.hashers import make_password
-from django.utils import timezone
 from django.views.generic.base import View
 from django.views.generic.edit import FormView
 
@@ -15,15 +16,25 @@ from braces.views import CsrfExemptMixin
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.renderers import JSONRenderer
 from drf_extra_fields.geo_fields import PointField
 
 from django.contrib.auth.models import User
 
-from ambulance.models import AmbulanceStatus, AmbulanceCapability
-from hospital.models import EquipmentType
+from ambulance.models import Ambulance, AmbulanceUpdate, \
+    AmbulanceStatus, AmbulanceCapability
+from ambulance.serializers import AmbulanceSerializer
+from hospital.models import Hospital, EquipmentType
+from hospital.serializers import HospitalSerializer
+from emstrack.conditional import make_etag, not_modified, set_validators, \
+    conditional_response
 from emstrack.models import defaults
 
-from .models import TemporaryPassword
+from .models import Profile
+from .permissions import get_user, get_acl, get_permissions, acl_latency, \
+    auth_cache, auth_fingerprint, stats as cache_stats
+from .serializers import ExtendedProfileSerializer
+from .tokens import token_generator
 
 from .forms import MQTTAuthenticationForm, AuthenticationForm, SignupForm
 
@@ -57,6 +68,29 @@ class MQTTLoginView(CsrfExemptMixin,
     template_name = 'login/mqtt_login.html'
     form_class = MQTTAuthenticationForm
 
+    def post(self, request, *args, **kwargs):
+
+        username = request.POST.get('username')
+        password = request.POST.get('password')
+
+        # tokens are cheap to verify and can be revoked, do not cache
+        if not password or token_generator.is_token(password):
+            return super().post(request, *args, **kwargs)
+
+        # last successful login of user with same credentials?
+        key = ('login', username)
+        fingerprint = auth_fingerprint(username, password)
+        cached = auth_cache.get(key)
+        if cached is not None and hmac.compare_digest(cached, fingerprint):
+            return HttpResponse('OK')
+
+        generation = auth_cache.generation
+        response = super().post(request, *args, **kwargs)
+        if response.status_code == 200:
+            auth_cache.set(key, fingerprint, generation)
+
+        return response
+
     def form_invalid(self, form):
         return HttpResponseForbidden()
     
@@ -77,9 +111,18 @@ class MQTTSuperuserView(CsrfExemptMixin,
             data = request.POST
         elif hasattr(request, 'DATA'):
             data = request.DATA
+
+        # cached positive decision?
+        username = data.get('username')
+        key = ('superuser', username)
+        if auth_cache.get(key):
+            return HttpResponse('OK')
+
+        generation = auth_cache.generation
         try:
-            if User.objects.get(username=data.get('username'),
+            if User.objects.get(username=username,
                                 is_active=True).is_superuser:
+                auth_cache.set(key, True, generation)
                 return HttpResponse('OK')
             
         except User.DoesNotExist:
@@ -101,7 +144,17 @@ class MQTTAclView(CsrfExemptMixin,
             data = request.POST
         elif hasattr(request, 'DATA'):
             data = request.DATA
-        allow = False
+
+        with acl_latency.time():
+            allow = self.check(data)
+
+        if allow:
+            return HttpResponse('OK')
+
+        return HttpResponseForbidden()
+
+    @staticmethod
+    def check(data):
 
         # Check permissions
         username = data.get('username')
@@ -109,177 +162,60 @@ class MQTTAclView(CsrfExemptMixin,
         acc = int(data.get('acc')) # 1 == sub, 2 == pub
 
         # get topic and remove first '/'
-        topic = data.get('topic').split('/')
-        if len(topic) > 0 and topic[0] == '':
-            del topic[0]
+        topic = data.get('topic')
+        if topic.startswith('/'):
+            topic = topic[1:]
 
         try:
-            
+
             # get user
-            user = User.objects.get(username=data.get('username'),
-                                    is_active=True)
-
-            #print('topic = {}'.format(topic))
-            #print('user = {}'.format(user))
-            #print('user.hospitals = {}'.format(user.hospitals.all()))
-
-            if acc == 1:
-                
-                # permission to subscribe:
-
-                #  - settings
-                if (len(topic) == 1 and
-                    topic[0] == 'settings'):
-
-                    return HttpResponse('OK')
-                    
-                #  - user/{username}/error
-                #  - user/{username}/profile
-                elif (len(topic) == 3 and
-                    topic[0] == 'user' and
-                    topic[1] == user.username):
-
-                    if (topic[2] == 'profile' or
-                        topic[2] == 'error'):
-                        
-                        return HttpResponse('OK')
-
-                #  - hospital/{hospital-id}/data
-                #  - hospital/{hospital-id}/metadata
-                #  - hospital/{hospital-id}/equipment/+/data
-                elif (len(topic) >= 3 and
-                      topic[0] == 'hospital'):
-                    
-                    hospital_id = int(topic[1])
-                    #print('hospital_id = {}'.format(hospital_id))
-
-                    # is user authorized?
-                    try:
-                        
-                        perm = user.profile.hospitals.get(hospital=hospital_id)
-            
-                        if (perm.can_read and
-                            ((len(topic) == 3 and topic[2] == 'data') or
-                             (len(topic) == 3 and topic[2] == 'metadata') or
-                             (len(topic) == 5 and topic[2] == 'equipment'
-                                              and topic[4] == 'data'))):
-                        
-                            return HttpResponse('OK')
-
-                    except ObjectDoesNotExist:
-                        pass
-
-                #  - ambulance/{ambulance-id}/data
-                elif (len(topic) == 3 and
-                      topic[0] == 'ambulance' and
-                      topic[2] == 'data'):
-                    
-                    ambulance_id = int(topic[1])
-                    #print('ambulance_id = {}'.format(ambulance_id))
-
-                    # is user authorized?
-                    try:
-                        
-                        perm = user.profile.ambulances.get(ambulance=ambulance_id)
-            
-                        if perm.can_read:
-                        
-                            return HttpResponse('OK')
-
-                    except ObjectDoesNotExist:
-                        pass
-                    
-            elif acc == 2:
-                
-                # permission to publish:
-
-                if (len(topic) >= 3 and
-                    topic[0] == 'user' and
-                    topic[1] == user.username):
-
-                    #  - user/{username}/error
-                    if (len(topic) == 3 and
-                        topic[2] == 'error'):
-                        
-                        return HttpResponse('OK')
-                    
-                    #  - user/{username}/ambulance/{ambulance-id}/data
-                    elif (len(topic) == 5 and
-                        topic[2] == 'ambulance' and
-                        topic[4] == 'data'):
-
-                        ambulance_id = int(topic[3])
-                        #print('ambulance_id = {}'.format(ambulance_id))
-
-                        # is user authorized?
-                        try:
-                        
-                            perm = user.profile.ambulances.get(ambulance=ambulance_id)
-            
-                            if perm.can_write:
-                        
-                                return HttpResponse('OK')
-
-                        except ObjectDoesNotExist:
-                            pass
-
-                    #  - user/{username}/hospital/{hospital-id}/data
-                    #  - user/{username}/hospital/{hospital-id}/equipment/+/data
-                    elif ((len(topic) == 5 and
-                           topic[2] == 'hospital' and
-                           topic[4] == 'data') or
-                          (len(topic) == 7 and
-                           topic[2] == 'hospital' and
-                           topic[4] == 'equipment' and
-                           topic[6] == 'data')):
-
-                        hospital_id = int(topic[3])
-                        #print('hospital_id = {}'.format(hospital_id))
-
-                        # is user authorized?
-                        try:
-                        
-                            perm = user.profile.hospitals.get(hospital=hospital_id)
-            
-                            if perm.can_write:
-                        
-                                return HttpResponse('OK')
-
-                        except ObjectDoesNotExist:
-                            pass
-                        
-                    #  - user/{username}/client/{client-id}/status
-                    elif (len(topic) == 5 and
-                          topic[2] == 'client' and
-                          topic[4] == 'status' and
-                          topic[3] == client_id):
-
-                        return HttpResponse('OK')
-                        
+            user = get_user(username)
+            if not user.is_active:
+                return False
+
         except User.DoesNotExist:
-            pass
-        
-        return HttpResponseForbidden()
+            return False
+
+        # compiled and cached ACL
+        acl = get_acl(user)
+
+        if acc == 1:
+
+            # permission to subscribe:
+            #  - settings
+            #  - user/{username}/error
+            #  - user/{username}/profile
+            #  - hospital/{hospital-id}/data
+            #  - hospital/{hospital-id}/metadata
+            #  - hospital/{hospital-id}/equipment/+/data
+            #  - ambulance/{ambulance-id}/data
+            return acl.can_subscribe(topic)
+
+        elif acc == 2:
+
+            # permission to publish:
+            #  - user/{username}/error
+            #  - user/{username}/ambulance/{ambulance-id}/data
+            #  - user/{username}/ambulance/data
+            #  - user/{username}/hospital/{hospital-id}/data
+            #  - user/{username}/hospital/{hospital-id}/equipment/+/data
+            #  - user/{username}/client/{client-id}/status
+            return acl.can_publish(topic, client_id)
+
+        return False
 
 class PasswordView(APIView):
     """
     Retrieve password to use with MQTT.
     """
 
-    @staticmethod
-    def generate_password(size = 20,
-                          chars = (string.ascii_letters +
-                                   string.digits +
-                                   string.punctuation)):
-        return (''.join(random.choice(chars) for _ in range(size)))
-    
     def get(self, request, user__username = None):
         """
-        Generate temporary password if one does not exist or is invalid.
-        Stores password in the database and returns a hash. Users in 
-        possesion of this hash will be able to login through MQTT. 
-        Passwords are valid for 120 seconds. 
-        A new hash is however returned every time.
+        Generate temporary password. Users in possesion of this 
+        password will be able to login through MQTT. 
+        Passwords are signed tokens valid for settings.MQTT['TOKEN_TTL']
+        seconds, 120 by default. 
+        A new password is returned every time.
         """
 
         # retrieve current user
@@ -288,46 +224,29 @@ class PasswordView(APIView):
         # make sure user and username are the same
         if user.username != user__username:
             raise PermissionDenied()
-        
-        try:
-
-            # Retrieve current password
-            pwd = TemporaryPassword.objects.get(user = user.id)
-            password = pwd.password
-            valid_until = pwd.created_on + timedelta(seconds=120)
-
-            # Invalidate password if it is expired
-            if timezone.now() > valid_until:
-                password = None
-
-        except ObjectDoesNotExist:
 
-            pwd = None
-            password = None
+        # Return signed token
+        return Response(token_generator.make_token(user.username))
 
-        if password is None:
-            
-            # Generate password
-            password = self.generate_password()
-
-            if pwd is None:
-                
-                # create password
-                pwd = TemporaryPassword(user = user,
-                                        password = password)
-
-            else:
+class StatsView(APIView):
+    """
+    Retrieve cache and MQTT ACL statistics.
+    """
 
-                # update password
-                pwd.password = password
+    def get(self, request):
+        """
+        Retrieve hits and misses of the user, permission, ACL and MQTT
+        login caches and the latency of MQTT ACL checks. Statistics are
+        kept per process, pid identifies the process that answered.
+        Only superusers can retrieve statistics.
+        """
 
-            # save password
-            pwd.save()
+        if not request.user.is_superuser:
+            raise PermissionDenied()
 
-        # Return password hash
-        password_hash = make_password(password=password)
-            
-        return Response(password_hash)
+        stats = cache_stats()
+        stats['pid'] = os.getpid()
+        return Response(stats)
 
 class SettingsView(APIView):
     """
@@ -357,4 +276,84 @@ class SettingsView(APIView):
         Retrieve current settings and options.
         """
 
-        return Response(self.get_settings())
+        return conditional_response(request, self.get_settings())
+
+class BootstrapView(APIView):
+    """
+    Retrieve settings, profile, ambulances and hospitals in one request.
+
+    version is the largest AmbulanceUpdate id in the snapshot and is
+    only a hint for skipping ambulance deltas, whose seq is an
+    AmbulanceUpdate id:
+
+    - ids are assigned on insert, not on commit, so a transaction still
+      in flight when the snapshot is taken can commit an update with a
+      lower id later; clients must not drop a delta only because its seq
+      is not larger than version, but compare location_timestamp or
+      updated_on as well;
+    - seq is only sent on ambulance/{id}/delta, which is published when
+      settings.MQTT['DELTA'] is enabled, and there is no equivalent for
+      hospitals, whose retained topics should always be applied.
+    """
+
+    @method_decorator(gzip_page)
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def get_bootstrap(user):
+
+        # read all tables from the same snapshot, unless already
+        # inside a transaction
+        snapshot = (connection.vendor == 'postgresql' and
+                    not connection.in_atomic_block)
+
+        with transaction.atomic():
+
+            if snapshot:
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+            # ambulance updates committed after the snapshot usually have
+            # a larger seq, but not always, see above
+            version = AmbulanceUpdate.objects.aggregate(version=Max('id'))['version'] or 0
+
+            # only objects the user can read
+            ambulances = Ambulance.objects.all()
+            hospitals = Hospital.objects.all()
+            if not user.is_superuser:
+                permissions = get_permissions(user)
+                ambulances = ambulances.filter(id__in=sorted(permissions.can_read['ambulances']))
+                hospitals = hospitals.filter(id__in=sorted(permissions.can_read['hospitals']))
+
+            return {
+                'version': version,
+                'settings': SettingsView.get_settings(),
+                'profile': ExtendedProfileSerializer(Profile.objects.get(user=user)).data,
+                'ambulances': AmbulanceSerializer(ambulances, many=True).data,
+                'hospitals': HospitalSerializer(hospitals, many=True).data
+            }
+
+    def get(self, request, user__username = None):
+        """
+        Retrieve bootstrap snapshot. Ambulance deltas with a seq larger
+        than version were not included in the snapshot; deltas with a
+        smaller seq may still be newer, see BootstrapView.
+        """
+
+        # retrieve current user
+        user = request.user
+
+        # make sure user and username are the same
+        if user.username != user__username:
+            raise PermissionDenied()
+
+        content = JSONRenderer().render(self.get_bootstrap(user))
+        etag = make_etag(hashlib.sha1(content).hexdigest())
+
+        # not modified?
+        response = not_modified(request, etag)
+        if response is None:
+            response = HttpResponse(content, content_type='application/json')
+
+        return set_validators(response, etag)
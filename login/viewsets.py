@@ -4,7 +4,8 @@ from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, mixins, generics, filters, permissions
 from rest_framework.decorators import detail_route
 from rest_framework.permissions import IsAuthenticated
-from rest_framework.response import Response
+
+from emstrack.conditional import conditional_response
 
 from .models import Profile
 
@@ -38,5 +39,6 @@ class ProfileViewSet(viewsets.GenericViewSet):
         """
         Retrieve user's extended profile.
         """
-        return Response(ExtendedProfileSerializer(self.get_object()).data)
+        return conditional_response(request,
+                                    ExtendedProfileSerializer(self.get_object()).data)
     
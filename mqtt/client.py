@@ -1,5 +1,6 @@
 import logging
-import time, sys
+import time, sys, threading
+from collections import namedtuple, deque
 
 import paho.mqtt.client as mqtt
 
@@ -15,6 +16,25 @@ class MQTTException(Exception):
         super().__init__(message)
         self.value = value
 
+# Publish waiting for acknowledgement
+Inflight = namedtuple('Inflight', 'topic payload qos retain start context')
+
+# Flow control
+#
+# At most broker['MAX_INFLIGHT'] publishes are waiting for acknowledgement
+# at any time (0 means no limit). When the window is full, publish queues
+# the message and sends it as soon as an acknowledgement arrives, or, if
+# broker['INFLIGHT_BLOCK'] is set, blocks the caller for at most
+# broker['INFLIGHT_TIMEOUT'] seconds. Blocking must not be used from
+# paho's callbacks, which run on the thread that receives the
+# acknowledgements.
+#
+# Acknowledgements may arrive before client.publish returns. These are
+# recorded and matched when publish registers the message id, so no
+# assumption is made about the order of callbacks. The inflight lock is
+# never held while calling into paho, which holds its own lock when
+# calling on_publish.
+
 class BaseClient():
     
     # initialize client
@@ -26,7 +46,24 @@ class BaseClient():
         self.style = kwargs.pop('style', color_style())
         self.verbosity = kwargs.pop('verbosity', 1)
         self.debug = kwargs.pop('debug', False)
-        self.forgive_mid = False
+
+        # flow control
+        self.max_inflight = self.broker.get('MAX_INFLIGHT', 0)
+        self.inflight_block = self.broker.get('INFLIGHT_BLOCK', False)
+        self.inflight_timeout = self.broker.get('INFLIGHT_TIMEOUT', 60)
+        self.inflight_lock = threading.Condition()
+        self.reserved = 0
+        self.acked = {}
+        self.backlog = deque()
+
+        # counters
+        self.counters = {
+            'published': 0,
+            'acknowledged': 0,
+            'queued': 0,
+            'blocked': 0
+        }
+        self.latency = {}
         
         if self.broker['CLIENT_ID']:
             self.client = mqtt.Client(self.broker['CLIENT_ID'],
@@ -65,7 +102,8 @@ class BaseClient():
                             self.broker['KEEPALIVE'])
 
     def done(self):
-        return len(self.published) == 0 and len(self.subscribed) == 0
+        return (len(self.published) == 0 and len(self.backlog) == 0 and
+                len(self.subscribed) == 0)
         
     def on_connect(self, client, userdata, flags, rc):
         
@@ -84,35 +122,64 @@ class BaseClient():
     def on_message(self, client, userdata, msg):
         pass
 
-    def publish(self, topic, payload = None, qos = 0, retain = False):
+    def publish(self, topic, payload = None, qos = 0, retain = False,
+                context = None):
+        """
+        Publish to topic. Returns the message id or None if the message
+        was queued because the inflight window is full. context is
+        passed to on_acknowledge.
+        """
 
-        # NOTE: The whole forgive mid thing is necessary because
-        # on_publish was getting called before publish ended
-        # forgive mid if qos = 0
-        if qos == 0:
-            self.forgive_mid = True
-        
-        # try to publish
-        result = self.client.publish(topic, payload, qos, retain)
-        if result.rc:
-            raise MQTTException('Could not publish to topic (rc = {})'.format(result.rc),
-                                result.rc)
-
-        if qos != 0:
-            # add to dictionary of published
-            self.published[result.mid] = (topic, payload, qos, retain)
-        else:
+        with self.inflight_lock:
+
+            # inflight window full?
+            if self.max_inflight and (self.backlog or
+                                      self.reserved >= self.max_inflight):
+
+                if not self.inflight_block:
+                    # queue until there is room
+                    self.backlog.append((topic, payload, qos, retain, context))
+                    self.counters['queued'] += 1
+                    return None
+
+                # wait until there is room
+                self.counters['blocked'] += 1
+                if not self.inflight_lock.wait_for(lambda: self.reserved < self.max_inflight,
+                                                   self.inflight_timeout):
+                    raise MQTTException('Timed out waiting for inflight window',
+                                        self.reserved)
+
+            # reserve slot
+            self.reserved += 1
 
-            # reset forgive_mid
-            self.forgive_mid = False
+        return self.send_publish(topic, payload, qos, retain, context)
 
-            # on_published already called?
-            if result.mid in self.published:
-                if self.published.pop(result.mid) is not None:
-                    raise MQTTException('Cannot make sense of mid', result.mid)
-            else:
-                # add to dictionary of published
-                self.published[result.mid] = (topic, payload, qos, retain)
+    def send_publish(self, topic, payload, qos, retain, context):
+
+        # try to publish
+        start = time.monotonic()
+        try:
+            result = self.client.publish(topic, payload, qos, retain)
+            if result.rc:
+                raise MQTTException('Could not publish to topic (rc = {})'.format(result.rc),
+                                    result.rc)
+        except Exception:
+            # release slot
+            with self.inflight_lock:
+                self.reserved -= 1
+                self.inflight_lock.notify_all()
+            raise
+
+        # add to dictionary of published unless already acknowledged
+        entry = Inflight(topic, payload, qos, retain, start, context)
+        with self.inflight_lock:
+            self.counters['published'] += 1
+            acked = self.acked.pop(result.mid, None)
+            if acked is None:
+                self.published[result.mid] = entry
+
+        if acked is not None:
+            self.acknowledge(result.mid, entry, acked)
 
         # debug? 
         if self.debug:
@@ -122,22 +189,107 @@ class BaseClient():
                                                        payload,
                                                        qos,
                                                        retain))
+
+        return result.mid
             
     def on_publish(self, client, userdata, mid):
 
         # debug? 
         if self.debug:
             logger.debug("Published mid={}".format(mid))
-            
-        if mid in self.published:
-            # TODO: check granted_qos?
-            # remove from list of subscribed
-            del self.published[mid]
 
-        else:
-            self.published[mid] = None
-            if not self.forgive_mid:
-                raise MQTTException('Unknown publish mid', mid)
+        now = time.monotonic()
+        with self.inflight_lock:
+            entry = self.published.pop(mid, None)
+            if entry is None:
+
+                # acknowledged before publish returned
+                self.acked[mid] = now
+
+                # forget acknowledgements that were never matched, so
+                # that they cannot match a reused message id
+                horizon = now - self.inflight_timeout
+                for k in [k for k, t in self.acked.items() if t < horizon]:
+                    del self.acked[k]
+
+        if entry is not None:
+            self.acknowledge(mid, entry, now)
+
+    def acknowledge(self, mid, entry, now):
+
+        with self.inflight_lock:
+
+            # release slot
+            self.reserved -= 1
+            self.inflight_lock.notify_all()
+
+            # update counters
+            self.counters['acknowledged'] += 1
+            latency = self.latency.get(entry.topic)
+            if latency is None:
+                latency = self.latency[entry.topic] = {'count': 0, 'total': 0., 'max': 0.}
+            elapsed = now - entry.start
+            latency['count'] += 1
+            latency['total'] += elapsed
+            latency['max'] = max(latency['max'], elapsed)
+
+            # take queued messages
+            backlog = self.take_backlog()
+
+        self.on_acknowledge(mid, entry)
+
+        self.send_backlog(backlog)
+
+    def take_backlog(self):
+
+        # reserve slots for queued messages, call with inflight lock held
+        backlog = []
+        while self.backlog and self.reserved < self.max_inflight:
+            backlog.append(self.backlog.popleft())
+            self.reserved += 1
+        return backlog
+
+    def send_backlog(self, backlog):
+
+        for message in backlog:
+            try:
+                self.send_publish(*message)
+            except MQTTException as e:
+                logger.warning("mqtt.BaseClient: could not publish to '{}', exception = {}".format(message[0], e))
+
+    def on_acknowledge(self, mid, entry):
+        pass
+
+    def reset_inflight(self):
+        """
+        Forget publishes waiting for acknowledgement, for example after
+        reconnecting with a clean session.
+        """
+
+        with self.inflight_lock:
+            self.reserved -= len(self.published)
+            self.published.clear()
+            self.acked.clear()
+            self.inflight_lock.notify_all()
+
+            # no acknowledgement will release these, send now
+            backlog = self.take_backlog()
+
+        self.send_backlog(backlog)
+
+    def stats(self):
+
+        with self.inflight_lock:
+            stats = dict(self.counters)
+            stats.update({
+                'inflight': len(self.published),
+                'backlog': len(self.backlog),
+                'latency': {topic: {'count': latency['count'],
+                                    'mean': latency['total'] / latency['count'],
+                                    'max': latency['max']}
+                            for topic, latency in self.latency.items()}
+            })
+            return stats
 
     def subscribe(self, topic, qos = 0):
 
@@ -0,0 +1,203 @@
+import logging
+import threading
+
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from drf_extra_fields.geo_fields import PointField
+
+from ambulance.models import Ambulance, AmbulanceUpdate
+
+from login.permissions import get_write_permissions
+
+from .codec import get_codec
+
+logger = logging.getLogger(__name__)
+
+# fields that can be collapsed into the latest update
+LOCATION_FIELDS = frozenset(('location', 'location_timestamp', 'orientation'))
+
+# PendingMessage
+
+class PendingMessage():
+
+    def __init__(self, client, userdata, msg):
+
+        self.client = client
+        self.userdata = userdata
+        self.msg = msg
+        self.data = None
+        self.timestamp = None
+
+        try:
+            data = get_codec().decode(msg.payload)
+        except Exception:
+            # let the handler report the error
+            return
+
+        # only pure location updates can be collapsed
+        if (isinstance(data, dict) and data and
+            'location_timestamp' in data and
+            LOCATION_FIELDS.issuperset(data.keys())):
+
+            self.timestamp = parse_datetime(str(data['location_timestamp']))
+            if self.timestamp is not None:
+                self.data = data
+
+    @property
+    def droppable(self):
+        return self.data is not None
+
+# Coalescer
+
+class Coalescer():
+
+    """
+    Collapse pending ambulance location updates.
+
+    Messages are held for up to `window` seconds. Consecutive location
+    updates for the same ambulance are collapsed into the one with the
+    latest location_timestamp; any other message, for example a status
+    change, is always forwarded and in order. If `history` is set the
+    collapsed updates are still recorded in AmbulanceUpdate in bulk.
+    """
+
+    def __init__(self, handler, window, history = False):
+
+        self.handler = handler
+        self.window = window
+        self.history = history
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.stale = []
+
+        # counters
+        self.received = 0
+        self.forwarded = 0
+        self.dropped = 0
+
+        # start flushing thread
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(name='mqtt_coalescer',
+                                       target=self.run,
+                                       daemon=True)
+        self.thread.start()
+
+    def add(self, key, client, userdata, msg):
+
+        message = PendingMessage(client, userdata, msg)
+
+        with self.lock:
+
+            self.received += 1
+            messages = self.pending.setdefault(key, [])
+
+            if message.droppable and messages and messages[-1].droppable:
+
+                try:
+                    newer = message.timestamp >= messages[-1].timestamp
+                except TypeError:
+                    # cannot compare naive and aware timestamps
+                    messages.append(message)
+                    return
+
+                # collapse with last pending location update
+                self.dropped += 1
+                if newer:
+                    self.stale.append(messages[-1])
+                    messages[-1] = message
+                else:
+                    self.stale.append(message)
+
+            else:
+                messages.append(message)
+
+    def callback(self, client, userdata, msg):
+        # key on ambulance id in 'user/{username}/ambulance/{id}/data'
+        self.add(msg.topic.split('/')[3], client, userdata, msg)
+
+    def flush(self):
+
+        # swap pending messages
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            stale, self.stale = self.stale, []
+
+        # forward messages
+        for messages in pending.values():
+            for message in messages:
+                self.forwarded += 1
+                self.handler(message.client, message.userdata, message.msg)
+
+        # save collapsed updates to history
+        if self.history and stale:
+            try:
+                self.save_history(stale)
+            except Exception as e:
+                logger.warning('mqtt.Coalescer: could not save history, exception = {}'.format(e))
+
+    def save_history(self, messages):
+
+        # parse topics
+        updates = []
+        for message in messages:
+            values = message.msg.topic.split('/')
+            updates.append((values[1], values[3], message.data))
+
+        # retrieve users and ambulances in bulk
+        users = {u.username: u
+                 for u in User.objects.filter(username__in={u[0] for u in updates})}
+        ambulances = Ambulance.objects.in_bulk([int(u[1]) for u in updates
+                                                if u[1].isdigit()])
+
+        location_field = PointField()
+        objs = []
+        for username, ambulance_id, data in updates:
+
+            user = users.get(username)
+            ambulance = ambulances.get(int(ambulance_id)) if ambulance_id.isdigit() else None
+            if user is None or ambulance is None:
+                continue
+
+            # check credentials
+            if not get_write_permissions(user).check_can_write(ambulance=ambulance.id):
+                continue
+
+            try:
+                location = location_field.to_internal_value(data['location'])
+            except Exception:
+                continue
+
+            objs.append(AmbulanceUpdate(ambulance=ambulance,
+                                        status=ambulance.status,
+                                        orientation=data.get('orientation', ambulance.orientation),
+                                        location=location,
+                                        location_timestamp=parse_datetime(str(data['location_timestamp'])),
+                                        comment=ambulance.comment,
+                                        updated_by=user,
+                                        updated_on=timezone.now()))
+
+        AmbulanceUpdate.objects.bulk_create(objs)
+
+    def run(self):
+        while not self.stopped.wait(self.window):
+            close_old_connections()
+            self.flush()
+
+    def stop(self):
+
+        # stop thread then flush what is left
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'forwarded': self.forwarded,
+            'dropped': self.dropped,
+            'pending': sum(len(m) for m in self.pending.values())
+        }
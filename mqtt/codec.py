@@ -0,0 +1,101 @@
+import logging
+import decimal, importlib
+from io import BytesIO
+
+from django.utils.functional import Promise
+
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+logger = logging.getLogger(__name__)
+
+# JSONCodec
+
+class JSONCodec():
+
+    """
+    Encode and decode MQTT payloads using Django REST Framework.
+    """
+
+    name = 'json'
+
+    def encode(self, data):
+        return JSONRenderer().render(data)
+
+    def decode(self, payload):
+        return JSONParser().parse(BytesIO(payload))
+
+# ORJSONCodec
+
+def orjson_default(obj):
+
+    # same conversions as rest_framework's JSONEncoder
+    if isinstance(obj, Promise):
+        return str(obj)
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, bytes):
+        return obj.decode()
+    elif hasattr(obj, 'tolist'):
+        return obj.tolist()
+    elif hasattr(obj, '__getitem__'):
+        try:
+            return dict(obj)
+        except Exception:
+            pass
+    elif hasattr(obj, '__iter__'):
+        return list(obj)
+    raise TypeError
+
+class ORJSONCodec():
+
+    """
+    Encode and decode MQTT payloads using orjson.
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def encode(self, data):
+        return self.orjson.dumps(data, default=orjson_default)
+
+    def decode(self, payload):
+        return self.orjson.loads(payload)
+
+CODECS = {
+    JSONCodec.name: JSONCodec,
+    ORJSONCodec.name: ORJSONCodec
+}
+
+def load_codec(name):
+
+    # registered codec or dotted path to codec class
+    if name in CODECS:
+        cls = CODECS[name]
+    else:
+        module, _, cls = name.rpartition('.')
+        cls = getattr(importlib.import_module(module), cls)
+
+    try:
+        return cls()
+    except ImportError as e:
+        logger.warning("mqtt.codec: could not load codec '{}', using '{}' instead, exception = {}".format(name,
+                                                                                                        JSONCodec.name,
+                                                                                                        e))
+        return JSONCodec()
+
+_codec = None
+
+def get_codec():
+    """
+    Return the codec selected by settings.MQTT['CODEC'].
+    """
+
+    global _codec
+    if _codec is None:
+        from django.conf import settings
+        _codec = load_codec(getattr(settings, 'MQTT', {}).get('CODEC', JSONCodec.name))
+    return _codec
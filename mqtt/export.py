@@ -0,0 +1,298 @@
+import logging
+import fcntl, os, signal, tempfile, threading, weakref
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from login.models import AmbulancePermission, HospitalPermission
+
+logger = logging.getLogger(__name__)
+
+# Export of broker credentials and ACLs
+#
+# Writes a password file and an ACL file in the format used by the
+# files backend of mosquitto-auth-plug, so that the broker can check
+# credentials and ACLs without calling MQTTLoginView and MQTTAclView.
+# The ACLs are the same as the ones enforced by MQTTAclView:
+# superusers can read and write every topic, and other users the topics
+# allowed by their ambulance and hospital permissions.
+#
+# Files are always regenerated from the database, while holding an
+# exclusive lock on '<file>.lock', so that processes exporting at the
+# same time cannot overwrite newer entries with ones they read earlier.
+# Files are replaced atomically and, if a pid file is given, the broker
+# is sent SIGHUP to reload them. If settings.MQTT['EXPORT'] is set,
+# the files are regenerated when users or permissions change, once per
+# transaction, on the thread that commits it.
+#
+# Every export reads all active users and their permissions, at a cost
+# that grows with the number of users. Regenerating only the entries of
+# the users that changed was dropped: entries read by different processes
+# at different times cannot be merged safely. Each committed transaction
+# that changed users or permissions counts as a request, and an export
+# that started loading after a request was counted covers it, so
+# concurrent commits in a process share exports without missing changes.
+#
+# The password file holds the hashes of the users' account passwords.
+# The temporary MQTT passwords returned by PasswordView are not in it,
+# so clients logging in with those need the http backend as a fallback,
+# e.g. 'auth_opt_backends files,http'.
+
+# topics allowed to all users
+ACL_PATTERNS = ('pattern read settings',
+                'pattern read user/%u/profile',
+                'pattern readwrite user/%u/error',
+                'pattern write user/%u/client/%c/status')
+
+def write_atomic(path, content):
+    """
+    Replace file at path with content. Returns False if unchanged.
+    """
+
+    try:
+        with open(path) as file:
+            if file.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # write to a unique temporary file in the same directory then replace
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            # mkstemp creates files readable by the owner only
+            os.fchmod(file.fileno(), 0o644)
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return True
+
+def signal_broker(pid_file):
+    """
+    Ask broker to reload its configuration.
+    """
+
+    try:
+        with open(pid_file) as file:
+            pid = int(file.read().strip())
+        os.kill(pid, signal.SIGHUP)
+        return True
+
+    except (OSError, ValueError) as e:
+        logger.warning("mqtt.export: could not signal broker with pid file '{}', exception = {}".format(pid_file, e))
+        return False
+
+def is_topic_level(value):
+    # cannot be used in a topic without acting as a wildcard
+    return not any(c in value for c in '/+#')
+
+class Exporter():
+
+    """
+    Writes the password and ACL entries of every active user to files.
+    """
+
+    def __init__(self, acl_file = None, password_file = None, pid_file = None,
+                 superusers_only = False):
+
+        self.acl_file = acl_file
+        self.password_file = password_file
+        self.pid_file = pid_file
+        self.superusers_only = superusers_only
+
+        # serializes exports
+        self.lock = threading.Lock()
+
+        # committed requests and requests covered by the last load
+        self.generation_lock = threading.Lock()
+        self.requested = 0
+        self.loaded = 0
+
+        # callback pending in the current transaction of each thread
+        self.local = threading.local()
+
+    @staticmethod
+    def password_entry(user):
+
+        # only pbkdf2 hashes are understood by the broker
+        if not user.password.startswith('pbkdf2_'):
+            return None
+
+        return '{}:{}'.format(user.username,
+                              user.password.replace('pbkdf2_', 'PBKDF2$', 1))
+
+    @staticmethod
+    def acl_entry(user, ambulances, hospitals):
+
+        lines = ['user {}'.format(user.username)]
+
+        # superusers
+        if user.is_superuser:
+            lines.append('topic readwrite #')
+            return '\n'.join(lines)
+
+        can_write = is_topic_level(user.username)
+        if not can_write:
+            logger.warning("mqtt.export: username '{}' cannot be used in topics, exporting read permissions only".format(user.username))
+
+        for id, can_read_, can_write_ in sorted(hospitals):
+            if can_read_:
+                lines.append('topic read hospital/{}/data'.format(id))
+                lines.append('topic read hospital/{}/metadata'.format(id))
+                lines.append('topic read hospital/{}/equipment/+/data'.format(id))
+            if can_write_ and can_write:
+                lines.append('topic write user/{}/hospital/{}/data'.format(user.username, id))
+                lines.append('topic write user/{}/hospital/{}/equipment/+/data'.format(user.username, id))
+
+        for id, can_read_, can_write_ in sorted(ambulances):
+            if can_read_:
+                lines.append('topic read ambulance/{}/data'.format(id))
+            if can_write_ and can_write:
+                lines.append('topic write user/{}/ambulance/{}/data'.format(user.username, id))
+
+        # bulk updates, each update is checked when processed
+        if can_write and any(can_write_ for id, can_read_, can_write_ in ambulances):
+            lines.append('topic write user/{}/ambulance/data'.format(user.username))
+
+        return '\n'.join(lines)
+
+    def load(self):
+        """
+        Compute entries of all users.
+        """
+
+        users = User.objects.filter(is_active=True)
+        if self.superusers_only:
+            users = users.filter(is_superuser=True)
+
+        # permissions of all users in two queries
+        ambulances = {}
+        for user_id, id, can_read, can_write in \
+            AmbulancePermission.objects.filter(profile__user__in=users) \
+                                       .values_list('profile__user_id', 'ambulance_id',
+                                                    'can_read', 'can_write'):
+            ambulances.setdefault(user_id, []).append((id, can_read, can_write))
+
+        hospitals = {}
+        for user_id, id, can_read, can_write in \
+            HospitalPermission.objects.filter(profile__user__in=users) \
+                                      .values_list('profile__user_id', 'hospital_id',
+                                                   'can_read', 'can_write'):
+            hospitals.setdefault(user_id, []).append((id, can_read, can_write))
+
+        entries = {}
+        for user in users.iterator():
+            entries[user.id] = (user.username,
+                                self.acl_entry(user,
+                                               ambulances.get(user.id, ()),
+                                               hospitals.get(user.id, ())),
+                                self.password_entry(user))
+
+        return entries
+
+    def lock_file(self):
+
+        # lock shared with other processes exporting the same files
+        path = (self.acl_file or self.password_file) + '.lock'
+        file = open(path, 'a')
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        return file
+
+    def export(self, generation = None):
+        """
+        Write files from the database and signal broker if anything
+        changed. If generation is given, skip the export if a load that
+        started after request generation was counted already covered it.
+        """
+
+        if not (self.acl_file or self.password_file):
+            return False
+
+        with self.lock:
+
+            if generation is not None and self.loaded >= generation:
+                return False
+
+            with self.lock_file():
+
+                # every request counted so far committed before this load
+                with self.generation_lock:
+                    requested = self.requested
+
+                # read under the lock, so that the last to write read last
+                entries = sorted(self.load().values())
+
+                changed = False
+                if self.acl_file:
+                    content = '\n\n'.join(('\n'.join(ACL_PATTERNS),) +
+                                          tuple(acl for username, acl, password in entries))
+                    changed = write_atomic(self.acl_file, content + '\n') or changed
+                if self.password_file:
+                    content = ''.join(password + '\n' for username, acl, password in entries
+                                      if password is not None)
+                    changed = write_atomic(self.password_file, content) or changed
+
+                self.loaded = requested
+
+        if changed and self.pid_file:
+            signal_broker(self.pid_file)
+
+        return changed
+
+    def schedule(self):
+        """
+        Export once the current transaction commits.
+        """
+
+        # Django drops the callback if the transaction is rolled back,
+        # which releases it through the weak reference
+        callback = getattr(self.local, 'callback', None)
+        if callback is not None and callback() is not None:
+            return
+
+        def flush():
+            self.flush()
+
+        self.local.callback = weakref.ref(flush)
+        transaction.on_commit(flush)
+
+    def flush(self):
+        """
+        Export changes committed by a transaction.
+        """
+
+        with self.generation_lock:
+            self.requested += 1
+            generation = self.requested
+
+        try:
+            self.export(generation)
+        except Exception as e:
+            logger.warning("mqtt.export: could not export, exception = {}".format(e))
+
+_exporter = None
+
+def get_exporter():
+    """
+    Return the exporter configured by settings.MQTT['EXPORT'] or None.
+    """
+
+    global _exporter
+    if _exporter is None:
+        export = getattr(settings, 'MQTT', {}).get('EXPORT')
+        if not export:
+            return None
+        _exporter = Exporter(acl_file=export.get('ACL_FILE'),
+                             password_file=export.get('PASSWORD_FILE'),
+                             pid_file=export.get('PID_FILE'))
+    return _exporter
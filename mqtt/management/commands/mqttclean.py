@@ -1,12 +1,52 @@
 import time
 from datetime import timedelta
 
+import paho.mqtt.client as mqtt
+
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.utils import timezone
 
 from mqtt.publish import PublishClient
 
+from django.contrib.auth.models import User
+
+from ambulance.models import Ambulance
+
+from hospital.models import Hospital, HospitalEquipment
+
+# Retained topics published by the application
+OWNED_TOPICS = ('settings',
+                'ambulance/+/data',
+                'hospital/+/data',
+                'hospital/+/metadata',
+                'hospital/+/equipment/+/data',
+                'user/+/profile')
+
+def expected_topics():
+    """
+    Retained topics that should exist according to the database.
+    """
+
+    topics = {'settings'}
+
+    for id in Ambulance.objects.values_list('id', flat=True).iterator():
+        topics.add('ambulance/{}/data'.format(id))
+
+    for id in Hospital.objects.values_list('id', flat=True).iterator():
+        topics.add('hospital/{}/data'.format(id))
+        topics.add('hospital/{}/metadata'.format(id))
+
+    for id, name in HospitalEquipment.objects.values_list('hospital_id',
+                                                          'equipment__name').iterator():
+        topics.add('hospital/{}/equipment/{}/data'.format(id, name))
+
+    for username in User.objects.filter(profile__isnull=False) \
+                                .values_list('username', flat=True).iterator():
+        topics.add('user/{}/profile'.format(username))
+
+    return topics
+
 class Client(PublishClient):
 
     def __init__(self, broker, **kwargs):
@@ -16,14 +56,27 @@ class Client(PublishClient):
         self.timeout = kwargs.pop('timeout', 10)
         self.last_activity = timezone.now()
 
+        # compare with database?
+        self.expected = kwargs.pop('expected', None)
+        self.sentinel = None
+        self.snapshot_done = False
+        self.orphans = []
+        self.received = 0
+        self.removed = 0
+
         # add / if necessary
         if self.base_topic and self.base_topic[-1] != '/':
             self.base_topic += '/'
-        
+
         # call super
         super().__init__(broker, **kwargs)
 
     def done(self):
+
+        # retained snapshot received and removals acknowledged?
+        if self.expected is not None:
+            return self.snapshot_done and super().done()
+
         return (timezone.now() > (self.last_activity +
                                   timedelta(seconds=self.timeout)) and
                 super().done())
@@ -32,9 +85,19 @@ class Client(PublishClient):
 
         # start loop
         self.loop_start()
-        
+
+        if self.expected is not None:
+
+            # wait for end of retained snapshot, at most timeout
+            start = time.monotonic()
+            while not self.done() and time.monotonic() - start < self.timeout:
+                time.sleep(0.01)
+
+            if not self.done():
+                self.stdout.write(self.style.ERROR("<< Timed out waiting for retained topics"))
+
         # are we done yet?
-        while not self.done():
+        while self.expected is None and not self.done():
 
             # wait at least until timeout
             remaining = (self.last_activity +
@@ -45,16 +108,19 @@ class Client(PublishClient):
             if remaining.total_seconds() > 0:
                 if self.verbosity > 0:
                     self.stdout.write(self.style.SUCCESS(">> Waiting for messages. Please be patient."))
-                
+
                 time.sleep(remaining.total_seconds())
 
         # stop loop
         self.loop_stop()
 
         if self.verbosity > 0:
+            if self.expected is not None:
+                self.stdout.write(self.style.SUCCESS("<< Received {} retained topics, removed {}.".format(self.received,
+                                                                                                           self.removed)))
             self.stdout.write(self.style.SUCCESS("<< Finished cleaning MQTT topics '{}'.".format(self.base_topic + '#')))
 
-        
+
     def on_connect(self, client, userdata, flags, rc):
 
         # is connected?
@@ -64,33 +130,90 @@ class Client(PublishClient):
         # subscribe to all topics descending from base topic
         self.subscribe(self.base_topic + '#')
 
+        # the sentinel is delivered after the retained snapshot
+        if self.expected is not None:
+            self.sentinel = 'mqttclean/{}/sentinel'.format(self.broker['CLIENT_ID'])
+            self.subscribe(self.sentinel, qos=1)
+
         if self.verbosity > 0:
             self.stdout.write(self.style.SUCCESS(">> Listening to MQTT topics '{}'...".format(self.base_topic + '#')))
 
         # last activity
         self.last_activity = timezone.now()
-        
+
+        return True
+
+    def on_subscribe(self, client, userdata, mid, granted_qos):
+
+        # call super
+        super().on_subscribe(client, userdata, mid, granted_qos)
+
+        # publish sentinel once subscribed
+        if self.sentinel is not None and not self.subscribed:
+            self.publish(self.sentinel, 'done', qos=1)
+
+    def is_orphan(self, topic):
+
+        if self.expected is None:
+            return True
+
+        # only topics published by the application that no longer exist
+        return (topic not in self.expected and
+                any(mqtt.topic_matches_sub(sub, topic) for sub in OWNED_TOPICS))
+
+    def remove_orphan(self, topic):
+
+        # delete topic
+        self.remove_topic(topic)
+        self.removed += 1
+
+        if self.verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(" > Removing topic '{}'".format(topic)))
+
+    def remove_orphans(self):
+
+        # objects created since expected was read must keep their topics
+        expected = expected_topics()
+        for topic in self.orphans:
+            if topic not in expected:
+                self.remove_orphan(topic)
+        self.orphans = []
+
     def on_message(self, client, userdata, msg):
 
+        # end of retained snapshot?
+        if msg.topic == self.sentinel:
+            self.remove_orphans()
+            self.snapshot_done = True
+            return
+
         # retained?
         if msg.retain:
 
-            # delete topic
-            self.remove_topic(msg.topic)
-            
+            self.received += 1
+
+            if self.is_orphan(msg.topic):
+
+                # compared with the database again at the end of the snapshot
+                if self.expected is not None:
+                    self.orphans.append(msg.topic)
+                else:
+                    self.remove_orphan(msg.topic)
+
             # last activity
             self.last_activity = timezone.now()
-                
-            if self.verbosity > 0:
-                self.stdout.write(self.style.SUCCESS(" > Removing topic '{}'".format(msg.topic)))
-                
-            
+
+
 class Command(BaseCommand):
     help = 'Remove retained topics from the mqtt broker'
 
     def add_arguments(self, parser):
         parser.add_argument('--base-topic', nargs='?', default='')
         parser.add_argument('--timeout', nargs='?', type=int, default=10)
+        parser.add_argument('--db', action='store_true', default=False,
+                            help='Only remove topics that do not exist in the database and stop as soon as all retained topics are received')
+        parser.add_argument('--max-inflight', type=int, default=100,
+                            help='Maximum number of removals waiting for acknowledgement')
 
     def handle(self, *args, **options):
 
@@ -104,13 +227,18 @@ class Command(BaseCommand):
         }
         broker.update(settings.MQTT)
         broker['CLIENT_ID'] = 'mqttclean_' + str(os.getpid())
+        broker['MAX_INFLIGHT'] = options['max_inflight']
+
+        base_topic = options['base_topic']
+        timeout = options['timeout']
+
+        # expected topics
+        expected = expected_topics() if options['db'] else None
 
-        base_topic = options['base_topic'] 
-        timeout = options['timeout'] 
-        
         client = Client(broker,
                         base_topic = base_topic,
                         timeout = timeout,
+                        expected = expected,
                         stdout = self.stdout,
                         style = self.style,
                         verbosity = options['verbosity'])
@@ -9,9 +9,21 @@ class Command(BaseCommand):
     
     help = 'Connect to the mqtt broker'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', nargs='?', type=int, default=None,
+                            help='number of worker threads, 0 to process messages in the network thread')
+        parser.add_argument('--max-queue-size', nargs='?', type=int, default=None,
+                            help='maximum number of messages queued per worker, 0 for unbounded')
+        parser.add_argument('--group', nargs='?', default=None,
+                            help='join shared subscription group to load-balance messages among clients')
+        parser.add_argument('--coalesce', nargs='?', type=float, default=None,
+                            help='window in seconds for collapsing ambulance location updates, 0 to disable')
+        parser.add_argument('--coalesce-history', action='store_true', default=None,
+                            help='save collapsed ambulance location updates to history')
+
     def handle(self, *args, **options):
 
-        import os
+        import os, socket
         
         broker = {
             'USERNAME': '',
@@ -23,8 +35,26 @@ class Command(BaseCommand):
             'CLEAN_SESSION': True
         }
         broker.update(settings.MQTT)
+
+        # shared subscription group
+        if options['group'] is not None:
+            broker['SHARED_GROUP'] = options['group']
+
+        # client ids must be unique across hosts in a shared group
+        if broker.get('SHARED_GROUP'):
+            broker['CLIENT_ID'] = broker['CLIENT_ID'] + '_' + socket.gethostname()
         broker['CLIENT_ID'] = broker['CLIENT_ID'] + '_' + str(os.getpid())
 
+        # override workers
+        if options['workers'] is not None:
+            broker['WORKERS'] = options['workers']
+        if options['max_queue_size'] is not None:
+            broker['MAX_QUEUE_SIZE'] = options['max_queue_size']
+        if options['coalesce'] is not None:
+            broker['COALESCE'] = options['coalesce']
+        if options['coalesce_history'] is not None:
+            broker['COALESCE_HISTORY'] = options['coalesce_history']
+
         client = SubscribeClient(broker,
                                  stdout = self.stdout,
                                  style = self.style,
@@ -43,3 +73,23 @@ class Command(BaseCommand):
 
         finally:
             client.disconnect()
+
+            # report worker statistics
+            stats = client.stats()
+            if options['verbosity'] > 0:
+                for name, cache in stats['cache'].items():
+                    if 'hits' not in cache:
+                        continue
+                    self.stdout.write(" > {} cache: hits = {}, misses = {}".format(name,
+                                                                                  cache['hits'],
+                                                                                  cache['misses']))
+            if options['verbosity'] > 0:
+                self.stdout.write(" > publish: published = {published}, acknowledged = {acknowledged}, queued = {queued}, inflight = {inflight}".format(**stats['publish']))
+            if 'coalescer' in stats and options['verbosity'] > 0:
+                self.stdout.write(" > coalescer: received = {received}, forwarded = {forwarded}, dropped = {dropped}".format(**stats['coalescer']))
+            if 'workers' in stats and options['verbosity'] > 0:
+                for k, worker in enumerate(stats['workers']):
+                    self.stdout.write(" > worker {}: processed = {}, errors = {}, rate = {:.1f}/s".format(k,
+                                                                                                          worker['processed'],
+                                                                                                          worker['errors'],
+                                                                                                          worker['rate']))
@@ -1,27 +1,33 @@
-from django.contrib.auth import get_user_model
-
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 
-from django.contrib.auth.models import User
+from mqtt.export import Exporter
 
 class Command(BaseCommand):
 
-    help = 'Create mqtt pwfile'
+    help = 'Create mqtt pwfile and acl file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--password-file', default='pwfile',
+                            help='Password file (default pwfile)')
+        parser.add_argument('--acl-file', default=None,
+                            help='ACL file, not written if omitted')
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Export all active users, not only superusers')
+        parser.add_argument('--pid-file', default=None,
+                            help='Broker pid file, broker is sent SIGHUP if files changed')
 
     def handle(self, *args, **options):
 
         if options['verbosity'] >= 1:
             self.stdout.write('Creating mosquitto-auth-plugin compatible pwfile')
 
-        with open('pwfile', 'w') as file:
-            
-            # Retrieve current users
-            for u in User.objects.filter(is_superuser=True):
-                file.write('{}:{}\n'.format(u.username,
-                                            u.password.replace('pbkdf2_',
-                                                               'PBKDF2$',1)))
+        exporter = Exporter(acl_file=options['acl_file'],
+                            password_file=options['password_file'],
+                            pid_file=options['pid_file'],
+                            superusers_only=not options['all'])
+        changed = exporter.export()
         
         if options['verbosity'] >= 1:
             self.stdout.write(
-                self.style.SUCCESS("Done."))
+                self.style.SUCCESS("Done." if changed else "Done, no changes."))
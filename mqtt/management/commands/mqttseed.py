@@ -1,150 +1,354 @@
 # mqttseed application command
-from django.core.management.base import BaseCommand
-from django.conf import settings
-from django.utils.six import BytesIO
+import time, json, os, hashlib
+from datetime import timedelta
 
-from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
+from mqtt.client import MQTTException
 from mqtt.publish import PublishClient
-
-from django.contrib.auth.models import User
+from mqtt.workers import WorkerPool
 
 from login.models import Profile
-    
+from login.serializers import ExtendedProfileSerializer
+
 from ambulance.models import Ambulance
 
-from hospital.models import Hospital, HospitalEquipment
+from hospital.models import Hospital, HospitalEquipment, Equipment
+from hospital.serializers import EquipmentSerializer
+
+# Seeding pipeline
+#
+# Objects are read from the database in chunks ordered by primary key,
+# which keeps memory bounded and, unlike QuerySet.iterator(), honors
+# prefetch_related. Chunks are serialized and published by a WorkerPool
+# while the main thread reads the next chunk. Publishes block when the
+# inflight window (broker['MAX_INFLIGHT']) is full, so the seeder never
+# runs ahead of the broker.
+#
+# Incremental seeding
+#
+# The state file records when the last seed started, the watermark, and
+# a fingerprint of the payload published to each topic that cannot be
+# tracked by updated_on: profiles, which change with permissions, and
+# hospital metadata, which changes with equipment. A later seed only
+# republishes ambulances, hospitals and hospital equipment updated after
+# the watermark and profiles and metadata whose fingerprints changed.
+#
+# The watermark is the time the seed started minus broker['SEED_MARGIN']
+# seconds (default 300). updated_on is set before a row is committed, so a
+# transaction that commits after the seed read its table may carry an
+# updated_on older than the start of the seed. The margin, which must
+# exceed the longest transaction plus the clock skew between the web
+# servers and the seeder, makes the next seed pick these rows up; rows
+# updated within the margin are published again, which is harmless.
+
+WATERMARKS = ('ambulance', 'hospital', 'hospital_equipment')
+
+def load_state(path):
+
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except FileNotFoundError:
+        return None
+
+    return {
+        'watermarks': {k: parse_datetime(v) for k, v in state['watermarks'].items()},
+        'fingerprints': state['fingerprints']
+    }
+
+def save_state(path, state):
+
+    # write to temporary file then replace
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as file:
+        json.dump({
+            'watermarks': {k: v.isoformat() for k, v in state['watermarks'].items()},
+            'fingerprints': state['fingerprints']
+        }, file)
+    os.replace(tmp, path)
+
+def chunked(queryset, chunk_size):
+    """
+    Iterate over queryset in lists of at most chunk_size objects.
+    """
+
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        last = chunk[-1].pk
 
 class Client(PublishClient):
 
-    # The callback for when the client receives a CONNACK
-    # response from the server.
-    def on_connect(self, client, userdata, flags, rc):
-
-        # is connected?
-        if not super().on_connect(client, userdata, flags, rc):
-            return False
-
-        # initialize pubset
-        self.pubset = set()
-        self.can_disconnect = False
-
-        # Seed settings
-        self.seed_settings()
-        
-        # Seed hospitals
-        self.seed_hospital_data()
-        self.seed_hospital_equipment_data()
-        self.seed_hospital_metadata()
-
-        # Seed ambulances
-        self.seed_ambulance_data()
-
-        # Seed profiles
-        self.seed_profile_data()
-        
-        # Seed calls
-        # self.seed_calls()
-
-        # Good to disconnect
-        self.can_disconnect = True
-        
-    def publish(self, topic, message, *vargs, **kwargs):
-
-        # increment pubcount then publish
-        result = self.client.publish(topic, message, *vargs, **kwargs)
-        self.pubset.add(result.mid)
-
-        # echo if verbosity > 0
-        if self.verbosity > 1:
-            self.stdout.write("   {}: {}".format(topic, message))
-        elif self.verbosity > 0:
+    def __init__(self, broker, **kwargs):
+
+        self.chunk_size = kwargs.pop('chunk_size', 500)
+        self.workers = kwargs.pop('workers', 4)
+
+        # call super
+        super().__init__(broker, **kwargs)
+
+        # publishes are done outside the network thread
+        self.inflight_block = True
+        self.pool = None
+
+        # incremental seeding
+        self.watermarks = {}
+        self.previous = {}
+        self.fingerprints = {}
+        self.seed_margin = self.broker.get('SEED_MARGIN', 300)
+
+    def publish(self, topic, payload = None, qos = 0, retain = False,
+                context = None):
+
+        mid = super().publish(topic, payload, qos=qos, retain=retain,
+                              context=context)
+
+        # echo if verbosity > 1
+        if self.verbosity > 2:
+            self.stdout.write("   {}: {}".format(topic, payload))
+        elif self.verbosity > 1:
             self.stdout.write("   {}".format(topic))
 
+        return mid
+
+    def seed(self, state = None):
+        """
+        Seed everything, or only what changed since state if given.
+        Returns the state for the next incremental seed. Raises
+        MQTTException if anything could not be published, in which case
+        no state is returned, so that it is retried by the next seed.
+        """
+
+        if state is not None:
+            self.watermarks = state['watermarks']
+            self.previous = state['fingerprints']
+        started = timezone.now() - timedelta(seconds=self.seed_margin)
+
+        # start workers
+        if self.workers:
+            self.pool = WorkerPool(self.workers, max_queue_size=2)
+
+        try:
+
+            # Seed settings
+            self.seed_settings()
+
+            # Seed hospitals
+            self.seed_hospital_data()
+            self.seed_hospital_equipment_data()
+            self.seed_hospital_metadata()
+
+            # Seed ambulances
+            self.seed_ambulance_data()
+
+            # Seed profiles
+            self.seed_profile_data()
+
+            # Seed calls
+            # self.seed_calls()
+
+        finally:
+            if self.pool is not None:
+                self.pool.stop()
+
+        # wait for acknowledgements, give up if none arrive for inflight_timeout
+        acknowledged = self.counters['acknowledged']
+        deadline = time.monotonic() + self.inflight_timeout
+        while not self.done():
+            if self.counters['acknowledged'] != acknowledged:
+                acknowledged = self.counters['acknowledged']
+                deadline = time.monotonic() + self.inflight_timeout
+            elif time.monotonic() > deadline:
+                raise MQTTException('Timed out waiting for acknowledgements',
+                                    len(self.published))
+            time.sleep(0.1)
+
+        if self.verbosity > 0:
+            stats = self.stats()
+            self.stdout.write(self.style.SUCCESS("<< Published {} messages".format(stats['acknowledged'])))
+
+        return {
+            'watermarks': {name: started for name in WATERMARKS},
+            'fingerprints': self.fingerprints
+        }
+
+    def changed(self, queryset, name):
+
+        # updated after watermark
+        watermark = self.watermarks.get(name)
+        if watermark is not None:
+            queryset = queryset.filter(updated_on__gt=watermark)
+        return queryset
+
+    def publish_fingerprint(self, topic, data):
+
+        # publish only if payload changed
+        payload = self.encode(data)
+        fingerprint = hashlib.sha1(payload).hexdigest()
+        if self.previous.get(topic) != fingerprint:
+            self.publish(topic, payload, qos=2, retain=True)
+
+        # record only once published
+        self.fingerprints[topic] = fingerprint
+
+    def seed_chunks(self, name, chunks, publish):
+
+        if self.verbosity > 0:
+            self.stdout.write(self.style.SUCCESS(">> Seeding {}".format(name)))
+
+        start = time.monotonic()
+        errors = self.pool.errors() if self.pool is not None else 0
+        count = 0
+        for k, chunk in enumerate(chunks):
+
+            # serialize and publish chunk
+            if self.pool is not None:
+                self.pool.submit(k, self.publish_chunk, chunk, publish)
+            else:
+                self.publish_chunk(chunk, publish)
+
+            count += len(chunk)
+            if self.verbosity > 0:
+                self.stdout.write("   {} {}...".format(count, name))
+
+        # wait for workers
+        if self.pool is not None:
+            self.pool.join()
+
+            # workers log and count failed chunks, do not go on as if seeded
+            errors = self.pool.errors() - errors
+            if errors:
+                raise MQTTException('Could not seed {}, {} chunks failed'.format(name, errors),
+                                    errors)
+
+        if self.verbosity > 0:
+            elapsed = time.monotonic() - start
+            self.stdout.write(self.style.SUCCESS("<< Done seeding {} {} in {:.1f}s ({:.0f}/s)".format(count,
+                                                                                                     name,
+                                                                                                     elapsed,
+                                                                                                     count / elapsed if elapsed > 0 else 0)))
+
+        return count
+
+    def publish_chunk(self, chunk, publish):
+        for obj in chunk:
+            publish(obj)
+
     def seed_settings(self):
         if self.verbosity > 0:
             self.stdout.write(self.style.SUCCESS(">> Seeding settings"))
 
         # seeding settings
         self.publish_settings()
-            
+
         if self.verbosity > 0:
             self.stdout.write(self.style.SUCCESS("<< Done seeding settings"))
-            
-    def seed_profile_data(self):
 
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS(">> Seeding profile data"))
+    def seed_profile_data(self, queryset = None):
+
+        if queryset is None:
+            queryset = Profile.objects.all()
 
         # seeding profiles
-        for obj in Profile.objects.all():
-            self.publish_profile(obj)
-            
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS("<< Done seeding profile data"))
-            
-    def seed_ambulance_data(self):
+        queryset = queryset.select_related('user') \
+                           .prefetch_related('ambulances__ambulance',
+                                             'hospitals__hospital')
+        def publish(profile):
+            self.publish_fingerprint('user/{}/profile'.format(profile.user.username),
+                                     ExtendedProfileSerializer(profile))
 
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS(">> Seeding ambulance data"))
+        return self.seed_chunks('profile data',
+                                chunked(queryset, self.chunk_size),
+                                publish)
+
+    def seed_ambulance_data(self, queryset = None):
+
+        if queryset is None:
+            queryset = self.changed(Ambulance.objects.all(), 'ambulance')
 
         # seeding ambulances
-        for obj in Ambulance.objects.all():
-            self.publish_ambulance(obj)
-            
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS("<< Done seeding ambulance data"))
+        return self.seed_chunks('ambulance data',
+                                chunked(queryset, self.chunk_size),
+                                self.publish_ambulance)
 
-    def seed_hospital_data(self):
+    def seed_hospital_data(self, queryset = None):
 
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS(">> Seeding hospital data"))
+        if queryset is None:
+            queryset = self.changed(Hospital.objects.all(), 'hospital')
 
-        # seeding hospital 
-        for obj in Hospital.objects.all():
-            self.publish_hospital(obj)
-            
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS("<< Done seeding hospital data"))
+        # seeding hospitals
+        return self.seed_chunks('hospital data',
+                                chunked(queryset, self.chunk_size),
+                                self.publish_hospital)
 
-            
-    def seed_hospital_equipment_data(self):
+    def seed_hospital_equipment_data(self, queryset = None):
 
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS(">> Seeding hospital equipment data"))
+        if queryset is None:
+            queryset = self.changed(HospitalEquipment.objects.all(), 'hospital_equipment')
 
-        # seeding hospital 
-        for obj in HospitalEquipment.objects.all():
-            self.publish_hospital_equipment(obj)
-            
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS("<< Done seeding hospital equipment data"))
+        # seeding hospital equipment
+        queryset = queryset.select_related('hospital', 'equipment')
+        return self.seed_chunks('hospital equipment data',
+                                chunked(queryset, self.chunk_size),
+                                self.publish_hospital_equipment)
 
-            
-    def seed_hospital_metadata(self):
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS(">> Seeding hospital metadata"))
+    def seed_hospital_metadata(self, queryset = None):
 
-        # seeding hospital metadata
-        for hospital in Hospital.objects.all():
-            self.publish_hospital_metadata(hospital)
-            
-        if self.verbosity > 0:
-            self.stdout.write(self.style.SUCCESS("<< Done seeding hospital metadata"))
+        if queryset is None:
+            queryset = Hospital.objects.all()
+
+        # serialize equipment once
+        objs = list(Equipment.objects.order_by('id'))
+        equipment = list(zip((obj.id for obj in objs),
+                             EquipmentSerializer(objs, many=True).data))
+
+        def publish(hospital):
+            ids = hospital.equipment_ids
+            self.publish_fingerprint('hospital/{}/metadata'.format(hospital.id),
+                                     [data for id, data in equipment if id in ids])
+
+        def chunks():
+            for chunk in chunked(queryset.only('id'), self.chunk_size):
 
+                # equipment of all hospitals in chunk in one query
+                ids = {hospital.id: set() for hospital in chunk}
+                for hospital_id, equipment_id in \
+                    HospitalEquipment.objects.filter(hospital_id__in=ids.keys()) \
+                                             .values_list('hospital_id', 'equipment_id'):
+                    ids[hospital_id].add(equipment_id)
 
-    # Message publish callback
-    def on_publish(self, client, userdata, mid):
+                for hospital in chunk:
+                    hospital.equipment_ids = ids[hospital.id]
 
-        # make sure all is published before disconnecting
-        self.pubset.remove(mid)
-        if len(self.pubset) == 0 and self.can_disconnect:
-            self.disconnect()
+                yield chunk
+
+        # seeding hospital metadata
+        return self.seed_chunks('hospital metadata', chunks(), publish)
 
 class Command(BaseCommand):
     help = 'Seed the mqtt broker'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of objects read from the database at a time')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of threads serializing and publishing, 0 to use the main thread')
+        parser.add_argument('--max-inflight', type=int, default=100,
+                            help='Maximum number of publishes waiting for acknowledgement')
+        parser.add_argument('--state', default=None,
+                            help='State file for incremental seeding (default settings.MQTT[\'SEED_STATE\'])')
+        parser.add_argument('--full', action='store_true', default=False,
+                            help='Republish everything, even if a state file exists')
+
     def handle(self, *args, **options):
 
         import os
@@ -160,17 +364,44 @@ class Command(BaseCommand):
         }
         broker.update(settings.MQTT)
         broker['CLIENT_ID'] = 'mqttseed_' + str(os.getpid())
+        broker['MAX_INFLIGHT'] = options['max_inflight']
+
+        # incremental?
+        path = options['state'] or broker.get('SEED_STATE')
+        state = None
+        if path and not options['full']:
+            state = load_state(path)
+            if state is not None and options['verbosity'] > 0:
+                self.stdout.write(self.style.SUCCESS(">> Seeding changes since {}".format(min(state['watermarks'].values()))))
 
         client = Client(broker,
+                        chunk_size = options['chunk_size'],
+                        workers = options['workers'],
                         stdout = self.stdout,
                         style = self.style,
                         verbosity = options['verbosity'])
 
         try:
-            client.loop_forever()
+
+            # wait for connection
+            while not client.connected:
+                client.loop()
+
+            # network loop runs in the background while seeding
+            client.loop_start()
+            state = client.seed(state)
+
+            # save state for next incremental seed, only reached if
+            # everything was published
+            if path:
+                save_state(path, state)
 
         except KeyboardInterrupt:
             pass
 
+        except MQTTException as e:
+            raise CommandError(str(e))
+
         finally:
             client.disconnect()
+            client.loop_stop()
@@ -0,0 +1,312 @@
+import logging
+import fcntl, os, re, struct, tempfile, threading, time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Outbox
+#
+# Retained publishes are appended to a file before being sent and marked
+# as done once the broker acknowledges them. Only the last publish to each
+# topic is kept, since it carries the whole retained state of the topic.
+# Publishes still pending after a broker outage or a process restart are
+# replayed on the next connection.
+#
+# Each record is a header followed by the topic and the payload:
+#
+#     op (1 byte), qos (1 byte), retain (1 byte),
+#     topic length (2 bytes), payload length (4 bytes)
+#
+# A payload length of 0xFFFFFFFF stands for a null payload. The file is
+# compacted when it grows past max_size; if the pending publishes alone
+# do not fit, the oldest ones are dropped.
+#
+# An outbox file belongs to a single process, which holds an exclusive
+# lock on '<path>.lock' while the outbox is open. Processes sharing the
+# same settings.MQTT['OUTBOX'] each use '<OUTBOX>.<pid>' and, on start,
+# adopt the outboxes left behind by processes that are gone, that is,
+# whose lock can be acquired.
+
+def process_path(path):
+    """
+    Return path of the outbox of the current process.
+    """
+    return '{}.{}'.format(path, os.getpid())
+
+def lock_file(path):
+    """
+    Open and lock '<path>.lock' without blocking. Returns the open file
+    or None if the lock is held by another process.
+    """
+
+    file = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+def unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+class Outbox():
+
+    """
+    Persistent store of pending retained publishes.
+    """
+
+    HEADER = struct.Struct('>BBBHI')
+
+    PUT = 1
+    DONE = 2
+
+    NULL = 0xFFFFFFFF
+
+    def __init__(self, path, max_size = 16 * 2**20, fsync = False):
+
+        self.path = path
+        self.max_size = max_size
+        self.fsync = fsync
+
+        self.lock = threading.Lock()
+
+        # topic -> (seq, payload, qos, retain)
+        self.pending = OrderedDict()
+        self.seq = 0
+
+        self.file = None
+        self.size = 0
+
+        # owned by this process
+        self.lock_file = lock_file(path)
+        if self.lock_file is None:
+            raise OSError("Outbox '{}' is in use by another process".format(path))
+
+        # metrics
+        self.dropped = 0
+        self.compactions = 0
+        self.replayed = 0
+        self.replay_rate = 0.
+
+        # load pending publishes and start a clean file
+        self.load()
+        with self.lock:
+            self.compact()
+
+    def load(self, path = None):
+
+        path = path or self.path
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return
+
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+
+            op, qos, retain, topic_length, payload_length = \
+                self.HEADER.unpack_from(data, offset)
+            start = offset + self.HEADER.size
+            length = topic_length + (0 if payload_length == self.NULL else payload_length)
+            if start + length > len(data):
+                # partially written record
+                break
+
+            topic = data[start:start + topic_length].decode('utf-8')
+            payload = None if payload_length == self.NULL else data[start + topic_length:start + length]
+            offset = start + length
+
+            if op == self.PUT:
+                self.pending.pop(topic, None)
+                self.seq += 1
+                self.pending[topic] = (self.seq, payload, qos, bool(retain))
+            elif op == self.DONE:
+                self.pending.pop(topic, None)
+            else:
+                logger.warning("mqtt.Outbox: invalid record in '{}', skipping remainder".format(path))
+                break
+
+        if offset < len(data):
+            logger.warning("mqtt.Outbox: ignored {} trailing bytes in '{}'".format(len(data) - offset,
+                                                                                    path))
+
+        if self.pending:
+            logger.info("mqtt.Outbox: loaded {} pending publishes from '{}'".format(len(self.pending),
+                                                                                   path))
+
+    def adopt(self, base):
+        """
+        Take over the pending publishes of outboxes at base or
+        '<base>.<pid>' whose process is gone. Returns the number of
+        outboxes adopted.
+        """
+
+        directory, name = os.path.split(os.path.abspath(base))
+        pattern = re.compile(r'^{}(\.\d+)?$'.format(re.escape(name)))
+
+        count = 0
+        for filename in sorted(os.listdir(directory)):
+
+            path = os.path.join(directory, filename)
+            if not pattern.match(filename) or path == os.path.abspath(self.path):
+                continue
+
+            # still owned?
+            file = lock_file(path)
+            if file is None:
+                continue
+
+            try:
+                with self.lock:
+                    # merge and persist before removing the orphan
+                    self.load(path)
+                    self.compact()
+                unlink(path)
+                unlink(path + '.lock')
+                count += 1
+            finally:
+                file.close()
+
+        return count
+
+    def record(self, op, topic, payload = None, qos = 0, retain = False):
+
+        topic = topic.encode('utf-8')
+        if payload is None:
+            header = self.HEADER.pack(op, qos, retain, len(topic), self.NULL)
+            return header + topic
+        else:
+            header = self.HEADER.pack(op, qos, retain, len(topic), len(payload))
+            return header + topic + payload
+
+    def write(self, record):
+
+        self.file.write(record)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.size += len(record)
+
+        if self.size > self.max_size:
+            self.compact()
+
+    def compact(self):
+
+        # drop oldest publishes until at most half full
+        records = [self.record(self.PUT, topic, payload, qos, retain)
+                   for topic, (seq, payload, qos, retain) in self.pending.items()]
+        size = sum(len(record) for record in records)
+        while records and size > self.max_size // 2:
+            size -= len(records.pop(0))
+            topic, _ = self.pending.popitem(last=False)
+            self.dropped += 1
+            logger.warning("mqtt.Outbox: outbox full, dropped publish to '{}'".format(topic))
+
+        # write to temporary file then replace
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                   prefix=os.path.basename(self.path) + '.',
+                                   suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for record in records:
+                    file.write(record)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            unlink(tmp)
+            raise
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'ab')
+        self.size = size
+        self.compactions += 1
+
+    def put(self, topic, payload, qos, retain):
+        """
+        Add publish to the outbox, replacing any pending publish
+        to the same topic. Returns the sequence number of the publish.
+        """
+
+        with self.lock:
+            self.seq += 1
+            self.pending.pop(topic, None)
+            self.pending[topic] = (self.seq, payload, qos, retain)
+            self.write(self.record(self.PUT, topic, payload, qos, retain))
+            return self.seq
+
+    def is_pending(self, topic, seq):
+        entry = self.pending.get(topic)
+        return entry is not None and entry[0] == seq
+
+    def done(self, topic, seq):
+        """
+        Remove publish from the outbox unless it has been superseded.
+        """
+
+        with self.lock:
+            if self.is_pending(topic, seq):
+                del self.pending[topic]
+                self.write(self.record(self.DONE, topic))
+
+    def items(self):
+        with self.lock:
+            return [(topic,) + entry for topic, entry in self.pending.items()]
+
+    def replay(self, deliver, skip = ()):
+        """
+        Call deliver(topic, payload, qos, retain, seq) for every pending
+        publish not in skip, a collection of (topic, seq).
+        """
+
+        start = time.monotonic()
+        count = 0
+        for topic, seq, payload, qos, retain in self.items():
+            if (topic, seq) in skip or not self.is_pending(topic, seq):
+                continue
+            deliver(topic, payload, qos, retain, seq)
+            count += 1
+
+        elapsed = time.monotonic() - start
+        self.replayed += count
+        if count:
+            self.replay_rate = count / elapsed if elapsed > 0 else float(count)
+            logger.info("mqtt.Outbox: replayed {} publishes in {:.3f}s".format(count, elapsed))
+
+        return count
+
+    def close(self):
+        with self.lock:
+
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+                # nothing left to adopt
+                if not self.pending:
+                    unlink(self.path)
+
+            if self.lock_file is not None:
+                if not self.pending:
+                    unlink(self.path + '.lock')
+                self.lock_file.close()
+                self.lock_file = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {
+            'backlog': len(self.pending),
+            'size': self.size,
+            'dropped': self.dropped,
+            'compactions': self.compactions,
+            'replayed': self.replayed,
+            'replay_rate': self.replay_rate
+        }
@@ -1,11 +1,14 @@
 import logging
-import atexit, sys, os, time
+import atexit, sys, os, time, threading, queue, weakref
+
+from django.db import transaction, close_old_connections
 
-from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
 from rest_framework import serializers
 
 from .client import BaseClient, MQTTException
+from .codec import get_codec
+from . import outbox
+from .outbox import Outbox
 
 from ambulance.models import Ambulance
 from ambulance.serializers import AmbulanceSerializer
@@ -52,11 +55,25 @@ class PublishClient(BaseClient):
 
     def __init__(self, broker, **kwargs):
 
-        # call super
-        super().__init__(broker, **kwargs)
-
         # set as active
         self.active = True
+
+        # payload codec
+        self.codec = get_codec()
+
+        # publish ambulance deltas
+        self.delta = broker.get('DELTA', False)
+        self.snapshot_interval = broker.get('SNAPSHOT_INTERVAL', 60)
+        self.snapshots = {}
+
+        # trailing snapshots, ambulance id -> due
+        self.trailing = {}
+        self.trailing_condition = threading.Condition()
+        self.trailing_thread = None
+        self.trailing_stopped = False
+
+        # call super
+        super().__init__(broker, **kwargs)
     
     def on_disconnect(self, client, userdata, rc):
         # Exception is generated only if never connected
@@ -66,19 +83,21 @@ class PublishClient(BaseClient):
         # call super
         super().on_disconnect(client, userdata, rc)
     
+    def encode(self, payload):
+
+        # serializer?
+        if isinstance(payload, serializers.BaseSerializer):
+            return self.codec.encode(payload.data)
+        else:
+            return self.codec.encode(payload)
+
     def publish_topic(self, topic, payload, qos=0, retain=False):
 
         if self.active:
 
-            # serializer?
-            if isinstance(payload, serializers.BaseSerializer):
-                payload = JSONRenderer().render(payload.data)
-            else:
-                payload = JSONRenderer().render(payload)
-                
             # Publish to topic
             self.publish(topic,
-                         payload,
+                         self.encode(payload),
                          qos=qos,
                          retain=retain)
         
@@ -104,12 +123,132 @@ class PublishClient(BaseClient):
                           qos=qos,
                           retain=retain)
         
-    def publish_ambulance(self, ambulance, qos=2, retain=True):
+    def publish_ambulance(self, ambulance, qos=2, retain=True,
+                          changed=None, seq=None):
+
+        # publish only changed fields?
+        if self.delta and changed is not None and seq is not None:
+
+            # publish delta
+            self.publish_ambulance_delta(ambulance, changed, seq)
+
+            # publish snapshot at a lower rate if only location changed
+            now = time.monotonic()
+            last = self.snapshots.get(ambulance.id)
+            if (changed.issubset(self.DELTA_FIELDS) and
+                last is not None and now - last < self.snapshot_interval):
+
+                # so that the retained snapshot catches up eventually
+                self.schedule_snapshot(ambulance.id, last + self.snapshot_interval)
+                return
+
+            self.snapshots[ambulance.id] = now
+            self.cancel_snapshot(ambulance.id)
+
         self.publish_topic('ambulance/{}/data'.format(ambulance.id),
                           AmbulanceSerializer(ambulance),
                           qos=qos,
                           retain=retain)
 
+    # fields that do not force a snapshot
+    DELTA_FIELDS = frozenset(('location', 'location_timestamp', 'orientation',
+                              'updated_by', 'updated_on'))
+
+    # Trailing snapshots
+    #
+    # When a snapshot is skipped, one is scheduled for when the snapshot
+    # interval expires, so that the retained ambulance/{id}/data does not
+    # keep a stale location if the ambulance goes quiet. The ambulance is
+    # read again from the database at that time, so only committed state
+    # is published, and a snapshot published in the meantime cancels it.
+
+    def schedule_snapshot(self, ambulance_id, due):
+
+        with self.trailing_condition:
+
+            if ambulance_id in self.trailing:
+                return
+            self.trailing[ambulance_id] = due
+
+            # start thread on first use
+            if self.trailing_thread is None:
+                self.trailing_thread = threading.Thread(name='mqtt_publish_snapshots',
+                                                        target=self.run_snapshots,
+                                                        daemon=True)
+                self.trailing_thread.start()
+
+            self.trailing_condition.notify()
+
+    def cancel_snapshot(self, ambulance_id):
+        with self.trailing_condition:
+            self.trailing.pop(ambulance_id, None)
+
+    def run_snapshots(self):
+
+        while True:
+
+            # wait for due snapshots
+            with self.trailing_condition:
+
+                if self.trailing_stopped:
+                    break
+
+                now = time.monotonic()
+                due = [k for k, t in self.trailing.items() if t <= now]
+                for k in due:
+                    del self.trailing[k]
+
+                if not due:
+                    timeout = (min(self.trailing.values()) - now
+                               if self.trailing else None)
+                    self.trailing_condition.wait(timeout)
+                    continue
+
+            close_old_connections()
+            for ambulance_id in due:
+                try:
+                    self.publish_trailing_snapshot(ambulance_id)
+                except Exception as e:
+                    logger.warning('mqtt.PublishClient: could not publish snapshot of ambulance {}, exception = {}'.format(ambulance_id, e))
+
+    def publish_trailing_snapshot(self, ambulance_id, qos=2, retain=True):
+
+        try:
+            ambulance = Ambulance.objects.get(id=ambulance_id)
+        except Ambulance.DoesNotExist:
+            return
+
+        self.snapshots[ambulance_id] = time.monotonic()
+        self.publish_topic('ambulance/{}/data'.format(ambulance_id),
+                          AmbulanceSerializer(ambulance),
+                          qos=qos,
+                          retain=retain)
+
+    def stop_snapshots(self):
+
+        with self.trailing_condition:
+            self.trailing_stopped = True
+            self.trailing_condition.notify()
+
+        if self.trailing_thread is not None:
+            self.trailing_thread.join()
+
+    def publish_ambulance_delta(self, ambulance, changed, seq, qos=0):
+
+        # changed fields only
+        data = AmbulanceSerializer(ambulance).data
+        delta = {k: data[k] for k in changed if k in data}
+        delta.update({
+            'id': ambulance.id,
+            'seq': seq,
+            'updated_on': data['updated_on']
+        })
+
+        self.publish_topic('ambulance/{}/delta'.format(ambulance.id),
+                           delta,
+                           qos=qos,
+                           retain=False)
+
     def remove_ambulance(self, ambulance):
         self.remove_topic('ambulance/{}/data'.format(ambulance.id))
         
@@ -142,7 +281,89 @@ class PublishClient(BaseClient):
         self.remove_topic('hospital/{}/equipment/{}/data'.format(equipment.hospital.id,
                                                                  equipment.equipment.name))
 
+# PublishBuffer
+
+class PublishBuffer():
+
+    """
+    Publishes deferred until the current transaction commits.
+    Publishes to the same topic are collapsed into the last one.
+    Publishes made in a savepoint that is rolled back are only discarded
+    if the buffer was registered inside that savepoint.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.messages = {}
+        self.registered = False
+        self.callback = None
+
+    def register(self):
+
+        # Django drops the callback if the transaction is rolled back,
+        # which releases the buffer through the weak reference
+        callback = FlushCallback(self)
+        self.callback = weakref.ref(callback, self.discard)
+        self.registered = True
+        transaction.on_commit(callback)
+
+    def discard(self, ref = None):
+        self.registered = False
+        self.client.release(self)
+
+    def add(self, topic, payload, qos, retain):
+        # keep only the last publish to topic
+        self.messages.pop(topic, None)
+        self.messages[topic] = (payload, qos, retain)
+
+    def flush(self):
+        self.discard()
+        for topic, (payload, qos, retain) in self.messages.items():
+            try:
+                self.client.send(topic, payload, qos, retain)
+            except Exception as e:
+                logger.warning("mqtt.PublishBuffer: could not publish to '{}', exception = {}".format(topic, e))
+
+class FlushCallback():
+
+    """
+    Flushes buffer on commit.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __call__(self):
+        self.buffer.flush()
+
 # Uses Alex Martelli's Borg for making PublishClient act like a singleton
+#
+# Publishes done inside a transaction are buffered and only sent when the
+# transaction commits, so nothing is published for changes that are rolled
+# back and repeated publishes to the same topic, for example hospital
+# metadata when saving many equipment rows, are serialized and sent once.
+# Payloads are serialized in the calling thread, which has access to the
+# transaction, and handed to a background thread for the network send.
+#
+# The buffer follows the on_commit callback it registers. Django drops that
+# callback when the transaction, or the savepoint in which it was registered,
+# is rolled back, and the buffer is then released as soon as the callback is
+# collected, which CPython does right away. Publishes made inside a savepoint
+# that is rolled back after the buffer was registered by an enclosing block
+# are NOT discarded and are still sent when the outer transaction commits:
+# Django has no hook for savepoint release, so publishes cannot be kept per
+# savepoint. Publish from the outermost block, or after the savepoint, when
+# this matters.
+#
+# If settings.MQTT['OUTBOX'] is the path of a file, retained publishes
+# are also kept in an Outbox until the broker acknowledges them. The
+# client then stays active when the broker is down, reconnects in the
+# background and replays pending publishes on every connection. Each
+# process has its own outbox at '<OUTBOX>.<pid>' and adopts on start the
+# outboxes of processes that are gone.
+
+# replay outbox marker
+REPLAY = object()
 
 class SingletonPublishClient(PublishClient):
 
@@ -171,6 +392,20 @@ class SingletonPublishClient(PublishClient):
         
         # override client_id
         broker['CLIENT_ID'] = 'mqtt_publish_' + str(os.getpid())
+
+        # background sender
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.started = False
+
+        # durable outbox, one per process
+        if broker.get('OUTBOX'):
+            self.outbox = Outbox(outbox.process_path(broker['OUTBOX']),
+                                 max_size=broker.get('OUTBOX_MAX_SIZE', 16 * 2**20),
+                                 fsync=broker.get('OUTBOX_FSYNC', False))
+            self.outbox.adopt(broker['OUTBOX'])
+        else:
+            self.outbox = None
         
         try:
 
@@ -184,16 +419,185 @@ class SingletonPublishClient(PublishClient):
             while not self.connected:
                 self.loop()
 
-            # start loop
-            self.loop_start()
+        except (MQTTException, OSError) as e:
 
-            # register atexit handler to make sure it disconnects at exit
-            atexit.register(self.disconnect)
+            if self.outbox is None or not hasattr(self, 'client'):
 
-        except MQTTException as e:
+                self.active = False
 
-            self.active = False
-            
-            logger.info('>> Failed to connect to MQTT brocker. Will not publish updates to MQTT...')
+                logger.info('>> Failed to connect to MQTT brocker. Will not publish updates to MQTT...')
+                logger.info('>> Generated exception: {}'.format(e))
+                return
+
+            logger.info('>> Failed to connect to MQTT brocker. Will keep trying in the background...')
             logger.info('>> Generated exception: {}'.format(e))
-        
+
+        # sender thread can wait for room in the inflight window
+        self.inflight_block = True
+
+        # start loop, reconnects if connection is lost
+        self.started = True
+        self.loop_start()
+
+        # start background sender
+        self.sender = threading.Thread(name='mqtt_publish_sender',
+                                       target=self.run_sender,
+                                       daemon=True)
+        self.sender.start()
+
+        # register atexit handler to make sure it disconnects at exit
+        atexit.register(self.stop)
+
+    def on_connect(self, client, userdata, flags, rc):
+
+        # keep trying in the background
+        if rc and self.started:
+            logger.warning('mqtt.SingletonPublishClient: could not connect to brocker (rc = {})'.format(rc))
+            return False
+
+        super().on_connect(client, userdata, flags, rc)
+
+        # replay pending publishes
+        if self.outbox is not None:
+            self.reset_inflight()
+            self.queue.put(REPLAY)
+
+        return True
+
+    def on_disconnect(self, client, userdata, rc):
+
+        # keep trying in the background
+        if self.started:
+            if rc:
+                logger.warning('mqtt.SingletonPublishClient: disconnected from brocker (rc = {})'.format(rc))
+            BaseClient.on_disconnect(self, client, userdata, rc)
+        else:
+            super().on_disconnect(client, userdata, rc)
+
+    def run_sender(self):
+
+        while True:
+
+            # wait for next message
+            message = self.queue.get()
+            if message is None:
+                self.queue.task_done()
+                break
+
+            if message is REPLAY:
+                topic = '#'
+            else:
+                topic = message[0]
+
+            try:
+                if message is REPLAY:
+                    self.replay()
+                else:
+                    self.deliver(*message)
+            except Exception as e:
+                logger.warning("mqtt.SingletonPublishClient: could not publish to '{}', exception = {}".format(topic, e))
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, topic, payload, qos, retain, seq = None):
+
+        if seq is not None:
+            # superseded, already delivered or will be replayed on connect?
+            if not self.outbox.is_pending(topic, seq) or not self.connected:
+                return
+            context = (topic, seq)
+        else:
+            context = None
+
+        self.publish(topic, payload, qos=qos, retain=retain, context=context)
+
+    def on_acknowledge(self, mid, entry):
+
+        # remove from outbox
+        if entry.context is not None:
+            self.outbox.done(*entry.context)
+
+    def replay(self):
+
+        if not self.connected:
+            return
+
+        # skip publishes waiting for acknowledgement
+        with self.inflight_lock:
+            skip = set(entry.context for entry in self.published.values())
+            skip.update(message[4] for message in self.backlog)
+
+        self.outbox.replay(self.deliver, skip)
+
+    def stop(self):
+
+        # send what is left then disconnect
+        self.stop_snapshots()
+        self.queue.put(None)
+        self.sender.join()
+        self.disconnect()
+        self.loop_stop()
+
+        if self.outbox is not None:
+            self.outbox.close()
+
+    def send(self, topic, payload, qos, retain):
+
+        # serialize in the calling thread
+        if payload is not None:
+            payload = self.encode(payload)
+
+        # persist retained publishes
+        if retain and self.outbox is not None:
+            seq = self.outbox.put(topic, payload, qos, retain)
+        else:
+            seq = None
+
+        # hand it to the sender
+        self.queue.put((topic, payload, qos, retain, seq))
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            'connected': self.connected,
+            'queue_depth': self.queue.qsize(),
+            'outbox': self.outbox.stats() if self.outbox is not None else None
+        })
+        return stats
+
+    def get_buffer(self):
+
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            return None
+
+        # buffer still registered with the current transaction?
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None or not buffer.registered:
+
+            # create buffer and flush it on commit
+            buffer = PublishBuffer(self)
+            self.local.buffer = buffer
+            buffer.register()
+
+        return buffer
+
+    def release(self, buffer):
+        if getattr(self.local, 'buffer', None) is buffer:
+            self.local.buffer = None
+
+    def publish_topic(self, topic, payload, qos=0, retain=False):
+
+        if self.active:
+
+            # defer to the end of the transaction
+            buffer = self.get_buffer()
+            if buffer is not None:
+                buffer.add(topic, payload, qos, retain)
+            else:
+                self.send(topic, payload, qos, retain)
+
+    def remove_topic(self, topic, qos=0):
+
+        # publish null to retained topic
+        self.publish_topic(topic, None, qos=qos, retain=True)
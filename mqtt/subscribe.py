@@ -1,15 +1,15 @@
 import logging
 
-from django.contrib.auth.models import User
+from login import permissions
 
 from django.core.exceptions import ObjectDoesNotExist
 
-from rest_framework.parsers import JSONParser
-from rest_framework.renderers import JSONRenderer
-from io import BytesIO
-
 from .client import BaseClient, MQTTException
+from .codec import get_codec
+from .workers import WorkerPool
+from .coalesce import Coalescer
 
+from ambulance import fastpath
 from ambulance.models import Ambulance
 from ambulance.serializers import AmbulanceSerializer
 
@@ -20,8 +20,108 @@ from hospital.serializers import HospitalSerializer, \
 logger = logging.getLogger(__name__)
 
 # SubscribeClient
+#
+# Scaling out: if MQTT['SHARED_GROUP'] is set, the client subscribes to
+# '$share/<group>/...' and the broker load-balances messages among all
+# clients in the same group, which may run on different hosts.
+#
+# Ordering guarantee: the broker may deliver consecutive messages for the
+# same ambulance to different clients, so messages are no longer
+# processed in the order they were published. Location updates are
+# therefore guarded: an update whose location_timestamp is older than the
+# ambulance's current location_timestamp is discarded, atomically in the
+# database, so the live location of an ambulance never moves back in
+# time. Messages without location_timestamp, such as status changes, are
+# applied in the order they are processed; devices that need strict
+# ordering of status changes should send them with a location update.
+#
+# The same holds without shared subscriptions for bulk updates, published
+# to 'user/{username}/ambulance/data': workers shard them by username and
+# messages for a single ambulance by ambulance id, so a bulk update and a
+# single update of the same ambulance may be applied out of order. Bulk
+# updates are therefore always guarded, and gateways should not mix both
+# topics for the same ambulance if status changes must stay in order.
+
 class SubscribeClient(BaseClient):
 
+    def __init__(self, broker, **kwargs):
+
+        # join shared subscription group
+        self.shared_group = kwargs.pop('shared_group',
+                                       broker.get('SHARED_GROUP', ''))
+
+        # discard location updates older than the current one
+        self.guard = kwargs.pop('guard',
+                                broker.get('ORDER_GUARD', bool(self.shared_group)))
+
+        # number of workers, 0 processes messages in the network thread
+        workers = kwargs.pop('workers', broker.get('WORKERS', 0))
+        max_queue_size = kwargs.pop('max_queue_size',
+                                    broker.get('MAX_QUEUE_SIZE', 0))
+
+        # coalescing window in seconds, 0 disables coalescing
+        coalesce = kwargs.pop('coalesce', broker.get('COALESCE', 0))
+        coalesce_history = kwargs.pop('coalesce_history',
+                                      broker.get('COALESCE_HISTORY', False))
+
+        # validate and save common ambulance updates without serializer
+        self.fast_path = kwargs.pop('fast_path', broker.get('FAST_PATH', True))
+
+        # start worker pool before connecting
+        self.pool = None
+        if workers:
+            self.pool = WorkerPool(workers, max_queue_size)
+
+        # coalesce ambulance location updates
+        self.coalescer = None
+        if coalesce:
+            self.coalescer = Coalescer(self.dispatch(self.on_ambulance),
+                                       coalesce, coalesce_history)
+
+        # payload codec
+        self.codec = get_codec()
+
+        # call super
+        super().__init__(broker, **kwargs)
+
+    def dispatch(self, handler, level = 3):
+
+        # no pool, process message in the network thread
+        if self.pool is None:
+            return handler
+
+        def callback(client, userdata, msg):
+            # shard by the entity id in 'user/{username}/{entity}/{id}/...'
+            # so that messages for the same ambulance or hospital are
+            # processed in order, bulk updates are sharded by username
+            self.pool.submit(msg.topic.split('/')[level],
+                             handler, client, userdata, msg)
+
+        return callback
+
+    def stats(self):
+        stats = {}
+        if self.pool is not None:
+            stats.update(self.pool.stats())
+        if self.coalescer is not None:
+            stats['coalescer'] = self.coalescer.stats()
+        stats['cache'] = permissions.stats()
+        stats['publish'] = super().stats()
+        return stats
+
+    def disconnect(self):
+
+        # flush pending updates
+        if self.coalescer is not None:
+            self.coalescer.stop()
+
+        # drain and stop workers before disconnecting
+        if self.pool is not None:
+            self.pool.stop()
+
+        # call super
+        super().disconnect()
+
     # The callback for when the client receives a CONNACK
     # response from the server.
     def on_connect(self, client, userdata, flags, rc):
@@ -35,31 +135,45 @@ class SubscribeClient(BaseClient):
         # client.subscribe('#', 2)
 
         # ambulance handler
-        self.client.message_callback_add('user/+/ambulance/+/data',
-                                         self.on_ambulance)
+        if self.coalescer is not None:
+            self.client.message_callback_add('user/+/ambulance/+/data',
+                                             self.coalescer.callback)
+        else:
+            self.client.message_callback_add('user/+/ambulance/+/data',
+                                             self.dispatch(self.on_ambulance))
         
+        # bulk ambulance handler
+        self.client.message_callback_add('user/+/ambulance/data',
+                                         self.dispatch(self.on_ambulance_bulk, level=1))
+
         # hospital handler
         self.client.message_callback_add('user/+/hospital/+/data',
-                                         self.on_hospital)
+                                         self.dispatch(self.on_hospital))
 
         # hospital equipment handler
         self.client.message_callback_add('user/+/hospital/+/equipment/+/data',
-                                         self.on_hospital_equipment)
+                                         self.dispatch(self.on_hospital_equipment))
         
         # call handler
         #self.client.message_callback_add('ambulance/+/call',
         #                                 self.on_call)
 
         # subscribe
-        self.subscribe('user/+/ambulance/+/data', 2)
-        self.subscribe('user/+/hospital/+/data', 2)
-        self.subscribe('user/+/hospital/+/equipment/+/data', 2)
+        self.subscribe(self.shared_topic('user/+/ambulance/+/data'), 2)
+        self.subscribe(self.shared_topic('user/+/ambulance/data'), 2)
+        self.subscribe(self.shared_topic('user/+/hospital/+/data'), 2)
+        self.subscribe(self.shared_topic('user/+/hospital/+/equipment/+/data'), 2)
         
         if self.verbosity > 0:
             self.stdout.write(self.style.SUCCESS(">> Listening to MQTT messages..."))
 
         return True
 
+    def shared_topic(self, topic):
+        if self.shared_group:
+            return '$share/{}/{}'.format(self.shared_group, topic)
+        return topic
+
     def send_error_message(self, username, topic, payload, error):
 
         logger.debug("send_error_message: {}, '{}:{}': '{}'".format(username,
@@ -75,7 +189,7 @@ class SubscribeClient(BaseClient):
 
         try:
                 
-            message = JSONRenderer().render({
+            message = self.codec.encode({
                 'topic': topic,
                 'payload': payload,
                 'error': error
@@ -111,8 +225,7 @@ class SubscribeClient(BaseClient):
         try:
 
             # retrieve user
-            #print(User.objects.all())
-            user = User.objects.get(username=values[1])
+            user = permissions.get_user(values[1])
 
         except ObjectDoesNotExist as e:
 
@@ -121,10 +234,10 @@ class SubscribeClient(BaseClient):
             logger.warning(('mqtt.SubscribeClient: {}, ' +
                             "topic = '{}:{}', " +
                             "error = '{}', " +
-                            "exception = {}").format(username,
-                                                     topic,
-                                                     payload,
-                                                     error,
+                            "exception = {}").format(values[1],
+                                                     msg.topic,
+                                                     msg.payload,
+                                                     'Unknown user',
                                                      e))
             return
             
@@ -132,7 +245,7 @@ class SubscribeClient(BaseClient):
         try:
             
             # Parse data into json dict
-            data = JSONParser().parse(BytesIO(msg.payload))
+            data = self.codec.decode(msg.payload)
             
         except Exception as e:
 
@@ -141,7 +254,11 @@ class SubscribeClient(BaseClient):
                                     "JSON formatted incorrectly")
             return
 
-        if len(values) == 5:
+        if len(values) == 4:
+
+            return (user, data)
+
+        elif len(values) == 5:
 
             return (user, data, values[3])
     
@@ -197,6 +314,75 @@ class SubscribeClient(BaseClient):
         
         logger.debug('on_ambulance: ambulance = {}'.format(ambulance))
         
+        try:
+
+            # common updates take the fast path
+            validated_data = fastpath.parse(data) if self.fast_path else None
+            if validated_data is not None:
+
+                logger.debug('on_ambulance: fast path')
+
+                # save to database
+                if fastpath.update(ambulance, validated_data, user,
+                                   guard=self.guard) is None:
+                    logger.debug('on_ambulance: discarded stale update')
+
+            else:
+
+                # update ambulance
+                self.update_ambulance(user, ambulance, data, msg)
+
+        except Exception as e:
+
+            logger.debug('on_ambulance: EXCEPTION')
+            
+            # send error message to user
+            self.send_error_message(user, msg.topic, msg.payload, e)
+            
+        logger.debug('on_ambulance: DONE')
+
+    # Update many ambulances
+    def on_ambulance_bulk(self, client, userdata, msg):
+
+        logger.debug("on_ambulance_bulk: msg = '{}:{}'".format(msg.topic, msg.payload))
+
+        # parse topic
+        values = self.parse_topic(msg)
+        if not values:
+            return
+
+        user, data = values
+
+        if not isinstance(data, list):
+
+            # send error message to user
+            self.send_error_message(user, msg.topic, msg.payload,
+                                    "Expected a list of updates")
+            return
+
+        try:
+
+            # permissions, saving and history in one pass; sharded apart
+            # from single updates, always discard stale locations
+            results = fastpath.bulk_update(data, user, guard=True)
+
+        except Exception as e:
+
+            logger.debug('on_ambulance_bulk: EXCEPTION')
+
+            # send error message to user
+            self.send_error_message(user, msg.topic, msg.payload, e)
+            return
+
+        # report failed updates only
+        errors = [result for result in results if 'error' in result]
+        if errors:
+            self.send_error_message(user, msg.topic, msg.payload, errors)
+
+        logger.debug('on_ambulance_bulk: DONE')
+
+    def update_ambulance(self, user, ambulance, data, msg):
+
         try:
         
             # update ambulance
@@ -206,6 +392,14 @@ class SubscribeClient(BaseClient):
             if serializer.is_valid():
                 
                 logger.debug('on_ambulance: valid serializer')
+
+                # discard stale location updates
+                location_timestamp = serializer.validated_data.get('location_timestamp')
+                if (self.guard and location_timestamp is not None and
+                    ambulance.location_timestamp is not None and
+                    location_timestamp < ambulance.location_timestamp):
+                    logger.debug('on_ambulance: discarded stale update')
+                    return
                 
                 # save to database
                 serializer.save(updated_by=user)
@@ -224,8 +418,6 @@ class SubscribeClient(BaseClient):
             
             # send error message to user
             self.send_error_message(user, msg.topic, msg.payload, e)
-            
-        logger.debug('on_ambulance: DONE')
 
     # Update hospital
     def on_hospital(self, client, userdata, msg):
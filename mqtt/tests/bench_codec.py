@@ -0,0 +1,57 @@
+import time
+
+from ambulance.serializers import AmbulanceSerializer
+
+from hospital.serializers import HospitalSerializer, \
+    HospitalEquipmentSerializer
+
+from login.tests.setup_data import TestSetup
+
+from ..codec import CODECS
+
+# Benchmark of MQTT payload codecs
+#
+# Not collected by the test runner, run with
+#
+#     ./manage.py test mqtt/tests/bench_codec.py
+
+class BenchCodec(TestSetup):
+
+    N = 20000
+
+    def test_benchmark(self):
+
+        payloads = {
+            'ambulance': AmbulanceSerializer(self.a1).data,
+            'hospital': HospitalSerializer(self.h1).data,
+            'equipment': HospitalEquipmentSerializer(self.he1).data,
+        }
+
+        print('\n>> Codec benchmark ({} messages)'.format(self.N))
+        for name, cls in CODECS.items():
+
+            try:
+                codec = cls()
+            except ImportError:
+                print('   {:8s}: not installed'.format(name))
+                continue
+
+            for kind, data in payloads.items():
+
+                encoded = codec.encode(data)
+                size = len(encoded) * self.N
+
+                start = time.perf_counter()
+                for _ in range(self.N):
+                    codec.encode(data)
+                encode = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for _ in range(self.N):
+                    codec.decode(encoded)
+                decode = time.perf_counter() - start
+
+                print('   {:8s} {:10s}: encode {:8.2f} MB/s, decode {:8.2f} MB/s'.format(name,
+                                                                                         kind,
+                                                                                         size / encode / 1e6,
+                                                                                         size / decode / 1e6))
@@ -0,0 +1,181 @@
+import itertools
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+# Local stand-in for an MQTT broker
+#
+# Replaces paho's Client so that BaseClient and its subclasses can be
+# tested without a running broker, for example
+#
+#     broker = Broker()
+#     with patch('mqtt.client.mqtt.Client', broker.Client):
+#         client = SubscribeClient(...)
+#
+# Messages are queued at each client and only delivered when the client
+# loops, which allows tests to control the order in which clients
+# process messages. Shared subscriptions ('$share/<group>/<filter>') are
+# load-balanced round-robin among the clients in the group. With
+# immediate_ack, publishes are acknowledged before client.publish returns,
+# as may happen with paho's network thread.
+
+class PublishResult():
+
+    def __init__(self, rc, mid):
+        self.rc = rc
+        self.mid = mid
+
+class Broker():
+
+    def __init__(self, immediate_ack = False):
+
+        self.immediate_ack = immediate_ack
+        self.clients = []
+        self.retained = {}
+        self.mids = itertools.count(1)
+        self.round_robin = {}
+
+    def Client(self, client_id = '', clean_session = True, *args, **kwargs):
+        client = BrokerClient(self, client_id, clean_session)
+        self.clients.append(client)
+        return client
+
+    def route(self, topic, payload, qos, retain):
+
+        # retain
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+        # shared groups that match
+        groups = {}
+        for client in self.clients:
+            if not client.connected:
+                continue
+            matched = False
+            for sub in client.subscriptions:
+                if sub.startswith('$share/'):
+                    _, group, filter = sub.split('/', 2)
+                    if mqtt.topic_matches_sub(filter, topic):
+                        groups.setdefault((group, filter), []).append(client)
+                elif not matched and mqtt.topic_matches_sub(sub, topic):
+                    # deliver once per client
+                    matched = True
+                    client.deliver(topic, payload, qos, False)
+
+        # deliver to one client per group
+        for key, members in groups.items():
+            k = self.round_robin.get(key, 0)
+            members[k % len(members)].deliver(topic, payload, qos, False)
+            self.round_robin[key] = k + 1
+
+class BrokerClient():
+
+    def __init__(self, broker, client_id, clean_session):
+
+        self.broker = broker
+        self.client_id = client_id
+        self.connected = False
+        self.subscriptions = []
+        self.callbacks = []
+        self.events = deque()
+        self.inbox = deque()
+
+        self.on_connect = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_disconnect = None
+        self.on_message = None
+
+    # paho interface
+
+    def will_set(self, topic, payload = None, qos = 0, retain = False):
+        self.will = (topic, payload, qos, retain)
+
+    def username_pw_set(self, username, password = None):
+        self.username = username
+
+    def connect(self, host, port = 1883, keepalive = 60):
+        self.connected = True
+        self.events.append(lambda: self.on_connect(self, None, {}, 0))
+        return 0
+
+    def disconnect(self):
+        self.connected = False
+        if self.on_disconnect:
+            self.on_disconnect(self, None, 0)
+        return 0
+
+    def message_callback_add(self, sub, callback):
+        self.callbacks.append((sub, callback))
+
+    def subscribe(self, topic, qos = 0):
+
+        mid = next(self.broker.mids)
+        self.subscriptions.append(topic)
+        self.events.append(lambda: self.on_subscribe(self, None, mid, (qos,)))
+
+        # deliver retained messages
+        filter = topic.split('/', 2)[2] if topic.startswith('$share/') else topic
+        for t, payload in self.broker.retained.items():
+            if mqtt.topic_matches_sub(filter, t):
+                self.deliver(t, payload, qos, True)
+
+        return (0, mid)
+
+    def publish(self, topic, payload = None, qos = 0, retain = False):
+
+        if not self.connected:
+            return PublishResult(mqtt.MQTT_ERR_NO_CONN, 0)
+
+        mid = next(self.broker.mids)
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.broker.route(topic, payload, qos, retain)
+        if self.broker.immediate_ack:
+            self.on_publish(self, None, mid)
+        else:
+            self.events.append(lambda: self.on_publish(self, None, mid))
+        return PublishResult(0, mid)
+
+    def loop(self, timeout = 1.0, *args, **kwargs):
+
+        # process events first
+        while self.events:
+            self.events.popleft()()
+
+        # then messages
+        while self.inbox:
+            self.dispatch(self.inbox.popleft())
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self, *args, **kwargs):
+        pass
+
+    def loop_forever(self):
+        while self.connected and (self.events or self.inbox):
+            self.loop()
+
+    # helpers
+
+    def deliver(self, topic, payload, qos, retain):
+        msg = mqtt.MQTTMessage(topic=topic.encode('utf-8'))
+        msg.payload = payload or b''
+        msg.qos = qos
+        msg.retain = retain
+        self.inbox.append(msg)
+
+    def dispatch(self, msg):
+
+        matched = False
+        for sub, callback in self.callbacks:
+            if mqtt.topic_matches_sub(sub, msg.topic):
+                matched = True
+                callback(self, None, msg)
+
+        if not matched and self.on_message:
+            self.on_message(self, None, msg)
@@ -0,0 +1,52 @@
+import json
+from unittest.mock import patch
+
+from ambulance.models import Ambulance, AmbulanceStatus
+
+from login.tests.setup_data import TestSetup
+
+from ..subscribe import SubscribeClient
+
+from .broker import Broker
+
+class TestBulkUpdate(TestSetup):
+
+    def test_bulk_update(self):
+
+        config = {
+            'USERNAME': '',
+            'PASSWORD': '',
+            'HOST': 'localhost',
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True,
+            'CLIENT_ID': 'test_bulk'
+        }
+
+        broker = Broker()
+        with patch('mqtt.client.mqtt.Client', broker.Client):
+
+            client = SubscribeClient(config, verbosity=0)
+            client.loop()
+            self.assertIn('user/+/ambulance/data', client.client.subscriptions)
+
+            # device listens to errors
+            device = broker.Client('test_bulk_device')
+            device.connect('localhost')
+            device.subscribe('user/{}/error'.format(self.u3.username))
+
+            # gateway publishes updates of many ambulances
+            device.publish('user/{}/ambulance/data'.format(self.u3.username),
+                           json.dumps([
+                               {'id': self.a3.id, 'status': AmbulanceStatus.AV.name},
+                               {'id': self.a1.id, 'status': AmbulanceStatus.AV.name}
+                           ]), qos=2)
+            client.loop()
+
+            self.assertEqual(Ambulance.objects.get(id=self.a3.id).status,
+                             AmbulanceStatus.AV.name)
+            self.assertEqual(Ambulance.objects.get(id=self.a1.id).status,
+                             AmbulanceStatus.UK.name)
+
+            # failed updates are reported
+            self.assertEqual(len(device.inbox), 1)
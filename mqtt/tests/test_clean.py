@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+from ambulance.models import Ambulance, AmbulanceCapability
+
+from login.tests.setup_data import TestSetup
+
+from ..management.commands.mqttclean import Client, expected_topics
+
+from .broker import Broker
+
+class TestClean(TestSetup):
+
+    def test_expected_topics(self):
+
+        topics = expected_topics()
+        self.assertIn('settings', topics)
+        self.assertIn('ambulance/{}/data'.format(self.a1.id), topics)
+        self.assertIn('hospital/{}/metadata'.format(self.h1.id), topics)
+        self.assertIn('hospital/{}/equipment/{}/data'.format(self.h1.id, self.e1.name), topics)
+        self.assertIn('user/{}/profile'.format(self.u2.username), topics)
+        self.assertNotIn('hospital/{}/equipment/{}/data'.format(self.h1.id, self.e3.name), topics)
+
+    def test_clean_db(self):
+
+        broker = Broker()
+        broker.retained.update({
+            'settings': b'{}',
+            'ambulance/{}/data'.format(self.a1.id): b'{}',
+            'ambulance/-1/data': b'{}',
+            'hospital/{}/equipment/{}/data'.format(self.h1.id, self.e3.name): b'{}',
+            'user/nobody/profile': b'{}',
+            'other/topic': b'{}'
+        })
+
+        config = {
+            'USERNAME': '',
+            'PASSWORD': '',
+            'HOST': 'localhost',
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True,
+            'CLIENT_ID': 'test_clean'
+        }
+
+        with patch('mqtt.client.mqtt.Client', broker.Client):
+            client = Client(config, expected=expected_topics(), verbosity=0)
+
+        # ambulance created after reading the database
+        ambulance = Ambulance.objects.create(identifier='BC-999',
+                                             capability=AmbulanceCapability.B.name,
+                                             updated_by=self.u1)
+        broker.retained['ambulance/{}/data'.format(ambulance.id)] = b'{}'
+
+        # connect, subscribe, receive snapshot and sentinel
+        client.client.loop()
+        self.assertTrue(client.snapshot_done)
+        self.assertFalse(client.done())
+
+        # acknowledge removals
+        client.client.loop()
+        self.assertTrue(client.done())
+
+        # only orphaned topics owned by the application are removed
+        self.assertEqual(client.received, 7)
+        self.assertEqual(client.removed, 3)
+        self.assertEqual(set(broker.retained.keys()),
+                         {'settings',
+                          'ambulance/{}/data'.format(self.a1.id),
+                          'ambulance/{}/data'.format(ambulance.id),
+                          'other/topic'})
@@ -0,0 +1,113 @@
+import time
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+
+from ..client import BaseClient, MQTTException
+
+from .broker import Broker
+
+class TestBaseClient(SimpleTestCase):
+
+    def connect(self, broker, **kwargs):
+
+        config = {
+            'USERNAME': '',
+            'PASSWORD': '',
+            'HOST': 'localhost',
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True,
+            'CLIENT_ID': 'test_client'
+        }
+        config.update(kwargs)
+
+        with patch('mqtt.client.mqtt.Client', broker.Client):
+            client = BaseClient(config, verbosity=0)
+        client.loop()
+        self.assertTrue(client.connected)
+        return client
+
+    def test_inflight_window(self):
+
+        broker = Broker()
+        client = self.connect(broker, MAX_INFLIGHT=2)
+
+        # window is full after two publishes
+        mids = [client.publish('test/{}'.format(k), 'x', qos=2) for k in range(5)]
+        self.assertEqual(mids[2:], [None, None, None])
+        self.assertEqual(len(client.published), 2)
+        self.assertEqual(len(client.backlog), 3)
+        self.assertFalse(client.done())
+
+        # queued messages are sent in order as acknowledgements arrive
+        while not client.done():
+            self.assertLessEqual(len(client.published), 2)
+            client.loop()
+        self.assertEqual(list(broker.clients[0].events), [])
+
+        stats = client.stats()
+        self.assertEqual(stats['published'], 5)
+        self.assertEqual(stats['acknowledged'], 5)
+        self.assertEqual(stats['queued'], 3)
+        self.assertEqual(stats['inflight'], 0)
+        self.assertEqual(sorted(stats['latency'].keys()),
+                         ['test/{}'.format(k) for k in range(5)])
+        self.assertEqual(stats['latency']['test/0']['count'], 1)
+
+    def test_inflight_block(self):
+
+        broker = Broker()
+        client = self.connect(broker, MAX_INFLIGHT=1,
+                              INFLIGHT_BLOCK=True, INFLIGHT_TIMEOUT=0.1)
+
+        client.publish('test', 'x', qos=1)
+
+        # no acknowledgement, times out
+        with self.assertRaises(MQTTException):
+            client.publish('test', 'y', qos=1)
+        self.assertEqual(client.stats()['blocked'], 1)
+
+        # acknowledgement frees window
+        client.loop()
+        self.assertIsNotNone(client.publish('test', 'y', qos=1))
+
+    def test_early_ack(self):
+
+        broker = Broker(immediate_ack=True)
+        client = self.connect(broker, MAX_INFLIGHT=1)
+
+        # acknowledged before publish returns
+        for k in range(3):
+            self.assertIsNotNone(client.publish('test', 'x', qos=2))
+        self.assertTrue(client.done())
+        self.assertEqual(client.stats()['acknowledged'], 3)
+        self.assertEqual(client.acked, {})
+
+    def test_reset_inflight(self):
+
+        broker = Broker()
+        client = self.connect(broker, MAX_INFLIGHT=1, INFLIGHT_TIMEOUT=0.01)
+
+        for k in range(3):
+            client.publish('test/{}'.format(k), 'x', qos=2)
+        self.assertEqual(len(client.published), 1)
+        self.assertEqual(len(client.backlog), 2)
+
+        # acknowledgements lost with the connection
+        broker.clients[0].events.clear()
+
+        # queued messages are sent without waiting for an acknowledgement
+        client.reset_inflight()
+        self.assertEqual(len(client.published), 1)
+        self.assertEqual(len(client.backlog), 1)
+        while not client.done():
+            client.loop()
+        self.assertEqual(client.stats()['acknowledged'], 2)
+
+        # unmatched acknowledgements are forgotten
+        client.on_publish(None, None, 1000)
+        self.assertIn(1000, client.acked)
+        time.sleep(0.02)
+        client.on_publish(None, None, 1001)
+        self.assertEqual(list(client.acked), [1001])
@@ -0,0 +1,53 @@
+import json
+
+from django.test import SimpleTestCase
+
+from ..coalesce import Coalescer
+
+class Message():
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = json.dumps(payload).encode('utf-8')
+
+class TestCoalescer(SimpleTestCase):
+
+    def test_coalesce(self):
+
+        received = []
+        def handler(client, userdata, msg):
+            received.append((msg.topic, json.loads(msg.payload.decode('utf-8'))))
+
+        # large window, flush manually
+        coalescer = Coalescer(handler, 3600)
+
+        topic1 = 'user/admin/ambulance/1/data'
+        topic2 = 'user/admin/ambulance/2/data'
+        location = {'latitude': 32.5, 'longitude': -117.0}
+
+        def update(timestamp):
+            return {'location': location,
+                    'location_timestamp': '2018-01-01T00:00:{:02d}Z'.format(timestamp)}
+
+        coalescer.callback(None, None, Message(topic1, update(1)))
+        coalescer.callback(None, None, Message(topic1, update(3)))
+        coalescer.callback(None, None, Message(topic1, update(2)))   # out of order
+        coalescer.callback(None, None, Message(topic2, update(1)))
+        coalescer.callback(None, None, Message(topic1, {'status': 'AV'}))
+        coalescer.callback(None, None, Message(topic1, update(4)))
+        coalescer.callback(None, None, Message(topic1, update(5)))
+        coalescer.callback(None, None, Message(topic1, {'status': 'OS'}))
+
+        coalescer.stop()
+
+        # status changes are never dropped and order is preserved
+        self.assertEqual([d for t, d in received if t == topic1],
+                         [update(3), {'status': 'AV'}, update(5), {'status': 'OS'}])
+        self.assertEqual([d for t, d in received if t == topic2],
+                         [update(1)])
+
+        stats = coalescer.stats()
+        self.assertEqual(stats['received'], 8)
+        self.assertEqual(stats['forwarded'], 5)
+        self.assertEqual(stats['dropped'], 3)
+        self.assertEqual(stats['pending'], 0)
@@ -0,0 +1,48 @@
+from ambulance.serializers import AmbulanceSerializer
+
+from hospital.serializers import HospitalSerializer, \
+    HospitalEquipmentSerializer
+
+from login.tests.setup_data import TestSetup
+
+from ..codec import JSONCodec, ORJSONCodec, load_codec
+
+class TestCodec(TestSetup):
+
+    def codecs(self):
+        codecs = [JSONCodec()]
+        try:
+            codecs.append(ORJSONCodec())
+        except ImportError:
+            pass
+        return codecs
+
+    def test_codec(self):
+
+        payloads = [AmbulanceSerializer(self.a1).data,
+                    HospitalSerializer(self.h1).data,
+                    HospitalEquipmentSerializer(self.he1).data,
+                    {'topic': 'user/admin/ambulance/1/data',
+                     'payload': b'{ "value": ',
+                     'error': 'JSON formatted incorrectly'}]
+
+        reference = JSONCodec()
+        for codec in self.codecs():
+            for payload in payloads:
+
+                # all codecs agree
+                encoded = codec.encode(payload)
+                self.assertIsInstance(encoded, bytes)
+                self.assertEqual(codec.decode(encoded),
+                                 reference.decode(reference.encode(payload)))
+
+            # invalid payloads raise
+            with self.assertRaises(Exception):
+                codec.decode(b'{ "value": ')
+
+    def test_load_codec(self):
+
+        self.assertIsInstance(load_codec('json'), JSONCodec)
+        self.assertIsInstance(load_codec('mqtt.codec.JSONCodec'), JSONCodec)
+        with self.assertRaises(Exception):
+            load_codec('mqtt.codec.UnknownCodec')
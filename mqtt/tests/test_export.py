@@ -0,0 +1,143 @@
+import os, signal, tempfile
+from unittest.mock import patch
+
+from login.models import AmbulancePermission
+from login.tests.setup_data import TestSetup
+
+from ..export import Exporter, write_atomic
+
+class TestExport(TestSetup):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.acl_file = os.path.join(self.dir.name, 'acl')
+        self.password_file = os.path.join(self.dir.name, 'pwfile')
+        self.pid_file = os.path.join(self.dir.name, 'pid')
+        with open(self.pid_file, 'w') as file:
+            file.write('12345\n')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self, path):
+        with open(path) as file:
+            return file.read()
+
+    def test_write_atomic(self):
+
+        path = os.path.join(self.dir.name, 'file')
+        self.assertTrue(write_atomic(path, 'content'))
+        self.assertFalse(write_atomic(path, 'content'))
+        self.assertTrue(write_atomic(path, 'other'))
+        self.assertEqual(self.read(path), 'other')
+        self.assertEqual([name for name in os.listdir(self.dir.name)
+                          if name.endswith('.tmp')], [])
+
+    def test_export(self):
+
+        exporter = Exporter(acl_file=self.acl_file,
+                            password_file=self.password_file,
+                            pid_file=self.pid_file)
+
+        with patch('mqtt.export.os.kill') as kill:
+            self.assertTrue(exporter.export())
+            kill.assert_called_once_with(12345, signal.SIGHUP)
+
+        # acl
+        blocks = self.read(self.acl_file).split('\n\n')
+        self.assertIn('pattern write user/%u/client/%c/status', blocks[0])
+        self.assertIn('user {}\ntopic readwrite #'.format(self.u1.username), blocks)
+        acl = [block for block in blocks if block.startswith('user testuser2\n')][0].split('\n')
+        self.assertIn('topic read hospital/{}/metadata'.format(self.h1.id), acl)
+        self.assertNotIn('topic write user/testuser2/hospital/{}/data'.format(self.h1.id), acl)
+        self.assertIn('topic write user/testuser2/hospital/{}/data'.format(self.h2.id), acl)
+        self.assertIn('topic read ambulance/{}/data'.format(self.a3.id), acl)
+        self.assertIn('topic write user/testuser2/ambulance/{}/data'.format(self.a3.id), acl)
+        self.assertNotIn('topic read ambulance/{}/data'.format(self.a1.id), acl)
+
+        # passwords
+        passwords = self.read(self.password_file).splitlines()
+        for user in (self.u1, self.u2, self.u3):
+            if user.password.startswith('pbkdf2_'):
+                self.assertIn('{}:{}'.format(user.username,
+                                             user.password.replace('pbkdf2_', 'PBKDF2$', 1)),
+                              passwords)
+
+        # nothing changed
+        with patch('mqtt.export.os.kill') as kill:
+            self.assertFalse(exporter.export())
+            kill.assert_not_called()
+
+        # everything is loaded in three queries
+        AmbulancePermission.objects.filter(ambulance=self.a1,
+                                           profile__user=self.u3).update(can_read=True)
+        with self.assertNumQueries(3), patch('mqtt.export.os.kill'):
+            self.assertTrue(exporter.export())
+        self.assertIn('topic read ambulance/{}/data'.format(self.a1.id),
+                      self.read(self.acl_file))
+
+        # inactive users are removed
+        self.u2.is_active = False
+        self.u2.save()
+        with patch('mqtt.export.os.kill'):
+            exporter.export()
+        self.assertNotIn('user testuser1\n', self.read(self.acl_file))
+
+    def test_export_processes(self):
+
+        # exporters of two processes
+        exporters = [Exporter(acl_file=self.acl_file,
+                              password_file=self.password_file)
+                     for k in range(2)]
+        topic = 'topic write user/testuser2/ambulance/{}/data'.format(self.a3.id)
+
+        exporters[0].export()
+        self.assertIn(topic, self.read(self.acl_file))
+
+        # revoked and exported by one process
+        AmbulancePermission.objects.filter(ambulance=self.a3,
+                                           profile__user=self.u3).update(can_write=False)
+        self.assertTrue(exporters[1].export())
+        self.assertNotIn(topic, self.read(self.acl_file))
+
+        # not restored by the other
+        self.assertFalse(exporters[0].export())
+        self.assertNotIn(topic, self.read(self.acl_file))
+
+    def test_schedule(self):
+
+        exporter = Exporter(acl_file=self.acl_file)
+
+        # one export per transaction
+        callbacks = []
+        with patch('mqtt.export.transaction.on_commit', callbacks.append):
+            exporter.schedule()
+            exporter.schedule()
+            self.assertEqual(len(callbacks), 1)
+
+            # transaction rolled back, Django drops the callback
+            callbacks.clear()
+            exporter.schedule()
+            self.assertEqual(len(callbacks), 1)
+
+        # commit
+        with patch.object(exporter, 'load', wraps=exporter.load) as load:
+            callbacks.pop()()
+            self.assertEqual(load.call_count, 1)
+        self.assertTrue(os.path.exists(self.acl_file))
+
+        # requests counted before a load started are covered by it
+        with patch.object(exporter, 'load', wraps=exporter.load) as load:
+            self.assertFalse(exporter.export(exporter.requested))
+            load.assert_not_called()
+
+            # later requests are not
+            exporter.flush()
+            self.assertEqual(load.call_count, 1)
+
+        # failed exports do not cover requests
+        with patch.object(exporter, 'load', side_effect=Exception('failed')):
+            exporter.flush()
+        with patch.object(exporter, 'load', wraps=exporter.load) as load:
+            exporter.export(exporter.requested)
+            self.assertEqual(load.call_count, 1)
@@ -0,0 +1,180 @@
+import os, tempfile
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.conf import settings
+
+from login.tests.setup_data import TestSetupData
+
+from ..outbox import Outbox
+from ..publish import SingletonPublishClient
+
+from .broker import Broker
+
+class TestOutbox(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'outbox')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_outbox(self):
+
+        outbox = Outbox(self.path)
+        self.assertEqual(len(outbox), 0)
+
+        # last publish to topic wins
+        seq1 = outbox.put('a', b'1', 2, True)
+        seq2 = outbox.put('a', b'2', 2, True)
+        seq3 = outbox.put('b', None, 2, True)
+        self.assertEqual(len(outbox), 2)
+        self.assertFalse(outbox.is_pending('a', seq1))
+        self.assertTrue(outbox.is_pending('a', seq2))
+        self.assertTrue(outbox.is_pending('b', seq3))
+
+        # superseded publishes are not removed
+        outbox.done('a', seq1)
+        self.assertEqual(len(outbox), 2)
+        outbox.done('a', seq2)
+        self.assertEqual(len(outbox), 1)
+
+        # reload
+        outbox.put('c', b'3', 1, True)
+        outbox.close()
+        outbox = Outbox(self.path)
+        self.assertEqual([(topic, payload, qos, retain)
+                          for topic, seq, payload, qos, retain in outbox.items()],
+                         [('b', None, 2, True), ('c', b'3', 1, True)])
+
+        # partially written record is ignored
+        outbox.close()
+        with open(self.path, 'ab') as file:
+            file.write(outbox.record(Outbox.PUT, 'd', b'4')[:-1])
+        outbox = Outbox(self.path)
+        self.assertEqual(len(outbox), 2)
+
+        # replay
+        delivered = []
+        outbox.replay(lambda topic, payload, qos, retain, seq: delivered.append(topic))
+        self.assertEqual(delivered, ['b', 'c'])
+        self.assertEqual(outbox.stats()['replayed'], 2)
+        outbox.close()
+
+    def test_bounded(self):
+
+        outbox = Outbox(self.path, max_size=1024)
+
+        # same topics do not grow the outbox
+        for k in range(1000):
+            outbox.put('topic/{}'.format(k % 4), b'x' * 50, 2, True)
+        self.assertEqual(len(outbox), 4)
+        self.assertLessEqual(os.path.getsize(self.path), 1024)
+        self.assertEqual(outbox.stats()['dropped'], 0)
+
+        # too many topics drop the oldest
+        for k in range(100):
+            outbox.put('topic/{}'.format(k), b'x' * 50, 2, True)
+        self.assertLessEqual(os.path.getsize(self.path), 1024)
+        self.assertGreater(outbox.stats()['dropped'], 0)
+        self.assertTrue(outbox.is_pending('topic/99', outbox.seq))
+        outbox.close()
+
+    def test_adopt(self):
+
+        # outbox of a process that is gone
+        orphan = Outbox(self.path + '.1')
+        orphan.put('a', b'1', 2, True)
+        orphan.close()
+
+        # outbox of a process that is running
+        running = Outbox(self.path + '.2')
+        running.put('b', b'2', 2, True)
+        with self.assertRaises(OSError):
+            Outbox(self.path + '.2')
+
+        outbox = Outbox(self.path + '.3')
+        self.assertEqual(outbox.adopt(self.path), 1)
+        self.assertEqual([topic for topic, *_ in outbox.items()], ['a'])
+        self.assertFalse(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.2'))
+
+        # adopted publishes survive a restart
+        outbox.close()
+        outbox = Outbox(self.path + '.3')
+        self.assertEqual(len(outbox), 1)
+
+        # empty outboxes are removed on close
+        running.done('b', running.seq)
+        running.close()
+        self.assertFalse(os.path.exists(self.path + '.2'))
+        outbox.close()
+
+class PublishClient(SingletonPublishClient):
+
+    # do not share state with the application's client
+    _shared_state = {}
+
+class TestOutboxReplay(TestSetupData, TransactionTestCase):
+
+    def setUp(self):
+
+        self.setUpTestData()
+
+        self.dir = tempfile.TemporaryDirectory()
+        config = dict(settings.MQTT)
+        config['OUTBOX'] = os.path.join(self.dir.name, 'outbox')
+
+        # connect to broker stand-in
+        self.broker = Broker()
+        with override_settings(MQTT=config), \
+             patch('mqtt.client.mqtt.Client', self.broker.Client):
+            PublishClient._shared_state.clear()
+            self.publisher = PublishClient()
+
+    def tearDown(self):
+        self.publisher.stop()
+        PublishClient._shared_state.clear()
+        self.dir.cleanup()
+
+    def process(self):
+        self.publisher.queue.join()
+        self.publisher.client.loop()
+        self.publisher.queue.join()
+        self.publisher.client.loop()
+
+    def test_replay(self):
+
+        outbox = self.publisher.outbox
+        self.assertIsNotNone(outbox)
+        topic = 'hospital/{}/data'.format(self.h1.id)
+
+        # acknowledged publishes leave the outbox
+        self.process()
+        self.publisher.publish_hospital(self.h1)
+        self.process()
+        self.assertIn(topic, self.broker.retained)
+        self.assertEqual(len(outbox), 0)
+
+        # broker goes away
+        del self.broker.retained[topic]
+        self.publisher.client.connected = False
+        self.publisher.client.on_disconnect(self.publisher.client, None, 1)
+        self.assertTrue(self.publisher.active)
+
+        # publishes are kept in the outbox
+        for k in range(5):
+            self.publisher.publish_hospital(self.h1)
+        self.publisher.publish_hospital(self.h2)
+        self.process()
+        self.assertEqual(len(outbox), 2)
+        self.assertNotIn(topic, self.broker.retained)
+
+        # replayed on reconnect
+        self.publisher.client.connect('localhost')
+        self.process()
+        self.assertIn(topic, self.broker.retained)
+        self.assertIn('hospital/{}/data'.format(self.h2.id), self.broker.retained)
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(self.publisher.stats()['outbox']['replayed'], 2)
@@ -0,0 +1,237 @@
+import time
+from unittest.mock import patch
+
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from ambulance.models import Ambulance, AmbulanceStatus
+
+from login.tests.setup_data import TestSetupData
+
+from ..publish import SingletonPublishClient
+
+from .broker import Broker
+
+class PublishClient(SingletonPublishClient):
+
+    # do not share state with the application's client
+    _shared_state = {}
+
+class TestPublishBuffer(TestSetupData, TransactionTestCase):
+
+    def setUp(self):
+
+        self.setUpTestData()
+
+        # connect to broker stand-in
+        self.broker = Broker()
+        with patch('mqtt.client.mqtt.Client', self.broker.Client):
+            PublishClient._shared_state.clear()
+            self.publisher = PublishClient()
+
+            self.subscriber = self.broker.Client('test_subscriber')
+            self.subscriber.connect('localhost')
+            self.subscriber.subscribe('#')
+
+            # discard retained messages
+            self.subscriber.inbox.clear()
+
+    def tearDown(self):
+        self.publisher.stop()
+        PublishClient._shared_state.clear()
+
+    def received(self):
+        self.publisher.queue.join()
+        topics = [msg.topic for msg in self.subscriber.inbox]
+        self.subscriber.inbox.clear()
+        return topics
+
+    def test_publish_on_commit(self):
+
+        self.assertTrue(self.publisher.active)
+
+        metadata = 'hospital/{}/metadata'.format(self.h1.id)
+        data = 'hospital/{}/data'.format(self.h1.id)
+
+        # outside a transaction publish right away
+        self.publisher.publish_hospital(self.h1)
+        self.assertEqual(self.received(), [data])
+
+        # inside a transaction publish once, on commit
+        with transaction.atomic():
+
+            with self.assertNumQueries(0):
+                for k in range(10):
+                    self.publisher.publish_hospital_metadata(self.h1)
+                self.publisher.publish_hospital(self.h1)
+
+            self.assertEqual(self.received(), [])
+
+        self.assertEqual(self.received(), [metadata, data])
+
+        # nothing is published on rollback
+        try:
+            with transaction.atomic():
+                self.publisher.publish_hospital(self.h1)
+                raise Exception('rollback')
+        except Exception:
+            pass
+        self.assertEqual(self.received(), [])
+
+        # next transaction publishes on commit
+        with transaction.atomic():
+            self.publisher.publish_hospital(self.h1)
+        self.assertEqual(self.received(), [data])
+
+        # nothing is published for a savepoint that is rolled back
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.publisher.publish_hospital(self.h1)
+                    raise Exception('rollback')
+            except Exception:
+                pass
+            self.publisher.publish_hospital_metadata(self.h1)
+        self.assertEqual(self.received(), [metadata])
+
+        # last publish wins
+        with transaction.atomic():
+            self.publisher.publish_hospital(self.h1)
+            self.publisher.remove_hospital(self.h1)
+        self.assertEqual(self.received(), [data, metadata])
+        self.assertNotIn(data, self.broker.retained)
+
+    def test_publish_savepoint(self):
+
+        metadata = 'hospital/{}/metadata'.format(self.h1.id)
+        data = 'hospital/{}/data'.format(self.h1.id)
+
+        # buffer registered inside the savepoint is discarded with it
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.publisher.publish_hospital(self.h1)
+                    raise Exception('rollback')
+            except Exception:
+                pass
+        self.assertEqual(self.received(), [])
+
+        # publishes in a savepoint that is rolled back after the buffer was
+        # registered by the enclosing block are still sent (documented limitation)
+        with transaction.atomic():
+            self.publisher.publish_hospital_metadata(self.h1)
+            try:
+                with transaction.atomic():
+                    self.publisher.publish_hospital(self.h1)
+                    raise Exception('rollback')
+            except Exception:
+                pass
+            self.assertEqual(self.received(), [])
+        self.assertEqual(self.received(), [metadata, data])
+
+        # nothing is sent if the outer transaction is rolled back
+        try:
+            with transaction.atomic():
+                self.publisher.publish_hospital_metadata(self.h1)
+                with transaction.atomic():
+                    self.publisher.publish_hospital(self.h1)
+                raise Exception('rollback')
+        except Exception:
+            pass
+        self.assertEqual(self.received(), [])
+
+    def test_publish_delta(self):
+
+        self.publisher.delta = True
+        self.publisher.snapshot_interval = 3600
+
+        data = 'ambulance/{}/data'.format(self.a1.id)
+        delta = 'ambulance/{}/delta'.format(self.a1.id)
+
+        # first update publishes snapshot
+        with patch('mqtt.publish.SingletonPublishClient', lambda: self.publisher):
+
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            ambulance.location = Point(-117., 32., srid=4326)
+            ambulance.location_timestamp = timezone.now()
+            ambulance.save()
+            self.assertEqual(self.received(), [delta, data])
+
+            # location updates publish only deltas
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            ambulance.location = Point(-117., 33., srid=4326)
+            ambulance.location_timestamp = timezone.now()
+            ambulance.save()
+
+            self.publisher.queue.join()
+            msg = self.subscriber.inbox[0]
+            self.assertEqual(self.received(), [delta])
+
+            payload = self.publisher.codec.decode(msg.payload)
+            self.assertEqual(set(payload.keys()),
+                             {'id', 'seq', 'location', 'location_timestamp',
+                              'updated_on'})
+            self.assertEqual(payload['id'], self.a1.id)
+            self.assertEqual(payload['location'],
+                             {'latitude': 33., 'longitude': -117.})
+
+            # sequence numbers increase
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            ambulance.orientation = 10.
+            ambulance.save()
+
+            self.publisher.queue.join()
+            seq = self.publisher.codec.decode(self.subscriber.inbox[0].payload)['seq']
+            self.assertGreater(seq, payload['seq'])
+            self.assertEqual(self.received(), [delta])
+
+            # saving the same instance again publishes only the new changes
+            ambulance.orientation = 20.
+            ambulance.save()
+
+            self.publisher.queue.join()
+            payload = self.publisher.codec.decode(self.subscriber.inbox[0].payload)
+            self.assertEqual(set(payload.keys()),
+                             {'id', 'seq', 'orientation', 'updated_on'})
+            self.assertEqual(self.received(), [delta])
+
+            # other changes publish snapshot
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            ambulance.status = AmbulanceStatus.OS.name
+            ambulance.save()
+            self.assertEqual(self.received(), [delta, data])
+
+    def test_publish_trailing_snapshot(self):
+
+        self.publisher.delta = True
+        self.publisher.snapshot_interval = 0.2
+
+        data = 'ambulance/{}/data'.format(self.a1.id)
+        delta = 'ambulance/{}/delta'.format(self.a1.id)
+
+        with patch('mqtt.publish.SingletonPublishClient', lambda: self.publisher):
+
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            ambulance.location = Point(-117., 32., srid=4326)
+            ambulance.location_timestamp = timezone.now()
+            ambulance.save()
+            self.assertEqual(self.received(), [delta, data])
+
+            # snapshot skipped
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            ambulance.location = Point(-117., 33., srid=4326)
+            ambulance.location_timestamp = timezone.now()
+            ambulance.save()
+            self.assertEqual(self.received(), [delta])
+
+            # then published when the interval expires
+            time.sleep(0.5)
+            self.publisher.queue.join()
+            msg = self.subscriber.inbox[0]
+            self.assertEqual(self.received(), [data])
+            payload = self.publisher.codec.decode(msg.payload)
+            self.assertEqual(payload['location'],
+                             {'latitude': 33., 'longitude': -117.})
+            self.assertEqual(self.broker.retained[data], msg.payload)
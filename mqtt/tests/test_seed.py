@@ -0,0 +1,152 @@
+import os, tempfile
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from rest_framework.renderers import JSONRenderer
+
+from ambulance.models import Ambulance
+
+from hospital.models import Equipment, Hospital, HospitalEquipment
+from hospital.serializers import EquipmentSerializer
+
+from login.models import Profile, HospitalPermission
+from login.tests.setup_data import TestSetup
+
+from ..client import MQTTException
+from ..management.commands.mqttseed import Client, chunked, \
+    load_state, save_state
+
+from .broker import Broker
+
+class TestSeed(TestSetup):
+
+    def test_chunked(self):
+
+        profiles = list(Profile.objects.order_by('pk'))
+        chunks = list(chunked(Profile.objects.all(), 2))
+        self.assertTrue(all(len(chunk) <= 2 for chunk in chunks))
+        self.assertEqual([obj for chunk in chunks for obj in chunk], profiles)
+
+    def seed(self, state = None, workers = 0, broker = None, **kwargs):
+
+        config = {
+            'USERNAME': '',
+            'PASSWORD': '',
+            'HOST': 'localhost',
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True,
+            'CLIENT_ID': 'test_seed',
+            'MAX_INFLIGHT': 4,
+            'SEED_MARGIN': 0
+        }
+        config.update(kwargs)
+
+        if broker is None:
+            broker = Broker(immediate_ack=True)
+        with patch('mqtt.client.mqtt.Client', broker.Client):
+            client = Client(config, workers=workers, chunk_size=2, verbosity=0)
+        client.loop()
+        state = client.seed(state)
+        self.assertTrue(client.done())
+
+        return broker, client, state
+
+    def test_seed(self):
+
+        broker, client, state = self.seed()
+
+        # all retained topics are published
+        topics = {'settings'}
+        topics.update('ambulance/{}/data'.format(obj.id)
+                      for obj in (self.a1, self.a2, self.a3))
+        topics.update('hospital/{}/{}'.format(obj.id, name)
+                      for obj in (self.h1, self.h2, self.h3)
+                      for name in ('data', 'metadata'))
+        topics.update('hospital/{}/equipment/{}/data'.format(obj.hospital.id, obj.equipment.name)
+                      for obj in (self.he1, self.he2, self.he3, self.he4, self.he5))
+        topics.update('user/{}/profile'.format(obj.user.username)
+                      for obj in Profile.objects.all())
+        self.assertEqual(set(broker.retained.keys()), topics)
+        self.assertEqual(client.stats()['acknowledged'], len(topics))
+
+        # metadata is the same as publish_hospital_metadata
+        equipment = Equipment.objects.filter(id__in=(self.e1.id, self.e2.id)).order_by('id')
+        self.assertEqual(broker.retained['hospital/{}/metadata'.format(self.h1.id)],
+                         JSONRenderer().render(EquipmentSerializer(equipment, many=True).data))
+
+    def test_incremental(self):
+
+        with tempfile.TemporaryDirectory() as dir:
+
+            # full seed
+            path = os.path.join(dir, 'state')
+            broker, client, state = self.seed()
+            save_state(path, state)
+            self.assertEqual(set(state['watermarks'].keys()),
+                             {'ambulance', 'hospital', 'hospital_equipment'})
+
+            # nothing changed, only settings
+            state = load_state(path)
+            broker, client, state = self.seed(state)
+            self.assertEqual(set(broker.retained.keys()), {'settings'})
+
+            # ambulance and permissions changed
+            Ambulance.objects.filter(id=self.a1.id).update(updated_on=timezone.now())
+            self.u2.profile.hospitals.add(
+                HospitalPermission.objects.create(hospital=self.h2)
+            )
+            broker, client, state = self.seed(state)
+            self.assertEqual(set(broker.retained.keys()),
+                             {'settings',
+                              'ambulance/{}/data'.format(self.a1.id),
+                              'user/{}/profile'.format(self.u2.username)})
+
+    def test_late_commit(self):
+
+        # everything was updated long ago
+        past = timezone.now() - timedelta(hours=1)
+        Ambulance.objects.update(updated_on=past)
+        Hospital.objects.update(updated_on=past)
+        HospitalEquipment.objects.update(updated_on=past)
+
+        broker, client, state = self.seed(SEED_MARGIN=60)
+
+        # committed after the seed read ambulances, but updated before it started
+        Ambulance.objects.filter(id=self.a1.id).update(updated_on=timezone.now() - timedelta(seconds=10))
+
+        # picked up by the next seed
+        broker, client, state = self.seed(state, SEED_MARGIN=60)
+        self.assertEqual(set(broker.retained.keys()),
+                         {'settings', 'ambulance/{}/data'.format(self.a1.id)})
+
+    def test_acknowledgement_timeout(self):
+
+        # publishes are never acknowledged
+        with self.assertRaises(MQTTException):
+            self.seed(broker=Broker(), MAX_INFLIGHT=0, INFLIGHT_TIMEOUT=0.2)
+
+    def test_worker_errors(self):
+
+        # failed chunks are not reported as seeded
+        with patch.object(Client, 'publish_ambulance', side_effect=Exception('failed')), \
+             self.assertRaises(MQTTException):
+            self.seed(workers=2)
+
+    def test_state_not_saved_on_errors(self):
+
+        with tempfile.TemporaryDirectory() as dir:
+
+            path = os.path.join(dir, 'state')
+            broker = Broker(immediate_ack=True)
+            with patch('mqtt.client.mqtt.Client', broker.Client), \
+                 patch.object(Client, 'publish_ambulance', side_effect=Exception('failed')), \
+                 self.assertRaises(CommandError):
+                call_command('mqttseed', state=path, workers=2, verbosity=0)
+
+            # ambulances are seeded again next time
+            self.assertFalse(os.path.exists(path))
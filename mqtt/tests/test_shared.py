@@ -0,0 +1,99 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.utils import timezone
+
+from ambulance.models import Ambulance, AmbulanceStatus
+
+from emstrack.tests.util import date2iso
+
+from login.tests.setup_data import TestSetup
+
+from ..subscribe import SubscribeClient
+
+from .broker import Broker
+
+class TestSharedSubscription(TestSetup):
+
+    def connect(self, broker, client_id, group):
+
+        config = {
+            'USERNAME': '',
+            'PASSWORD': '',
+            'HOST': 'localhost',
+            'PORT': 1883,
+            'KEEPALIVE': 60,
+            'CLEAN_SESSION': True,
+            'CLIENT_ID': client_id,
+            'SHARED_GROUP': group
+        }
+
+        client = SubscribeClient(config, verbosity=0)
+        client.loop()
+        self.assertTrue(client.connected)
+        return client
+
+    def test_shared_subscription(self):
+
+        broker = Broker()
+        with patch('mqtt.client.mqtt.Client', broker.Client):
+
+            # two clients in the same group
+            client1 = self.connect(broker, 'test_shared_1', 'emstrack')
+            client2 = self.connect(broker, 'test_shared_2', 'emstrack')
+            for client in (client1, client2):
+                self.assertIn('$share/emstrack/user/+/ambulance/+/data',
+                              client.client.subscriptions)
+                self.assertTrue(client.guard)
+
+            # device publishes location updates
+            device = broker.Client('test_shared_device')
+            device.connect('localhost')
+
+            topic = 'user/{}/ambulance/{}/data'.format(self.u1.username,
+                                                       self.a1.id)
+            now = timezone.now()
+            timestamps = [now + timedelta(seconds=k) for k in range(6)]
+            for k, timestamp in enumerate(timestamps):
+                device.publish(topic,
+                               json.dumps({
+                                   'location': {'latitude': 32. + k,
+                                                'longitude': -117.},
+                                   'location_timestamp': date2iso(timestamp)
+                               }), qos=2)
+
+            # load is balanced between clients
+            self.assertEqual(len(client1.client.inbox), 3)
+            self.assertEqual(len(client2.client.inbox), 3)
+
+            # process out of order: client2 has the latest update
+            client2.loop()
+            client1.loop()
+
+            # live location never moves back in time
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            self.assertEqual(ambulance.location_timestamp, timestamps[-1])
+            self.assertEqual(ambulance.location.y, 37.)
+
+            # status changes are applied
+            device.publish(topic,
+                           json.dumps({'status': AmbulanceStatus.AV.name}),
+                           qos=2)
+            client1.loop()
+            client2.loop()
+            ambulance = Ambulance.objects.get(id=self.a1.id)
+            self.assertEqual(ambulance.status, AmbulanceStatus.AV.name)
+            self.assertEqual(ambulance.location_timestamp, timestamps[-1])
+
+            # without a group every client gets every message
+            client3 = self.connect(broker, 'test_shared_3', '')
+            self.assertIn('user/+/ambulance/+/data',
+                          client3.client.subscriptions)
+            self.assertFalse(client3.guard)
+            device.publish(topic,
+                           json.dumps({'status': AmbulanceStatus.OS.name}),
+                           qos=2)
+            self.assertEqual(len(client3.client.inbox), 1)
+            self.assertEqual(len(client1.client.inbox) +
+                             len(client2.client.inbox), 1)
@@ -0,0 +1,63 @@
+import threading, time
+
+from django.test import SimpleTestCase
+
+from ..workers import WorkerPool
+
+class TestWorkerPool(SimpleTestCase):
+
+    def test_ordering(self):
+
+        # record order of processing per key
+        lock = threading.Lock()
+        processed = {}
+
+        def task(key, value):
+            # make sure tasks overlap
+            time.sleep(0.001)
+            with lock:
+                processed.setdefault(key, []).append(value)
+
+        pool = WorkerPool(4)
+
+        # submit tasks
+        for value in range(50):
+            for key in range(10):
+                pool.submit(key, task, key, value)
+
+        # wait until done
+        pool.join()
+
+        # all tasks processed in order
+        for key in range(10):
+            self.assertEqual(processed[key], list(range(50)))
+
+        # counters
+        stats = pool.stats()
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['processed'], 500)
+        self.assertEqual(len(stats['workers']), 4)
+        self.assertEqual(sum(w['errors'] for w in stats['workers']), 0)
+
+        pool.stop()
+
+    def test_shard(self):
+
+        pool = WorkerPool(3)
+
+        # same key, same worker
+        self.assertEqual(pool.shard('12'), pool.shard(12))
+        self.assertEqual(pool.shard('abc'), pool.shard('abc'))
+        self.assertEqual([pool.shard(k) for k in range(6)],
+                         [0, 1, 2, 0, 1, 2])
+
+        # errors are counted but do not stop the worker
+        def fail():
+            raise Exception('fail')
+
+        pool.submit(0, fail)
+        pool.join()
+        self.assertEqual(pool.stats()['workers'][0]['errors'], 1)
+
+        pool.stop()
+        pool.stop()
@@ -0,0 +1,150 @@
+import logging
+import threading, queue, time, zlib
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# Worker
+
+class Worker(threading.Thread):
+
+    def __init__(self, pool, index):
+
+        # call super
+        super().__init__(name='mqtt_worker_{}'.format(index),
+                         daemon=True)
+
+        self.pool = pool
+        self.index = index
+        self.queue = queue.Queue(pool.max_queue_size)
+
+        # counters
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def run(self):
+
+        while True:
+
+            # wait for next task
+            task = self.queue.get()
+            if task is None:
+                # sentinel, stop
+                self.queue.task_done()
+                break
+
+            func, args, kwargs = task
+            start = time.monotonic()
+
+            try:
+
+                # make sure stale connections are not reused
+                close_old_connections()
+
+                # process task
+                func(*args, **kwargs)
+
+            except Exception as e:
+
+                self.errors += 1
+                logger.warning(('mqtt.Worker[{}]: task {} failed, ' +
+                                'exception = {}').format(self.index, func, e))
+
+            finally:
+
+                self.processed += 1
+                self.busy_time += time.monotonic() - start
+                self.queue.task_done()
+
+        # close thread connection
+        close_old_connections()
+
+# WorkerPool
+
+class WorkerPool():
+
+    """
+    Pool of worker threads with one queue per worker.
+
+    Tasks are assigned to a worker by hashing a key, so that all tasks
+    with the same key, for example the id of an ambulance, are processed
+    in the order they were submitted, while tasks with different keys
+    are processed in parallel.
+    """
+
+    def __init__(self, size, max_queue_size = 0):
+
+        if size < 1:
+            raise ValueError('WorkerPool needs at least one worker')
+
+        self.size = size
+        self.max_queue_size = max_queue_size
+        self.started_on = time.monotonic()
+        self.stopped = False
+
+        # create and start workers
+        self.workers = [Worker(self, k) for k in range(size)]
+        for worker in self.workers:
+            worker.start()
+
+    def shard(self, key):
+
+        # integer keys are distributed round-robin, everything else by crc
+        try:
+            value = int(key)
+        except (TypeError, ValueError):
+            value = zlib.crc32(str(key).encode('utf-8'))
+
+        return value % self.size
+
+    def submit(self, key, func, *args, **kwargs):
+
+        # queue task in the worker responsible for key;
+        # this will block if max_queue_size is reached
+        self.workers[self.shard(key)].queue.put((func, args, kwargs))
+
+    def join(self):
+
+        # wait until all queues are empty
+        for worker in self.workers:
+            worker.queue.join()
+
+    def stop(self, wait = True):
+
+        # already stopped?
+        if self.stopped:
+            return
+        self.stopped = True
+
+        # send sentinels
+        for worker in self.workers:
+            worker.queue.put(None)
+
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+    def queue_depth(self):
+        return sum(worker.queue.qsize() for worker in self.workers)
+
+    def errors(self):
+        return sum(worker.errors for worker in self.workers)
+
+    def stats(self):
+
+        elapsed = max(time.monotonic() - self.started_on, 1e-9)
+
+        return {
+            'queue_depth': self.queue_depth(),
+            'processed': sum(worker.processed for worker in self.workers),
+            'errors': self.errors(),
+            'workers': [{
+                'queue_depth': worker.queue.qsize(),
+                'processed': worker.processed,
+                'errors': worker.errors,
+                'rate': worker.processed / elapsed,
+                'utilization': worker.busy_time / elapsed
+            } for worker in self.workers]
+        }